@@ -0,0 +1,215 @@
+# Streaming tar and zip archive input and output for the E-Safenet folder actions
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Members are read one at a time as a stream (tar archives in stream mode, zip members decompressed on the fly),
+# and written the same way, so no member has to be held in memory or extracted to a temporary file:
+#   - tar: a member header needs the size of the member. The size of an encrypted or decrypted file is known
+#     once its header block is processed, which is done before the member is added.
+#   - zip: the member is compressed while it is written, and its header is completed afterwards, like
+#     ZipFile.write does for files on disk. The output archive has to be a regular (seekable) file.
+import os
+import tarfile
+import time
+import zipfile
+import zlib
+
+#Output archive formats, by file name suffix
+SUFFIXES = [('.zip', 'zip'), ('.tar', 'w|'), ('.tar.gz', 'w|gz'), ('.tgz', 'w|gz'), ('.tar.bz2', 'w|bz2'), ('.tbz2', 'w|bz2')]
+#Zip archives cannot hold dates before 1980
+ZIP_EPOCH = time.mktime((1980, 1, 2, 0, 0, 0, 0, 0, -1))
+
+class ArchiveException(Exception):
+	pass
+
+"""
+Whether path is an existing tar or zip archive.
+"""
+def is_archive(path):
+	return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+"""
+The mode to write an archive at path in (see SUFFIXES), or None if path is not named like an archive.
+"""
+def archive_mode(path):
+	for suffix, mode in SUFFIXES:
+		if path.lower().endswith(suffix):
+			return mode
+	return None
+
+"""
+Check that a member name stays inside the folder it is extracted to.
+"""
+def safe_name(name):
+	name = name.replace("\\", "/")
+	parts = [p for p in name.split("/") if p not in ("", ".")]
+	if name.startswith("/") or ".." in parts or not parts:
+		raise ArchiveException("Unsafe member name %r" % name)
+	return "/".join(parts)
+
+"""
+Yield (name, file object, size, modification time) for the regular files in an archive, in the order they are stored.
+A file object can only be read until the next member is yielded.
+"""
+def archive_files(path):
+	if zipfile.is_zipfile(path):
+		zf = zipfile.ZipFile(path)
+		try:
+			for info in zf.infolist():
+				if info.filename.endswith("/"):
+					continue
+				fh = zf.open(info)
+				yield info.filename, fh, info.file_size, time.mktime(info.date_time + (0, 0, -1))
+				fh.close()
+		finally:
+			zf.close()
+	else:
+		tf = tarfile.open(path, "r|*")
+		try:
+			for member in tf:
+				if member.isfile():
+					yield member.name, tf.extractfile(member), member.size, member.mtime
+		finally:
+			tf.close()
+
+"""
+Like archive_files, for the files below a folder, named relative to it.
+"""
+def folder_files(folder):
+	for root, dirs, files in os.walk(folder):
+		for f in files:
+			path = os.path.join(root, f)
+			st = os.stat(path)
+			with open(path, "rb") as fh:
+				yield os.path.relpath(path, folder).replace(os.sep, "/"), fh, st.st_size, st.st_mtime
+
+"""
+A file-like object reading from an iterator of chunks, for tarfile.addfile.
+"""
+class ChunkReader:
+	def __init__(self, chunks):
+		self.chunks = iter(chunks)
+		self.buffer = ""
+		self.pos = 0
+
+	def read(self, size=-1):
+		#tarfile reads in small blocks, the chunk is only copied when it runs out
+		while size < 0 or len(self.buffer) - self.pos < size:
+			chunk = next(self.chunks, None)
+			if chunk is None:
+				break
+			self.buffer = self.buffer[self.pos:] + chunk
+			self.pos = 0
+		if size < 0:
+			size = len(self.buffer) - self.pos
+		data = self.buffer[self.pos:self.pos + size]
+		self.pos += len(data)
+		return data
+
+"""
+Writes files into a new tar or zip archive, the format is picked by the name of the archive (see SUFFIXES).
+"""
+class ArchiveWriter:
+	def __init__(self, path):
+		self.mode = archive_mode(path)
+		if self.mode is None:
+			raise ArchiveException("%s is not named like a tar or zip archive" % path)
+		if self.mode == 'zip':
+			self.archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, True)
+		else:
+			self.archive = tarfile.open(path, self.mode)
+
+	"""
+	Add a file of the given size, with its contents in chunks.
+	"""
+	def add(self, name, size, mtime, chunks):
+		if self.mode == 'zip':
+			self.add_zip(name, size, mtime, chunks)
+			return
+		info = tarfile.TarInfo(name)
+		info.size = size
+		info.mtime = mtime
+		info.mode = 0644
+		reader = ChunkReader(chunks)
+		self.archive.addfile(info, reader)
+		if reader.read(1):
+			raise ArchiveException("Member %s is larger than %d bytes" % (name, size))
+
+	"""
+	Add a member to the zip archive without knowing its contents up front, see ZipFile.write.
+	"""
+	def add_zip(self, name, size, mtime, chunks):
+		zf = self.archive
+		info = zipfile.ZipInfo(name, time.localtime(max(mtime, ZIP_EPOCH))[:6])
+		info.external_attr = 0644 << 16
+		info.compress_type = zipfile.ZIP_DEFLATED
+		info.file_size = size
+		info.header_offset = zf.fp.tell()
+		zf._writecheck(info)
+		zf._didModify = True
+		#the sizes and CRC in the header are written again once they are known
+		info.CRC = crc = 0
+		info.compress_size = compress_size = 0
+		zip64 = size * 1.05 > zipfile.ZIP64_LIMIT
+		zf.fp.write(info.FileHeader(zip64))
+		compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+		file_size = 0
+		for chunk in chunks:
+			file_size += len(chunk)
+			crc = zlib.crc32(chunk, crc) & 0xffffffff
+			data = compressor.compress(chunk)
+			compress_size += len(data)
+			zf.fp.write(data)
+		data = compressor.flush()
+		compress_size += len(data)
+		zf.fp.write(data)
+		if file_size != size:
+			raise ArchiveException("Member %s is %d bytes instead of %d" % (name, file_size, size))
+		info.CRC = crc
+		info.compress_size = compress_size
+		position = zf.fp.tell()
+		zf.fp.seek(info.header_offset)
+		zf.fp.write(info.FileHeader(zip64))
+		zf.fp.seek(position)
+		zf.filelist.append(info)
+		zf.NameToInfo[info.filename] = info
+
+	def close(self):
+		self.archive.close()
+
+"""
+Writes files into a folder, like ArchiveWriter.
+"""
+class FolderWriter:
+	def __init__(self, folder):
+		self.folder = folder
+		if not os.path.isdir(folder):
+			os.mkdir(folder)
+
+	def add(self, name, size, mtime, chunks):
+		path = os.path.join(self.folder, safe_name(name))
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		try:
+			with open(path, "wb") as fh:
+				for chunk in chunks:
+					fh.write(chunk)
+		except:
+			os.remove(path) #do not leave partial output behind
+			raise
+
+	def close(self):
+		pass
@@ -0,0 +1,358 @@
+# Speed and key recovery accuracy benchmark of the E-Safenet engines and attacks
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Generates synthetic corpora (source code in C, PHP and CS, binary files) encrypted with a generated key,
+# times the engines and attacks on them, and reports the accuracy of the recovered keys.
+# The same seed gives the same key and corpora (check with --check-seed), the results are written as JSON.
+#
+# usage: python benchmarks/suite.py [--sizes 1K,64K,1M] [--files 20] [--seed 1] [--outfile results.json] [--check-seed]
+import argparse
+import cPickle
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from esafenet import Esafenet
+import esafenet
+import coa_models
+import partial_binary
+import partial_c
+import simplelzo1x
+import xor_engine
+
+LANGUAGES = ['C', 'PHP', 'CS']
+#Identifiers, operators and layout mixed with the keywords of the language
+FILLER = ['i', 'j', 'count', 'buffer', 'result', 'value', 'name', 'data', 'len', 'index', '0', '1', '42',
+	' = ', ' + ', ' == ', ' < ', '(', ')', ', ', '; ', '.', '[', ']', ' ', ' ', ' ', '\n', '\n', '    ', '\t']
+
+#Texts are generated up to this size, larger texts are made of slices of such a block (see extend)
+BLOCK = 1 << 16
+#Random bytes of binary texts are generated this many at a time
+POOL = 1 << 20
+
+def parse_size(s):
+	units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+	s = s.strip().upper()
+	if s[-1] in units:
+		return int(float(s[:-1]) * units[s[-1]])
+	return int(s)
+
+"""
+Text of the given size made of slices of block, at offsets and of lengths drawn from rnd. Large texts are built
+from a single generated block this way, which is fast and still only depends on the seed.
+"""
+def extend(rnd, block, size):
+	if size <= len(block):
+		return block[:size]
+	parts = []
+	length = 0
+	while length < size:
+		start = rnd.randrange(len(block) // 2)
+		part = block[start:start + min(rnd.randint(len(block) // 8, len(block) // 2), size - length)]
+		parts.append(part)
+		length += len(part)
+	return "".join(parts)
+
+"""
+Source code-like plaintext of the given size.
+"""
+def source_text(rnd, language, size):
+	words = partial_c.keyword_lists[language] * 2 + FILLER
+	parts = []
+	length = 0
+	while length < min(size, BLOCK):
+		line = "".join(rnd.choice(words) for i in range(rnd.randint(2, 12))) + "\n"
+		parts.append(line)
+		length += len(line)
+	return extend(rnd, "".join(parts)[:BLOCK], size)
+
+"""
+n random bytes from rnd.
+"""
+def random_bytes(rnd, n):
+	return ("%0*x" % (2 * n, rnd.getrandbits(8 * n))).decode("hex")
+
+"""
+Binary plaintext of the given size: structures with many zero bytes, random data in between.
+The first block is mostly zeros, so it compresses like the header of a real binary file.
+"""
+def binary_text(rnd, size):
+	parts = ["\x00" * 1024]
+	length = 1024
+	#random data is drawn a pool at a time, and never repeated: repeats at the same key offset would look like key bytes
+	pool = ""
+	used = 0
+	while length < size:
+		if rnd.random() < 0.5:
+			part = "\x00" * rnd.randint(64, 2048)
+		else:
+			n = rnd.randint(16, 512)
+			if used + n > len(pool):
+				pool = random_bytes(rnd, min(POOL, max(size, 512)))
+				used = 0
+			part = pool[used:used + n]
+			used += n
+		parts.append(part)
+		length += len(part)
+	parts[-1] = parts[-1][:len(parts[-1]) - (length - size)]
+	return "".join(parts)
+
+"""
+Compare a recovered key with the real key, like partial_c.compare_keys.
+"""
+def key_accuracy(key, real):
+	if key is None:
+		return {'match': 0, 'none': len(real), 'wrong': 0}
+	key = list(key)
+	match = sum(1 for k, r in zip(key, real) if k == r)
+	none = sum(1 for k in key if k is None)
+	return {'match': match, 'none': none, 'wrong': len(real) - match - none}
+
+"""
+Run fn without output, process_parallel prints the matches of every file and the key counts.
+"""
+def quiet(fn):
+	def run():
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, "w")
+		try:
+			return fn()
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+	return run
+
+class Suite:
+	def __init__(self, seed, workdir):
+		self.rnd = random.Random(seed)
+		random.seed(seed)
+		#not Esafenet.generate_key, which seeds the global generator from the system
+		self.key = [self.rnd.randint(0, 255) for i in range(512)]
+		self.workdir = workdir
+		self.results = []
+		#hash of the key and all generated plaintexts, to compare runs
+		self.digest = hashlib.sha1(str(self.key))
+
+	def source(self, language, size):
+		text = source_text(self.rnd, language, size)
+		self.digest.update(text)
+		return text
+
+	def binary_source(self, size):
+		text = binary_text(self.rnd, size)
+		self.digest.update(text)
+		return text
+
+	"""
+	Time fn(), record the result and print a line. Returns the value of fn.
+	"""
+	def measure(self, name, fn, size=None, accuracy=None, **info):
+		start = time.time()
+		value = fn()
+		elapsed = time.time() - start
+		result = {'name': name, 'seconds': round(elapsed, 6)}
+		if size is not None:
+			result['bytes'] = size
+			result['mb_per_s'] = round(size / max(elapsed, 1e-9) / (1 << 20), 3)
+		if accuracy is not None:
+			result['accuracy'] = accuracy(value)
+		result.update(info)
+		self.results.append(result)
+		line = "%-40s %10.3fs" % (name + (" " + info['label'] if 'label' in info else ""), elapsed)
+		if size is not None:
+			line += " %10.2f MB/s" % result['mb_per_s']
+		if accuracy is not None:
+			line += "  match %(match)d none %(none)d wrong %(wrong)d" % result['accuracy']
+		print line
+		return value
+
+	def encrypt_decrypt(self, sizes):
+		for size in sizes:
+			plain = self.source('C', size)
+			label = "%d bytes" % size
+			encrypted = self.measure("encrypt_file", lambda: Esafenet.encrypt_file(plain, self.key), size, label=label)
+			decrypted = self.measure("decrypt_file", lambda: Esafenet.decrypt_file(encrypted, self.key), size, label=label)
+			assert decrypted == plain
+			#every output is dropped once checked, so only the input, the encrypted file and one output are held
+			del decrypted
+			if esafenet.NATIVE:
+				#the native calls must give the same files as the Python path
+				esafenet.NATIVE = False
+				try:
+					python_encrypted = self.measure("encrypt_file python", lambda: Esafenet.encrypt_file(plain, self.key), size, label=label)
+					assert python_encrypted == encrypted, "native and Python encryption differ"
+					del python_encrypted
+					python_decrypted = self.measure("decrypt_file python", lambda: Esafenet.decrypt_file(encrypted, self.key), size, label=label)
+					assert python_decrypted == plain
+					del python_decrypted
+				finally:
+					esafenet.NATIVE = True
+			plain = encrypted = None
+
+	"""
+	Encrypt many small files with one compressor, and with a new compressor per file. The work memory is cleared
+	for every compression, so this shows whether keeping a compressor still pays.
+	"""
+	def compressor_reuse(self, files, size=1024):
+		texts = [self.source('C', size) for i in range(files)]
+		k = xor_engine.key_string(self.key)
+		label = "%d files of %d bytes" % (files, size)
+		compressor = simplelzo1x.Compressor()
+		reused = self.measure("compressor reused", lambda: [compressor.encrypt(text, k) for text in texts], files * size, label=label)
+		new = self.measure("compressor per file", lambda: [simplelzo1x.Compressor().encrypt(text, k) for text in texts], files * size, label=label)
+		assert reused == new
+
+	def write_corpus(self, name, texts):
+		folder = os.path.join(self.workdir, name)
+		os.makedirs(folder)
+		for i, text in enumerate(texts):
+			with open(os.path.join(folder, "%04d" % i), "wb") as fh:
+				fh.write(Esafenet.encrypt_file(text, self.key))
+		return folder
+
+	def folders(self, sizes, files):
+		texts = [self.source('C', self.rnd.choice(sizes)) for i in range(files)]
+		size = sum(len(t) for t in texts)
+		plain = os.path.join(self.workdir, "plain")
+		os.makedirs(plain)
+		for i, text in enumerate(texts):
+			with open(os.path.join(plain, "%04d" % i), "wb") as fh:
+				fh.write(text)
+		for jobs in [1, 0]:
+			label = "%d files, jobs %d" % (files, jobs)
+			enc, dec = os.path.join(self.workdir, "enc%d" % jobs), os.path.join(self.workdir, "dec%d" % jobs)
+			failures = self.measure("encrypt_folder", lambda: Esafenet.encrypt_folder(plain, self.key, enc, jobs), size, label=label, jobs=jobs)
+			failures += self.measure("decrypt_folder", lambda: Esafenet.decrypt_folder(enc, self.key, dec, jobs), size, label=label, jobs=jobs)
+			assert not failures
+		label = "%d files, pipeline" % files
+		enc, dec = os.path.join(self.workdir, "enc_pipeline"), os.path.join(self.workdir, "dec_pipeline")
+		failures = self.measure("encrypt_folder", lambda: Esafenet.encrypt_folder(plain, self.key, enc, 0, 8), size, label=label, jobs=0, io_threads=8)
+		failures += self.measure("decrypt_folder", lambda: Esafenet.decrypt_folder(enc, self.key, dec, 0, False, 8), size, label=label, jobs=0, io_threads=8)
+		assert not failures
+
+	def known_plaintext(self, sizes):
+		for size in sizes:
+			if size < 1536:
+				continue
+			plain = self.source('C', size)
+			encrypted = Esafenet.encrypt_file(plain, self.key)
+			self.measure("find_key", lambda: Esafenet.find_key(encrypted, plain), size,
+				lambda key: key_accuracy(key, self.key), label="%d bytes" % size)
+
+	def binary(self, sizes):
+		for size in sizes:
+			encrypted = Esafenet.encrypt_file(self.binary_source(size), self.key)
+			self.measure("find_binary_key", lambda: partial_binary.find_binary_key(encrypted), size,
+				lambda key: key_accuracy(partial_binary.binary_key_bytes(encrypted), self.key), label="%d bytes" % size)
+
+	def text(self, sizes, files, jobs):
+		for language in LANGUAGES:
+			texts = [self.source(language, self.rnd.choice(sizes)) for i in range(files)]
+			folder = self.write_corpus("text_" + language, texts)
+			size = sum(len(t) for t in texts)
+			out = StringIO.StringIO()
+			self.measure("process_parallel", quiet(lambda: partial_c.process_parallel(folder, language, out, jobs)), size,
+				lambda r: key_accuracy(cPickle.loads(out.getvalue()), self.key), label="%s, %d files" % (language, files), language=language)
+
+	def ciphertext_only(self, sizes, files):
+		texts = [Esafenet.encrypt_file(self.source('C', self.rnd.choice(sizes)), self.key) for i in range(files)]
+		size = sum(len(t) for t in texts)
+		for model in [None] + coa_models.BUILTIN_MODELS:
+			if model is not None and coa_models.numpy is None:
+				continue
+			self.measure("coa", lambda: Esafenet.coa_find_key(texts, model), size,
+				lambda key: key_accuracy(key, self.key), label="model %s, %d files" % (model, files), model=model)
+		if coa_models.numpy is not None:
+			self.measure("solve", lambda: Esafenet.coa_solve_key(texts[0], texts, 'text')[0], size,
+				lambda key: key_accuracy(key, self.key), label="model text, %d files" % files, model='text')
+
+def environment():
+	return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': multiprocessing.cpu_count(),
+		'numpy': xor_engine.numpy.__version__ if xor_engine.numpy is not None else None,
+		'time': time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+"""
+Check that the seed gives the same key and corpora every time: two suites generate a corpus of every kind,
+returns whether their digests match.
+"""
+def check_seed(seed, sizes, files):
+	digests = []
+	for run in range(2):
+		suite = Suite(seed, None)
+		for language in LANGUAGES:
+			for i in range(files):
+				suite.source(language, suite.rnd.choice(sizes))
+		for size in sizes:
+			suite.binary_source(size)
+		digests.append(suite.digest.hexdigest())
+	print "Seed %d: %s (%s)" % (seed, "key and corpora are reproducible" if digests[0] == digests[1] else "key and corpora DIFFER", digests[0])
+	return digests[0] == digests[1]
+
+BENCHMARKS = ['encrypt', 'folders', 'findkey', 'binary', 'text', 'coa']
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="E-Safenet speed and accuracy benchmarks")
+	parser.add_argument('--sizes', type=str, help='Comma separated file sizes, with K, M or G suffix (default 1K,16K,256K,4M)', default="1K,16K,256K,4M")
+	parser.add_argument('--files', type=int, help='Files per corpus for the folder, text and coa benchmarks (default 20)', default=20)
+	parser.add_argument('--jobs', type=int, help='Worker processes for process_parallel (default all cores)', default=None)
+	parser.add_argument('--seed', type=int, help='Seed for the key and corpora (default 1)', default=1)
+	parser.add_argument('--only', type=str, help='Comma separated benchmarks to run, of %s' % BENCHMARKS, default=",".join(BENCHMARKS))
+	parser.add_argument('--outfile', type=str, help='JSON results file (default: print only)', required=False)
+	parser.add_argument('--check-seed', action='store_true', help='Only check that the seed gives the same key and corpora twice')
+	args = parser.parse_args()
+
+	sizes = [parse_size(s) for s in args.sizes.split(",")]
+	#corpora of many files use the smaller sizes only
+	corpus_sizes = [s for s in sizes if s <= 1 << 20] or [min(sizes)]
+	only = args.only.split(",")
+	if args.check_seed:
+		sys.exit(0 if check_seed(args.seed, corpus_sizes, args.files) else 1)
+	workdir = tempfile.mkdtemp(prefix="esafenet-bench-")
+	suite = Suite(args.seed, workdir)
+	try:
+		if 'encrypt' in only:
+			suite.encrypt_decrypt(sizes)
+			if esafenet.NATIVE:
+				suite.compressor_reuse(100 * args.files)
+		if 'folders' in only:
+			suite.folders(corpus_sizes, args.files)
+		if 'findkey' in only:
+			suite.known_plaintext(sizes)
+		if 'binary' in only:
+			suite.binary(sizes)
+		if 'text' in only:
+			suite.text(corpus_sizes, args.files, args.jobs)
+		if 'coa' in only:
+			suite.ciphertext_only(corpus_sizes, args.files)
+	finally:
+		shutil.rmtree(workdir)
+
+	print "Key and corpora: %s" % suite.digest.hexdigest()
+	report = {'environment': environment(), 'seed': args.seed, 'corpus_sha1': suite.digest.hexdigest(), 'sizes': sizes, 'files': args.files, 'results': suite.results}
+	if args.outfile != None:
+		with open(args.outfile, "w") as fh:
+			json.dump(report, fh, indent=1, sort_keys=True)
+		print "Results written to %s" % args.outfile
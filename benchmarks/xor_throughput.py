@@ -0,0 +1,60 @@
+# Throughput benchmark of the E-Safenet XOR engine
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# usage: python benchmarks/xor_throughput.py [size in KB]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import xor_engine
+
+#The byte-by-byte implementation that used to live in Esafenet.__xor_with_key
+def legacy_xor_with_key(text, key):
+	xored = ""
+	for idx, c in enumerate(text):
+		keyb = key[idx % len(key)]
+		keyb = 0 if keyb is None else keyb
+		xored += chr(ord(c) ^ keyb)
+	return xored
+
+def bulk_without_numpy(text, key):
+	numpy = xor_engine.numpy
+	xor_engine.numpy = None
+	try:
+		return xor_engine.xor_with_key(text, key)
+	finally:
+		xor_engine.numpy = numpy
+
+def measure(name, fn, text, key):
+	start = time.time()
+	out = fn(text, key)
+	elapsed = max(time.time() - start, 1e-9)
+	print "%-20s %10.2f MB/s" % (name, len(text) / elapsed / (1024 * 1024))
+	return out
+
+if __name__ == "__main__":
+	size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 1024 * 1024
+	text = os.urandom(size)
+	key = [ord(c) for c in os.urandom(512)]
+	key[3] = None
+
+	print "Xoring %d bytes with a 512 byte key" % size
+	reference = measure("legacy", legacy_xor_with_key, text, key)
+	if xor_engine.numpy is not None:
+		assert measure("bulk (numpy)", xor_engine.xor_with_key, text, key) == reference
+	assert measure("bulk (long int)", bulk_without_numpy, text, key) == reference
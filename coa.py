@@ -0,0 +1,265 @@
+# Ciphertext-only attack on E-Safenet encrypted files
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Every key byte is chosen such that it decrypts as many bytes of its column (the bytes at the same
+# offset in every 512 byte block) as possible to printable characters.
+# Instead of trying all 256 key bytes on every byte of the text, the text is reduced to a histogram
+# of byte values per column first, which is then scored against all key bytes at once.
+#
+# With a scoring model (see coa_models.py), "printable" is replaced by the cost of each plaintext byte
+# under the model. If the model has a bigram table, the key is then refined column by column: each key
+# byte is chosen to minimize the cost of the byte pairs it forms with its neighbouring columns, given
+# the current key bytes of those columns. The byte pairs are counted once, so the refinement does not
+# depend on the size of the corpus.
+#
+# find_key_steps runs the attack step by step, for programs that show its progress (see esafenet_gui.py):
+# the key so far is reported while the files are counted and while it is refined, and the caller can stop at any step.
+import time
+from collections import Counter
+import corpus
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+KEY_LEN = 512
+
+"""
+Returns whether byte value o is a printable plaintext character.
+"""
+def printable(o):
+	return (o >= 32 and o <= 126) or o == 9 or o == 10 or o == 13
+
+#Refinement stops after this many rounds over all columns, or earlier when no key byte changes
+REFINE_ROUNDS = 4
+#Seconds between the intermediate keys reported by find_key_steps
+KEY_INTERVAL = 0.5
+
+#SCORES[c][k] is 1 if ciphertext byte c decrypts to a printable character with key byte k
+SCORES = [[int(printable(c ^ k)) for k in range(256)] for c in range(256)]
+#PRINTABLE_KEYS[c] lists the key bytes that decrypt ciphertext byte c to a printable character
+PRINTABLE_KEYS = [[k for k in range(256) if printable(c ^ k)] for c in range(256)]
+if numpy is not None:
+	SCORES = numpy.array(SCORES, dtype=numpy.int64)
+	#XOR[c][k] = c ^ k, for looking up the plaintext byte of every (ciphertext byte, key byte) at once
+	XOR = numpy.arange(256)[:, None] ^ numpy.arange(256)[None, :]
+
+"""
+Count the byte values in every column of text, from position start on (the header block is skipped by default).
+Returns a 512x256 array: hist[i][c] is the number of times byte c occurs at an offset i (mod 512).
+The text is counted in blocks (a multiple of the key length), which all start in the same column, so the
+memory used does not grow with the size of the text.
+"""
+def column_histogram(text, start=KEY_LEN, block=1 << 20):
+	if numpy is not None:
+		data = numpy.frombuffer(text, dtype=numpy.uint8)
+		hist = numpy.zeros(KEY_LEN * 256, dtype=numpy.int64)
+		#column * 256 for every offset of a block
+		cols = (numpy.arange(max(min(block, len(data) - start), 0), dtype=numpy.int32) + start) % KEY_LEN * 256
+		for first in range(start, len(data), block):
+			chunk = data[first:first + block]
+			hist += numpy.bincount(cols[:len(chunk)] + chunk, minlength=KEY_LEN * 256)
+		return hist.reshape(KEY_LEN, 256)
+
+	hist = [[0] * 256 for i in range(KEY_LEN)]
+	for i in range(KEY_LEN):
+		first = start + (i - start) % KEY_LEN
+		for c, n in Counter(text[first::KEY_LEN]).iteritems():
+			hist[i][ord(c)] = n
+	return hist
+
+"""
+Add the column histograms of all texts together.
+"""
+def corpus_histogram(texts, start=KEY_LEN):
+	total = None
+	for text in texts:
+		hist = column_histogram(text, start)
+		if total is None:
+			total = hist
+		elif numpy is not None:
+			total += hist
+		else:
+			total = [[a + b for a, b in zip(r1, r2)] for r1, r2 in zip(total, hist)]
+	return total
+
+"""
+Score all 256 key bytes for every column of the histogram.
+Returns a 512x256 array: scores[i][k] is the number of bytes in column i that key byte k decrypts to printable characters,
+or, with a model, minus the cost of the plaintext of column i under key byte k.
+"""
+def column_scores(hist, model=None):
+	if model is not None:
+		scores = numpy.zeros((KEY_LEN, 256), dtype=numpy.int64)
+		for r in range(model.period):
+			scores[r::model.period] = -numpy.dot(hist[r::model.period], model.unigram[r][XOR].astype(numpy.int64))
+		return scores
+	if numpy is not None:
+		return numpy.dot(hist, SCORES)
+	scores = []
+	for row in hist:
+		col = [0] * 256
+		for c, n in enumerate(row):
+			if n:
+				for k in PRINTABLE_KEYS[c]:
+					col[k] += n
+		scores.append(col)
+	return scores
+
+"""
+Pick the best scoring key byte for every column (the lowest one on ties).
+"""
+def best_key(scores):
+	if numpy is not None:
+		return [int(k) for k in numpy.argmax(scores, 1)]
+	return [row.index(max(row)) for row in scores]
+
+"""
+Count the pairs of consecutive bytes in texts, from position start on, by the column of their first byte.
+Returns a list of 512 (first bytes, second bytes, counts) arrays, one entry per distinct pair.
+"""
+def pair_histogram(texts, start=KEY_LEN, block=1 << 24):
+	codes = [numpy.zeros(0, dtype=numpy.int32)]
+	counts = [numpy.zeros(0, dtype=numpy.int64)]
+	pending = 0
+	for text in texts:
+		data = numpy.frombuffer(text, dtype=numpy.uint8)
+		for first in range(start, len(data) - 1, block):
+			c1 = data[first:first + block].astype(numpy.int32)
+			c2 = data[first + 1:first + block + 1]
+			c1 = c1[:len(c2)]
+			cols = (numpy.arange(len(c1), dtype=numpy.int32) + first) % KEY_LEN
+			new_codes, new_counts = numpy.unique((cols * 256 + c1) * 256 + c2, return_counts=True)
+			codes.append(new_codes)
+			counts.append(new_counts)
+			pending += len(new_codes)
+			if pending > block:
+				codes, counts = merge_pairs(codes, counts)
+				pending = 0
+	codes, counts = merge_pairs(codes, counts)
+	codes, counts = codes[0], counts[0]
+
+	bounds = numpy.searchsorted(codes, numpy.arange(KEY_LEN + 1) * 65536)
+	pairs = []
+	for i in range(KEY_LEN):
+		c = codes[bounds[i]:bounds[i + 1]]
+		pairs.append(((c >> 8) & 0xff, c & 0xff, counts[bounds[i]:bounds[i + 1]]))
+	return pairs
+
+def merge_pairs(codes, counts):
+	merged, inverse = numpy.unique(numpy.concatenate(codes), return_inverse=True)
+	return [merged], [numpy.bincount(inverse, numpy.concatenate(counts)).astype(numpy.int64)]
+
+"""
+Cost of the byte pairs of column i (first bytes in column i) for all 256 key bytes of one of both columns.
+With key_first None, the key byte of the first column varies and the second column uses key_second, and vice versa.
+"""
+def pair_costs(table, pairs, key_first, key_second, block=4096):
+	c1, c2, n = pairs
+	costs = numpy.zeros(256, dtype=numpy.int64)
+	for first in range(0, len(n), block):
+		b1, b2, bn = c1[first:first + block], c2[first:first + block], n[first:first + block]
+		if key_first is None:
+			costs += numpy.dot(bn, table[XOR[b1], (b2 ^ key_second)[:, None]].astype(numpy.int64))
+		else:
+			costs += numpy.dot(bn, table[(b1 ^ key_first)[:, None], XOR[b2]].astype(numpy.int64))
+	return costs
+
+"""
+Refine the key with the bigram table of the model: every key byte is replaced by the one for which the pairs
+with the previous and next column cost least. Repeated until no key byte changes, or for at most rounds rounds.
+"""
+def refine_key(key, pairs, model, rounds=REFINE_ROUNDS):
+	key = list(key)
+	for step in refine_steps(key, pairs, model, rounds):
+		pass
+	return key
+
+"""
+Like refine_key, refining key in place. Yields (round, column) after every column.
+"""
+def refine_steps(key, pairs, model, rounds=REFINE_ROUNDS):
+	for r in range(rounds):
+		changed = 0
+		for i in range(KEY_LEN):
+			prev, following = (i - 1) % KEY_LEN, (i + 1) % KEY_LEN
+			costs = pair_costs(model.bigram_for(prev), pairs[prev], key[prev], None)
+			costs += pair_costs(model.bigram_for(i), pairs[i], None, key[following])
+			if costs.any():
+				best = int(numpy.argmin(costs))
+				if costs[best] < costs[key[i]]:
+					key[i] = best
+					changed += 1
+			yield r, i
+		if not changed:
+			break
+
+"""
+Ciphertext-only attack: find the key that maximizes the printable plaintext in texts, or that minimizes the
+cost of the plaintext under model (a ScoringModel, see coa_models.py).
+texts are whole encrypted files, the header block of each is skipped.
+"""
+def find_key(texts, start=KEY_LEN, model=None, rounds=REFINE_ROUNDS):
+	key = [None] * KEY_LEN
+	for stage, done, total, step_key in find_key_steps(texts, start, model, rounds):
+		if step_key is not None:
+			key = step_key
+	return key
+
+"""
+Run find_key step by step. Yields (stage, done, total, key) after every step:
+  ("histogram", files counted, number of files, key) while the files are counted,
+  ("pairs", 0, 1, None) before the byte pairs are counted, when the key is refined with the model,
+  ("refine", columns refined, columns to refine at most, key) while the key is refined.
+key is the best key so far at most every KEY_INTERVAL seconds and at the last step of a stage, and None at the other steps.
+The last key yielded is the result of find_key. Stop iterating to cancel the attack.
+"""
+def find_key_steps(texts, start=KEY_LEN, model=None, rounds=REFINE_ROUNDS):
+	total = None
+	last = time.time()
+	for i, text in enumerate(texts):
+		hist = column_histogram(text, start)
+		if total is None:
+			total = hist
+		elif numpy is not None:
+			total += hist
+		else:
+			total = [[a + b for a, b in zip(r1, r2)] for r1, r2 in zip(total, hist)]
+		key = None
+		if i == len(texts) - 1 or time.time() - last > KEY_INTERVAL:
+			key = best_key(column_scores(total, model))
+			last = time.time()
+		yield "histogram", i + 1, len(texts), key
+	if total is None or model is None or model.bigram is None or not rounds:
+		return
+	yield "pairs", 0, 1, None
+	refined = list(key)
+	pairs = pair_histogram(texts, start)
+	for r, i in refine_steps(refined, pairs, model, rounds):
+		key = None
+		if i == KEY_LEN - 1 or time.time() - last > KEY_INTERVAL:
+			key = list(refined)
+			last = time.time()
+		yield "refine", r * KEY_LEN + i + 1, rounds * KEY_LEN, key
+
+"""
+The encrypted files to attack: a single file, or all files below a folder, as a corpus (see corpus.py).
+The files are memory-mapped when they are used, files that are not E-Safenet files and duplicates are left out.
+"""
+def read_texts(path):
+	return corpus.Corpus(corpus.list_files(path))
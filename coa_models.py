@@ -0,0 +1,245 @@
+# Plaintext scoring models for the E-Safenet ciphertext-only attack
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# A model gives the cost of each plaintext byte (unigram) and of each byte following another byte (bigram),
+# as -log2 of its probability in 1/8 bits, capped at 255, so that a table fits in one byte per entry.
+# The tables may depend on the column modulo a period, e.g. UTF-16LE text has a period of 2.
+#
+# The built-in models are stored in the models folder, run this script to regenerate them:
+#   python coa_models.py
+# or to train a model on a folder of plaintext files:
+#   python coa_models.py --train plaintext_folder --period 1 --outfile model.esm
+import argparse
+import os
+import struct
+import sys
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+MODEL_SUFFIX = ".esm"
+BUILTIN_MODELS = ['printable', 'text', 'utf16le', 'ole']
+
+#magic, period, has bigram table
+HEADER = struct.Struct("<4sBB2x")
+MAGIC = "ESM1"
+SCALE = 8
+MAX_COST = 255
+
+class ModelException(Exception):
+	pass
+
+"""
+Convert a table of probabilities to costs.
+"""
+def to_costs(p):
+	p = numpy.asarray(p, dtype=numpy.float64)
+	with numpy.errstate(divide='ignore'):
+		cost = numpy.round(-numpy.log2(p) * SCALE)
+	return numpy.clip(cost, 0, MAX_COST).astype(numpy.uint8)
+
+"""
+A plaintext scoring model.
+unigram is a (period, 256) cost table, bigram a (period, 256, 256) cost table or None.
+Row r of the tables is used for the columns i with i % period == r (for the bigram: the column of the first byte).
+"""
+class ScoringModel:
+	def __init__(self, name, unigram, bigram=None):
+		self.name = name
+		self.unigram = numpy.asarray(unigram, dtype=numpy.uint8).reshape(-1, 256)
+		self.period = len(self.unigram)
+		self.bigram = None if bigram is None else numpy.asarray(bigram, dtype=numpy.uint8).reshape(self.period, 256, 256)
+
+	def save(self, path):
+		with open(path, "wb") as fh:
+			fh.write(HEADER.pack(MAGIC, self.period, self.bigram is not None))
+			fh.write(self.unigram.tostring())
+			if self.bigram is not None:
+				fh.write(self.bigram.tostring())
+
+	@staticmethod
+	def load(path):
+		with open(path, "rb") as fh:
+			data = fh.read()
+		if len(data) < HEADER.size:
+			raise ModelException("%s is not a scoring model" % path)
+		magic, period, has_bigram = HEADER.unpack_from(data)
+		size = HEADER.size + period * 256 * (1 + 256 * has_bigram)
+		if magic != MAGIC or period == 0 or len(data) != size:
+			raise ModelException("%s is not a scoring model" % path)
+		tables = numpy.frombuffer(data, dtype=numpy.uint8, offset=HEADER.size)
+		unigram = tables[:period * 256]
+		bigram = tables[period * 256:] if has_bigram else None
+		return ScoringModel(os.path.basename(path).rsplit(".", 1)[0], unigram, bigram)
+
+	"""
+	The cost table of column i for the byte pairs starting in it.
+	"""
+	def bigram_for(self, i):
+		return self.bigram[i % self.period]
+
+"""
+Load a model by name (one of BUILTIN_MODELS) or from a model file.
+"""
+def get_model(name):
+	if numpy is None:
+		raise ModelException("Scoring models need numpy")
+	if name in BUILTIN_MODELS:
+		return ScoringModel.load(os.path.join(MODELS_DIR, name + MODEL_SUFFIX))
+	return ScoringModel.load(name)
+
+def printable_bytes():
+	return [9, 10, 13] + range(32, 127)
+
+"""
+Printable characters only, each one equally likely. The same objective as the original attack.
+"""
+def printable_model():
+	p = numpy.zeros(256)
+	p[printable_bytes()] = 1.0 / len(printable_bytes())
+	return ScoringModel("printable", to_costs(p))
+
+#Approximate relative frequencies of characters in English prose and source code
+TEXT_FREQUENCIES = {' ': 15.0, 'e': 9.0, 't': 6.5, 'a': 6.0, 'o': 5.8, 'i': 5.5, 'n': 5.5, 's': 5.0, 'r': 5.0,
+	'h': 4.0, 'l': 3.3, 'd': 3.0, 'c': 2.5, 'u': 2.3, 'm': 2.0, 'f': 1.8, 'p': 1.6, 'g': 1.5, 'w': 1.5,
+	'y': 1.4, 'b': 1.1, 'v': 0.8, 'k': 0.6, 'x': 0.15, 'j': 0.12, 'q': 0.08, 'z': 0.07,
+	'\n': 2.0, '\r': 0.5, '\t': 0.5, '.': 0.8, ',': 0.8, ';': 0.5, '(': 0.5, ')': 0.5, '{': 0.2, '}': 0.2,
+	'=': 0.4, '"': 0.3, "'": 0.2, '-': 0.3, '_': 0.3, '/': 0.2, '*': 0.2, ':': 0.2}
+
+#Character classes of the text bigram model: the probability of a byte depends on the class of the byte before it
+CLASSES = ['lower', 'upper', 'digit', 'space', 'newline', 'tab', 'punct', 'other']
+#CLASS_TRANSITIONS[a][b]: relative probability of a byte of class b following a byte of class a
+CLASS_TRANSITIONS = [
+	[70, 2, 0.5, 18, 2, 0.2, 8, 0.01],	#lower
+	[60, 20, 1, 8, 1, 0.2, 5, 0.01],	#upper
+	[3, 1, 60, 10, 3, 0.5, 20, 0.01],	#digit
+	[50, 10, 4, 20, 2, 1, 12, 0.01],	#space
+	[20, 5, 1, 30, 15, 25, 5, 0.01],	#newline
+	[30, 5, 1, 5, 5, 50, 5, 0.01],	#tab
+	[20, 5, 5, 35, 15, 2, 18, 0.01],	#punct
+	[1, 1, 1, 1, 1, 1, 1, 1],	#other
+]
+
+def byte_class(b):
+	c = chr(b)
+	if c.islower():
+		return 0
+	if c.isupper():
+		return 1
+	if c.isdigit():
+		return 2
+	if c == ' ':
+		return 3
+	if c in '\r\n':
+		return 4
+	if c == '\t':
+		return 5
+	if 33 <= b <= 126:
+		return 6
+	return 7
+
+def text_unigram():
+	p = numpy.zeros(256) + 1e-6
+	p[printable_bytes()] = 0.1
+	for c, f in TEXT_FREQUENCIES.items():
+		p[ord(c)] = f
+		if c.islower():
+			p[ord(c.upper())] = f / 10
+	p[ord('0'):ord('9') + 1] = 0.5
+	return p / p.sum()
+
+"""
+English text and source code: character frequencies, and a bigram over character classes.
+"""
+def text_model():
+	p = text_unigram()
+	classes = numpy.array([byte_class(b) for b in range(256)])
+	class_p = numpy.array([p[classes == c].sum() for c in range(len(CLASSES))])
+	within = p / class_p[classes]
+	transitions = numpy.array(CLASS_TRANSITIONS, dtype=numpy.float64)
+	transitions /= transitions.sum(1)[:, None]
+	bigram = transitions[classes][:, classes] * within[None, :]
+	return ScoringModel("text", to_costs(p), to_costs(bigram))
+
+"""
+UTF-16LE text: text characters in the even columns, (mostly) zero bytes in the odd columns.
+"""
+def utf16le_model():
+	low = text_unigram()
+	high = numpy.zeros(256) + 1e-4
+	high[0] = 1.0
+	high /= high.sum()
+	bigram = numpy.array([numpy.tile(high, (256, 1)), numpy.tile(low, (256, 1))])
+	return ScoringModel("utf16le", to_costs([low, high]), to_costs(bigram))
+
+"""
+Office/OLE compound documents: many zero bytes (padding, high bytes of integers) and 0xff bytes (free
+sector markers), small values, some text, and long runs of the same byte.
+"""
+def ole_model():
+	p = numpy.zeros(256) + 0.1
+	p[printable_bytes()] = 0.3
+	p[1:16] = 1.0
+	p[0] = 30.0
+	p[0xff] = 10.0
+	p[0xfe] = 1.0
+	p /= p.sum()
+	bigram = 0.5 * numpy.tile(p, (256, 1)) + 0.5 * numpy.eye(256)
+	return ScoringModel("ole", to_costs(p), to_costs(bigram))
+
+"""
+Build a model from plaintext files, with add-one smoothing.
+"""
+def train_model(name, texts, period=1):
+	counts = numpy.ones((period, 256))
+	pairs = numpy.ones((period, 256, 256))
+	for text in texts:
+		data = numpy.frombuffer(text, dtype=numpy.uint8)
+		cols = numpy.arange(len(data)) % period
+		counts += numpy.bincount(cols * 256 + data, minlength=period * 256).reshape(period, 256)
+		pairs += numpy.bincount((cols[:-1] * 256 + data[:-1]) * 256 + data[1:], minlength=period * 65536).reshape(period, 256, 256)
+	return ScoringModel(name, to_costs(counts / counts.sum(1)[:, None]), to_costs(pairs / pairs.sum(2)[:, :, None]))
+
+def build_builtin_models():
+	for model in [printable_model(), text_model(), utf16le_model(), ole_model()]:
+		model.save(os.path.join(MODELS_DIR, model.name + MODEL_SUFFIX))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Build scoring models for the E-Safenet ciphertext-only attack")
+	parser.add_argument('--train', type=str, help='Folder of plaintext files to train a model on (default: regenerate the built-in models)', required=False)
+	parser.add_argument('--period', type=int, help='Period of the model in bytes (default 1)', required=False, default=1)
+	parser.add_argument('--outfile', type=str, help='Model file to write', required=False)
+	args = parser.parse_args()
+
+	if args.train == None:
+		build_builtin_models()
+		print "Built-in models written to %s" % MODELS_DIR
+	else:
+		if args.outfile == None:
+			parser.print_usage()
+			print "error: outfile is required for training a model"
+			sys.exit(1)
+		texts = []
+		for root, dirs, files in os.walk(args.train):
+			for f in files:
+				with open(os.path.join(root, f), "rb") as fh:
+					texts.append(fh.read())
+		train_model(os.path.basename(args.outfile), texts, args.period).save(args.outfile)
+		print "Model trained on %d files written to %s" % (len(texts), args.outfile)
@@ -0,0 +1,203 @@
+# Checksum-constrained ciphertext-only attack on E-Safenet encrypted files
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Replaces the CPLEX model (cplex_coa.mod): choose the key with the best total score (see coa.py), such that
+# the plaintext bytes 512-1023 of a file add up to the checksum in its header.
+# Every key byte decrypts exactly one of those bytes, and the key bytes are independent apart from this
+# single sum constraint, so:
+#  1. A Lagrangian relaxation of the constraint is solved by bisection on the multiplier. For a given
+#     multiplier every key byte is chosen on its own, and the relaxation gives an upper bound on the score.
+#  2. Starting from the solution of the relaxation, a dynamic program over the deviation from the checksum
+#     picks the best combination of the top candidates of every column that hits the checksum exactly.
+# If the score found equals the bound, the key is optimal.
+#
+# The key bytes under the last 3 bytes of the compressed first block are fixed as well: an LZO stream
+# always ends with the same 3 bytes.
+import struct
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+KEY_LEN = 512
+LZO_EOF = "\x11\x00\x00"
+#Candidates per column, and the largest deviation from the checksum, of the dynamic program (doubled when no key is found)
+CANDIDATES = 32
+WINDOW = 4096
+MAX_ATTEMPTS = 3
+
+class SolverException(Exception):
+	pass
+
+"""
+Read the constraint from the header of an encrypted file.
+Returns (checksum, the ciphertext bytes whose plaintext must add up to the checksum).
+"""
+def header_constraint(text):
+	if len(text) < 512:
+		raise SolverException("File is too short (%d bytes) to contain an E-Safenet header" % len(text))
+	checksum = struct.unpack('<I', text[8:12])[0] & 0xffffff
+	return checksum, bytearray(text[512:1024])
+
+"""
+Key bytes that follow from the end of the compressed first block.
+Returns a dictionary of key index to key byte.
+"""
+def fixed_key_bytes(text):
+	padding_end, compressed_len = struct.unpack('<hh', text[4:8])
+	if compressed_len < len(LZO_EOF) or padding_end + compressed_len != 512:
+		return {}
+	fixed = {}
+	for j in range(compressed_len - len(LZO_EOF), compressed_len):
+		fixed[j] = ord(text[padding_end + j]) ^ ord(LZO_EOF[j - compressed_len + len(LZO_EOF)])
+	return fixed
+
+"""
+For a Lagrange multiplier lam, the best plaintext value of every constrained column, and the value of the dual function.
+values[i][v] is the score of plaintext value v in column i.
+"""
+def relaxation(values, checksum, lam):
+	reduced = values - lam * numpy.arange(256)[None, :]
+	choice = numpy.argmax(reduced, 1)
+	return choice, reduced.max(1).sum() + lam * checksum
+
+"""
+Bisection on the Lagrange multiplier, for the multiplier at which the relaxed choice adds up to the checksum.
+Returns (the relaxed choices just above and just below the checksum, the lowest upper bound on the score seen).
+"""
+def bisect_multiplier(values, checksum, spread, iterations=60):
+	low, high = -spread, spread
+	above, dual = relaxation(values, checksum, low)
+	below, bound = relaxation(values, checksum, high)
+	bound = min(bound, dual)
+	for it in range(iterations):
+		lam = (low + high) / 2
+		choice, dual = relaxation(values, checksum, lam)
+		bound = min(bound, dual)
+		total = choice.sum()
+		if total == checksum:
+			return choice, choice, bound
+		if total > checksum:
+			low, above = lam, choice
+		else:
+			high, below = lam, choice
+	return above, below, bound
+
+"""
+Both relaxed choices are (close to) optimal at the multiplier found, so columns can be switched from one to the
+other without losing much. Start from the choice below the checksum and switch columns until the sum is
+as close to the checksum as it gets.
+"""
+def mix_choices(above, below, checksum):
+	base = below.copy()
+	total = int(base.sum())
+	for i in numpy.nonzero(above != below)[0]:
+		step = int(above[i]) - int(base[i])
+		if abs(checksum - total - step) < abs(checksum - total):
+			base[i] = above[i]
+			total += step
+	return base
+
+"""
+Dynamic program over the deviation from the checksum. Every column may take one of its candidate values.
+Returns the chosen value of every column, or None when no combination within the window adds up to the checksum.
+"""
+def fit_checksum(values, checksum, base, candidates, window):
+	n = len(values)
+	target = checksum - int(base.sum())
+	if abs(target) > window:
+		return None
+	size = 2 * window + 1
+	NONE = numpy.iinfo(numpy.int64).min // 2
+	best = numpy.zeros(size, dtype=numpy.int64) + NONE
+	best[window] = 0
+	back = numpy.zeros((n, size), dtype=numpy.uint8)
+	for i in range(n):
+		new = numpy.zeros(size, dtype=numpy.int64) + NONE
+		for c, v in enumerate(candidates[i]):
+			d = int(v) - int(base[i])
+			src = best[max(0, -d):size - max(0, d)] + values[i][v]
+			dst = new[max(0, d):size - max(0, -d)]
+			better = src > dst
+			dst[better] = src[better]
+			back[i][max(0, d):size - max(0, -d)][better] = c
+		new[new < NONE // 2] = NONE
+		best = new
+	if best[window + target] == NONE:
+		return None
+
+	chosen = [0] * n
+	pos = window + target
+	for i in range(n - 1, -1, -1):
+		v = candidates[i][back[i][pos]]
+		chosen[i] = v
+		pos -= int(v) - int(base[i])
+	return chosen
+
+"""
+Find the key with the highest total score, for which the plaintext of the constrained ciphertext bytes adds up to checksum.
+scores is a 512x256 array of the score of every key byte in every column (see coa.column_scores),
+fixed a dictionary of key bytes that are known.
+Returns (key, score, upper bound on the score).
+"""
+def solve(scores, cipher, checksum, fixed={}, candidates=CANDIDATES, window=WINDOW):
+	if numpy is None:
+		raise SolverException("The solver needs numpy")
+	scores = numpy.array(scores, dtype=numpy.int64)
+	spread = float(scores.max() - scores.min()) + 1
+	for i, k in fixed.items():
+		keep = scores[i][k]
+		scores[i] = scores.min() - 256 * spread
+		scores[i][k] = keep
+
+	key = [int(k) for k in numpy.argmax(scores, 1)]
+	n = len(cipher)
+	if n == 0:
+		total = int(scores.max(1).sum())
+		return key, total, total
+	if checksum > 255 * n:
+		raise SolverException("The checksum %d cannot be reached with %d plaintext bytes" % (checksum, n))
+
+	#values[i][v]: score of plaintext value v in constrained column i
+	xor = numpy.arange(256)[None, :] ^ numpy.array(cipher, dtype=numpy.int64)[:, None]
+	values = scores[numpy.arange(n)[:, None], xor]
+	above, below, bound = bisect_multiplier(values, checksum, spread)
+	bound += scores[n:].max(1).sum()
+	base = mix_choices(above, below, checksum)
+
+	#the candidates of a column are its values closest in score to its base value, and the values in between the two choices
+	order = numpy.argsort(values[numpy.arange(n), base][:, None] - values, 1, kind='mergesort')
+	for attempt in range(MAX_ATTEMPTS):
+		top = order[:, :min(candidates, 256)].copy()
+		top[:, 0] = above
+		top[:, 1] = below
+		for i, k in fixed.items():
+			if i < n:
+				top[i] = k ^ cipher[i]
+		chosen = fit_checksum(values, checksum, base, top, window)
+		if chosen is not None:
+			break
+		candidates *= 2
+		window *= 2
+	else:
+		raise SolverException("No key found that matches the checksum %d" % checksum)
+
+	for i, v in enumerate(chosen):
+		key[i] = int(v) ^ cipher[i]
+	total = int(sum(scores[i][k] for i, k in enumerate(key)))
+	return key, total, int(numpy.floor(bound + 1e-6))
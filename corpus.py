@@ -0,0 +1,146 @@
+# Memory-efficient corpus of E-Safenet encrypted files, shared by the attacks and the GUI
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# A Corpus only holds the paths and sizes of its files:
+#   - a file is memory-mapped when it is used, and unmapped when the caller drops it, so the files are never
+#     copied into memory and the page cache is shared with other processes working on the same files,
+#   - files that are too small to have data after the header block, or do not start with the E-Safenet magic,
+#     are left out when they are added,
+#   - identical files are kept once: a file is only hashed when another file in the corpus has the same size.
+# A Corpus is a sequence of memory-mapped files, so it can be passed to the attacks instead of a list of texts.
+# body() and bodies() give the ciphertext after the 512 byte header block, which starts at key offset 0.
+import hashlib
+import mmap
+import os
+import scanner
+
+#Files need data after the 512 byte header block to be of use to the attacks
+MIN_SIZE = 513
+HEADER_LEN = 512
+
+"""
+The files to attack: a single file, or all files below a folder.
+"""
+def list_files(path):
+	if not os.path.isdir(path):
+		return [path]
+	paths = []
+	for root, dirs, files in os.walk(path):
+		for f in files:
+			paths.append(os.path.join(root, f))
+	return paths
+
+"""
+Map the file at path read-only. Empty files (which cannot be mapped) are returned as an empty string.
+"""
+def map_file(path):
+	with open(path, "rb") as fh:
+		if os.fstat(fh.fileno()).st_size == 0:
+			return ""
+		return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+def file_hash(path):
+	return hashlib.sha1(map_file(path)).hexdigest()
+
+class Corpus:
+	"""
+	A corpus of the files at paths. Files smaller than min_size are left out, and with check_magic the files without
+	the E-Safenet magic, with dedup the files identical to a file in the corpus. skipped counts the files left out.
+	"""
+	def __init__(self, paths=(), min_size=MIN_SIZE, check_magic=True, dedup=True):
+		self.min_size = min_size
+		self.check_magic = check_magic
+		self.dedup = dedup
+		self.paths = []
+		self.sizes = []
+		self.skipped = {'small': 0, 'magic': 0, 'duplicate': 0, 'unreadable': 0}
+		#size: indexes of the files of that size, and the hashes of those that were compared (by index)
+		self.by_size = {}
+		self.hashes = {}
+		self.add(paths)
+
+	"""
+	Add the files at paths, leaving out the files as described for the constructor. Returns the number of files added.
+	"""
+	def add(self, paths):
+		added = 0
+		for path in paths:
+			try:
+				size = os.path.getsize(path)
+				if size < self.min_size:
+					self.skipped['small'] += 1
+					continue
+				if self.check_magic:
+					with open(path, "rb") as fh:
+						magic = fh.read(len(scanner.MAGIC))
+					if magic != scanner.MAGIC:
+						self.skipped['magic'] += 1
+						continue
+				if self.dedup and self.is_duplicate(path, size):
+					self.skipped['duplicate'] += 1
+					continue
+			except (IOError, OSError):
+				self.skipped['unreadable'] += 1
+				continue
+			self.by_size.setdefault(size, []).append(len(self.paths))
+			self.paths.append(path)
+			self.sizes.append(size)
+			added += 1
+		return added
+
+	"""
+	Whether the file at path is identical to a file in the corpus. The hash of a file that is not is kept
+	under the index it is added at.
+	"""
+	def is_duplicate(self, path, size):
+		same = self.by_size.get(size)
+		if not same:
+			return False
+		digest = file_hash(path)
+		for i in same:
+			if i not in self.hashes:
+				self.hashes[i] = file_hash(self.paths[i])
+			if self.hashes[i] == digest:
+				return True
+		self.hashes[len(self.paths)] = digest
+		return False
+
+	def __len__(self):
+		return len(self.paths)
+
+	"""
+	File i, memory-mapped.
+	"""
+	def __getitem__(self, i):
+		return map_file(self.paths[i])
+
+	def __iter__(self):
+		for path in self.paths:
+			yield map_file(path)
+
+	"""
+	The ciphertext of file i after the header block, as a buffer on the mapped file.
+	"""
+	def body(self, i):
+		return buffer(self[i], HEADER_LEN)
+
+	def bodies(self):
+		for text in self:
+			yield buffer(text, HEADER_LEN)
+
+	def total_size(self):
+		return sum(self.sizes)
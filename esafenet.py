@@ -24,8 +24,105 @@ import random
 import cPickle
 import collections
 import argparse
+import archive
+import itertools
+import multiprocessing
 import partial_c
 import partial_binary
+import in_place
+import scanner
+import coa
+import coa_models
+import coa_solver
+import corpus
+import key_state
+import manifest
+import pipeline
+import stats
+import threading
+import xor_engine
+
+#Chunk size for streaming encryption/decryption, a multiple of the 512 byte key length
+STREAM_CHUNK_SIZE = 512 * 2048
+
+"""
+Read exactly size bytes from a file-like object, unless the end of the file is reached first.
+"""
+def read_fully(fh, size):
+	data = fh.read(size)
+	while len(data) < size:
+		more = fh.read(size - len(data))
+		if not more:
+			break
+		data += more
+	return data
+
+#simplelzo1x 1.3 and later encrypt and decrypt whole files in a single call, without the GIL
+NATIVE = hasattr(simplelzo1x, "Compressor")
+#Per thread: the key string of the last key used, and an LZO compressor (its calls are serialized, so one per thread)
+native_state = threading.local()
+
+"""
+The key as a string for the native calls, cached for the next file with the same key.
+"""
+def native_key(key):
+	key = list(key)
+	cached = getattr(native_state, "key", None)
+	if cached is None or cached[0] != key:
+		cached = native_state.key = (key, xor_engine.key_string(key))
+	return cached[1]
+
+def native_compressor():
+	compressor = getattr(native_state, "compressor", None)
+	if compressor is None:
+		compressor = native_state.compressor = simplelzo1x.Compressor()
+	return compressor
+
+#Key and stream options used by process_folder_file, set once per worker process
+folder_worker_key = None
+folder_worker_options = {}
+#None, or whether to hash the files, when the files are recorded in a manifest
+folder_worker_record = None
+
+def init_folder_worker(key, options, stats_enabled=False, record=None):
+	global folder_worker_key, folder_worker_options, folder_worker_record
+	folder_worker_key = key
+	folder_worker_options = options
+	folder_worker_record = record
+	if stats_enabled:
+		#the totals inherited from the parent process are not this worker's
+		stats.reset()
+		stats.enable()
+
+"""
+Encrypt or decrypt a single file for Esafenet.process_folder.
+task is an (action, source, destination) tuple. Returns (source, error, statistics, record), where error is None on success,
+statistics are the totals of this file (see stats.take) for the parent process, and record is None, or
+(key used, hash of the source file, bytes written) for the manifest of the run.
+"""
+def process_folder_file(task):
+	action, src, dst = task
+	stats.count("files")
+	key = folder_worker_key
+	digest = None
+	try:
+		with open(src, "rb") as fl, open(dst, "wb") as fh:
+			if folder_worker_record is not None and isinstance(key, KeyRing):
+				#the manifest records which key of the ring was used
+				key = Esafenet.select_key(read_fully(fl, 1024), key)
+				fl.seek(0)
+			infh = manifest.HashingReader(fl) if folder_worker_record else fl
+			written = getattr(Esafenet, action + "_stream")(infh, fh, key, **folder_worker_options)
+			if folder_worker_record:
+				digest = infh.hexdigest()
+	except Exception as e:
+		if os.path.exists(dst):
+			os.remove(dst) #do not leave partial output behind
+		stats.count("failures")
+		if isinstance(e, simplelzo1x.error):
+			stats.count("lzo_errors")
+		return (src, "%s: %s" % (e.__class__.__name__, e), stats.take(), None)
+	return (src, None, stats.take(), (key, digest, written) if folder_worker_record is not None else None)
 
 """
 Esafenet: A class to perform encryption/decryption operations on E-Safenet files.
@@ -41,127 +138,500 @@ class Esafenet:
 
 	"""
 	Encrypt a given text, with the key given.
+	With simplelzo1x 1.3 or later, the file is encrypted in a single native call (see NATIVE).
 	Returns the encrypted text.
 	"""
 	@staticmethod
 	def encrypt_file(text, key):
-		
-		compressed_bytes = simplelzo1x.compress(text[:512])
+		if NATIVE:
+			with stats.stage("native_encrypt"):
+				data = native_compressor().encrypt(text, native_key(key))
+			stats.count("native_encrypt_bytes", len(text))
+			return data
+		header = Esafenet.__encrypt_header(text[:512], text[512:1024], key)
+		with stats.stage("xor"):
+			body = xor_engine.xor_with_key(text[512:], key)
+		stats.count("xor_bytes", len(text) - 512)
+		return header + body
+
+	"""
+	Build the encrypted first 512 byte block: the E-Safenet header, followed by the encrypted, compressed first block.
+	second_block holds the (up to) 512 bytes following the first block, which are used for the checksum.
+	"""
+	@staticmethod
+	def __encrypt_header(first_block, second_block, key):
+		with stats.stage("lzo_compress"):
+			compressed_bytes = native_compressor().compress(first_block) if NATIVE else simplelzo1x.compress(first_block)
+		stats.count("lzo_compress_bytes", len(first_block))
 		compressed_len = len(compressed_bytes)
 		#3 bytes act as checksum for the second 512 bytes of the message. The 1 is static.
-		checksum = sum(ord(a) for a in text[512:1024]) | 1 << 24
+		checksum = sum(ord(a) for a in second_block) | 1 << 24
 		padding_end = (512 - compressed_len)
 
 		header = "b" + '\x14' + "#" + "e" + struct.pack('<h', padding_end) + struct.pack('<h', compressed_len) + struct.pack('<I',checksum) + "E-SafeNet" + '\x00\x00\x00' + "LOCK" + '\x00'*(padding_end-28)
 
-		return header + Esafenet.__xor_with_key(compressed_bytes, key) + Esafenet.__xor_with_key(text[512:], key)
-	
+		return header + xor_engine.xor_with_key(compressed_bytes, key)
+
+	"""
+	Encrypt the file-like object infh to outfh, with the key given.
+	Only the first 1024 bytes and a single chunk are held in memory, so files of any size can be encrypted.
+	Returns the number of bytes written.
+	"""
+	@staticmethod
+	def encrypt_stream(infh, outfh, key, chunk_size=STREAM_CHUNK_SIZE):
+		return Esafenet.__write_chunks(Esafenet.encrypt_chunks(infh, key, chunk_size), outfh)
+
+	"""
+	Encrypt the file-like object infh with the key given, yielding the encrypted file in chunks, the 512 byte header block first.
+	"""
+	@staticmethod
+	def encrypt_chunks(infh, key, chunk_size=STREAM_CHUNK_SIZE):
+		key, blocks, chunk = Esafenet.__begin_encrypt(infh, key)
+		yield Esafenet.__encrypt_header(blocks[0], blocks[1], key)
+		#the remainder of the file starts at key offset 0
+		for data in Esafenet.__xor_chunks(infh, key, chunk, chunk_size):
+			yield data
+
+	"""
+	Xor the body of a file with the key: chunk, followed by the rest of infh.
+	"""
+	@staticmethod
+	def __xor_chunks(infh, key, chunk, chunk_size):
+		#keep track of the position for short reads
+		pos = 0
+		while chunk:
+			with stats.stage("xor"):
+				data = xor_engine.xor_with_key(chunk, key, pos)
+			yield data
+			pos += len(chunk)
+			with stats.stage("read"):
+				chunk = infh.read(chunk_size)
+		stats.count("read_bytes", pos)
+		stats.count("xor_bytes", pos)
+
+	"""
+	Write chunks to outfh, returning the number of bytes written.
+	"""
+	@staticmethod
+	def __write_chunks(chunks, outfh):
+		written = 0
+		for data in chunks:
+			with stats.stage("write"):
+				outfh.write(data)
+			written += len(data)
+		stats.count("write_bytes", written)
+		return written
+
+	"""
+	Read the first 1024 bytes of a file to encrypt, for encrypt_stream and pipeline_folder.
+	Returns (key, (first block, second block), first chunk of the remainder), the second block being that chunk.
+	"""
+	@staticmethod
+	def __begin_encrypt(infh, key):
+		with stats.stage("read"):
+			first_block = read_fully(infh, 512)
+			second_block = read_fully(infh, 512)
+		stats.count("read_bytes", len(first_block))
+		return key, (first_block, second_block), second_block
+
 	"""
 	Encrypt an entire folder at the given location, with the key and store it on disk
+	With io_threads, the folder is processed by pipeline_folder instead of jobs worker processes.
+	With a manifest (see open_manifest), the files that are up to date in it are skipped.
+	folder and dest_folder can be tar or zip archives as well, see process_archive.
+	Returns a list of (file, error) tuples for the files that could not be encrypted.
 	"""
 	@staticmethod
-	def encrypt_folder(folder, key, dest_folder):
-		if not os.path.isdir(dest_folder):
-			os.mkdir(dest_folder)
-	
-		for root, dirs, files in os.walk(folder):
-			nr = root.replace(folder, "")
-			if nr:
-				nr += "/"
-			for d in dirs:
-				if not os.path.isdir(dest_folder + "/" + nr + d):
-					os.mkdir(dest_folder + "/" + nr + d)
-			for f in files:
-				fl = open(root + "/" +  f, "rb")
-				enc = Esafenet.encrypt_file(fl.read(), key)
-				with open(dest_folder + "/" + nr + f, "wb") as fh:
-					fh.write(enc)
+	def encrypt_folder(folder, key, dest_folder, jobs=1, io_threads=None, manifest_db=None):
+		if archive.is_archive(folder) or archive.archive_mode(dest_folder):
+			return Esafenet.process_archive("encrypt", folder, key, dest_folder)
+		if io_threads:
+			return Esafenet.pipeline_folder("encrypt", folder, key, dest_folder, jobs, io_threads, manifest_db=manifest_db)
+		return Esafenet.process_folder("encrypt", folder, key, dest_folder, jobs, manifest_db=manifest_db)
 			
 
 
 	"""
 	Decrypt a given text, with the key.
+	With verify, a wrong key raises an EsafenetException (see check_key) instead of producing garbage.
+	With simplelzo1x 1.3 or later, the file is decrypted in a single native call (see NATIVE).
 	Returns the file's text
 	"""
 	@staticmethod
-	def decrypt_file(text, key):
+	def decrypt_file(text, key, verify=False):
+		key = Esafenet.select_key(text, key)
+		if verify and not Esafenet.check_key(text, key):
+			raise EsafenetException("Wrong key: the header checksum does not match")
+		if NATIVE and len(text) >= 512:
+			with stats.stage("native_decrypt"):
+				plain = simplelzo1x.decrypt(text, native_key(key))
+			stats.count("native_decrypt_bytes", len(text))
+			return plain
 		plain = ""
 		offset = ord(text[4]) | ord(text[5]) << 8  #offset is stored in these 2 bytes in little-endian order.
-		decr_header = Esafenet.__xor_with_key(text[offset:512], key)
-#		plain_header = ""
-		plain_header = simplelzo1x.decompress(decr_header)
-		plain_file = Esafenet.__xor_with_key(text[512:], key)
+		decr_header = xor_engine.xor_with_key(text[offset:512], key)
+		with stats.stage("lzo_decompress"):
+#			plain_header = ""
+			plain_header = simplelzo1x.decompress(decr_header)
+		with stats.stage("xor"):
+			plain_file = xor_engine.xor_with_key(text[512:], key)
+		stats.count("lzo_decompress_bytes", len(plain_header))
+		stats.count("xor_bytes", len(plain_file))
 		
 		return plain_header + plain_file
 
 	"""
-	Xor any text with a given key.
-	The key should be an array of byte values.
-	An Esafenet key has a length of 512 bytes.
+	Decrypt the encrypted file in src, any bytes-like object (str, bytearray, buffer, mmap or memoryview), into the
+	writable buffer dst (a bytearray, mmap or memoryview) of at least len(src) bytes, without intermediate copies of the file:
+	only the header block is copied, the rest is xored straight from src into dst.
+	With verify, a wrong key raises an EsafenetException before anything is written.
+	Returns (number of bytes written, header fields as returned by scanner.parse_header).
 	"""
 	@staticmethod
-	def __xor_with_key(text, key):
-		xored = ""
-		for idx, c in enumerate(text):
-			keyb = key[idx % len(key)]
-			keyb = 0 if keyb is None else keyb
-			xored += chr(ord(c) ^ keyb)
-		return xored
-			
+	def decrypt_into(src, dst, key, verify=False):
+		head = xor_engine.as_string(src[:1024])
+		if len(head) < 512:
+			raise EsafenetException("File is too short (%d bytes) to contain an E-Safenet header" % len(head))
+		key = Esafenet.select_key(head, key)
+		if verify and not Esafenet.check_key(head, key):
+			raise EsafenetException("Wrong key: the header checksum does not match")
+		plain_header = Esafenet.__decrypt_header(head[:512], key)
+		size = len(plain_header) + len(src) - 512
+		if len(dst) < size:
+			raise EsafenetException("Output buffer too small: %d bytes needed" % size)
+		dst[:len(plain_header)] = plain_header
+		with stats.stage("xor"):
+			xor_engine.xor_into(src, dst, key, 0, 512, len(plain_header))
+		stats.count("xor_bytes", len(src) - 512)
+		return size, scanner.parse_header(head[:512])
+
+	"""
+	Encrypt the file in src, any bytes-like object, into the writable buffer dst of at least max(len(src), 512) bytes,
+	like decrypt_into: only the first 1024 bytes are copied to build the header block.
+	Returns (number of bytes written, header fields as returned by scanner.parse_header).
+	"""
+	@staticmethod
+	def encrypt_into(src, dst, key):
+		head = xor_engine.as_string(src[:1024])
+		header = Esafenet.__encrypt_header(head[:512], head[512:], key)
+		size = len(header) + max(len(src) - 512, 0)
+		if len(dst) < size:
+			raise EsafenetException("Output buffer too small: %d bytes needed" % size)
+		dst[:len(header)] = header
+		with stats.stage("xor"):
+			xor_engine.xor_into(src, dst, key, 0, 512, len(header))
+		stats.count("xor_bytes", max(len(src) - 512, 0))
+		return size, scanner.parse_header(header)
+
+	"""
+	Decrypt the file-like object infh to outfh, with the key.
+	Only the 512 byte header block and a single chunk are held in memory, so files of any size can be decrypted.
+	With verify, a wrong key raises an EsafenetException before anything is written.
+	Returns the number of bytes written.
+	"""
+	@staticmethod
+	def decrypt_stream(infh, outfh, key, chunk_size=STREAM_CHUNK_SIZE, verify=False):
+		return Esafenet.__write_chunks(Esafenet.decrypt_chunks(infh, key, chunk_size, verify), outfh)
+
+	"""
+	Decrypt the file-like object infh with the key, yielding the plaintext in chunks, the decompressed first block first.
+	Errors in the header block (a short file, a wrong key with verify, a corrupt first block) are raised before anything is yielded.
+	"""
+	@staticmethod
+	def decrypt_chunks(infh, key, chunk_size=STREAM_CHUNK_SIZE, verify=False):
+		key, header, chunk = Esafenet.__begin_decrypt(infh, key, chunk_size, verify)
+		yield Esafenet.__decrypt_header(header, key)
+		for data in Esafenet.__xor_chunks(infh, key, chunk, chunk_size):
+			yield data
+
+	"""
+	Read the 512 byte header block and the first chunk of an encrypted file, for decrypt_stream and pipeline_folder.
+	The key is selected from a KeyRing and verified on them.
+	Returns (key, header block, first chunk).
+	"""
+	@staticmethod
+	def __begin_decrypt(infh, key, chunk_size=STREAM_CHUNK_SIZE, verify=False):
+		with stats.stage("read"):
+			header = read_fully(infh, 512)
+		if len(header) < 512:
+			raise EsafenetException("File is too short (%d bytes) to contain an E-Safenet header" % len(header))
+		with stats.stage("read"):
+			chunk = read_fully(infh, chunk_size)
+		stats.count("read_bytes", len(header))
+		key = Esafenet.select_key(header + chunk[:512], key)
+		if verify and not Esafenet.check_key(header + chunk[:512], key):
+			raise EsafenetException("Wrong key: the header checksum does not match")
+		return key, header, chunk
+
+	"""
+	Decompress the header block of an encrypted file, returning the first (up to) 512 bytes of plaintext.
+	"""
+	@staticmethod
+	def __decrypt_header(header, key):
+		offset = ord(header[4]) | ord(header[5]) << 8  #offset is stored in these 2 bytes in little-endian order.
+		with stats.stage("lzo_decompress"):
+			plain_header = simplelzo1x.decompress(xor_engine.xor_with_key(header[offset:512], key))
+		stats.count("lzo_decompress_bytes", len(plain_header))
+		return plain_header
+
+	"""
+	Check whether key is the key of an encrypted file, given (at least) the first 1024 bytes of the file.
+	The plaintext bytes 512-1024 must add up to the checksum in the header, and the first block must decompress.
+	This only touches the first 1024 bytes, so wrong keys are rejected in microseconds.
+	"""
+	@staticmethod
+	def check_key(text, key):
+		if len(text) < 512:
+			return False
+		checksum = struct.unpack('<I', text[8:12])[0] & 0xffffff
+		if sum(bytearray(xor_engine.xor_with_key(text[512:1024], key))) != checksum:
+			return False
+		offset = ord(text[4]) | ord(text[5]) << 8
+		try:
+			simplelzo1x.decompress(xor_engine.xor_with_key(text[offset:512], key))
+		except simplelzo1x.error:
+			return False
+		return True
+
+	"""
+	Resolve the key to use for an encrypted file, given (at least) the first 1024 bytes of the file.
+	key is either a key, which is returned as-is, or a KeyRing to pick the key from.
+	"""
+	@staticmethod
+	def select_key(text, key):
+		if not isinstance(key, KeyRing):
+			return key
+		selected = key.select(text)
+		if selected is None:
+			raise EsafenetException("No key in the key ring matches this file")
+		return selected[1]
+
+	"""
+	Like select_key, for the file at path. For in-place decryption the original header block is read from the journal.
+	"""
+	@staticmethod
+	def select_file_key(path, key):
+		if not isinstance(key, KeyRing):
+			return key
+		with open(path, "rb") as fh:
+			text = read_fully(fh, 1024)
+		if os.path.exists(in_place.journal_name(path)):
+			with open(in_place.journal_name(path), "rb") as fh:
+				fh.seek(in_place.STATE.size)
+				text = fh.read(512) + text[512:]
+		return Esafenet.select_key(text, key)
+
 	"""
 	Decrypt all files in an entire folder at the given location, with the key and store it on disk
+	With verify, files for which the key is wrong are reported as failures.
+	With io_threads, the folder is processed by pipeline_folder instead of jobs worker processes.
+	With a manifest (see open_manifest), the files that are up to date in it are skipped.
+	folder and dest_folder can be tar or zip archives as well, see process_archive.
+	Returns a list of (file, error) tuples for the files that could not be decrypted.
 	"""
 	@staticmethod
-	def decrypt_folder(folder, key, dest_folder):
-		if not os.path.isdir(dest_folder):
-			os.mkdir(dest_folder)
-	
+	def decrypt_folder(folder, key, dest_folder, jobs=1, verify=False, io_threads=None, manifest_db=None):
+		if archive.is_archive(folder) or archive.archive_mode(dest_folder):
+			return Esafenet.process_archive("decrypt", folder, key, dest_folder, {'verify': verify})
+		if io_threads:
+			return Esafenet.pipeline_folder("decrypt", folder, key, dest_folder, jobs, io_threads, {'verify': verify}, manifest_db=manifest_db)
+		return Esafenet.process_folder("decrypt", folder, key, dest_folder, jobs, {'verify': verify}, manifest_db)
+
+	"""
+	Decrypt a file on disk in place, without writing a second copy.
+	If an earlier in-place decryption of the file was interrupted, it is resumed from its journal.
+	Returns the size of the decrypted file.
+	"""
+	@staticmethod
+	def decrypt_in_place(path, key):
+		return in_place.decrypt_in_place(path, Esafenet.select_file_key(path, key))
+
+	"""
+	Undo an interrupted in-place decryption, restoring the encrypted file.
+	"""
+	@staticmethod
+	def rollback_in_place(path, key):
+		in_place.rollback_in_place(path, Esafenet.select_file_key(path, key))
+
+	"""
+	Decrypt all files in a folder in place. With rollback, the interrupted in-place decryptions in the folder are undone instead.
+	Returns a list of (file, error) tuples for the files that could not be processed.
+	"""
+	@staticmethod
+	def decrypt_folder_in_place(folder, key, rollback=False):
+		failures = []
 		for root, dirs, files in os.walk(folder):
-			nr = root.replace(folder, "")
-			if nr:
-				nr += "/"
-			for d in dirs:
-				if not os.path.isdir(dest_folder + "/" + nr + d):
-					os.mkdir(dest_folder + "/" + nr + d)
 			for f in files:
-				fl = open(root + "/" + f, "rb")
-				dec = Esafenet.decrypt_file(fl.read(), key)
-				with open(dest_folder + "/" + nr + f, "wb") as fh:
-					fh.write(dec)
+				path = root + "/" + f
+				if f.endswith(in_place.JOURNAL_SUFFIX):
+					continue
+				try:
+					if not rollback:
+						Esafenet.decrypt_in_place(path, key)
+					elif os.path.exists(in_place.journal_name(path)):
+						Esafenet.rollback_in_place(path, key)
+				except Exception as e:
+					failures.append((path, "%s: %s" % (e.__class__.__name__, e)))
+		return failures
+
+	"""
+	Encrypt or decrypt (action) all files in a folder, using jobs worker processes (0 uses all cores).
+	options are passed on to encrypt_stream or decrypt_stream.
+	The destination directory tree is created up front. A file that fails does not stop the run,
+	instead its error is returned in a list of (file, error) tuples.
+	With a manifest, files that are up to date in it are skipped, and the outcome of the others is recorded.
+	"""
+	@staticmethod
+	def process_folder(action, folder, key, dest_folder, jobs=1, options={}, manifest_db=None):
+		if not os.path.isdir(dest_folder):
+			os.mkdir(dest_folder)
+
+		tasks = []
+		with stats.stage("walk"):
+			for root, dirs, files in os.walk(folder):
+				nr = root.replace(folder, "")
+				if nr:
+					nr += "/"
+				for d in dirs:
+					if not os.path.isdir(dest_folder + "/" + nr + d):
+						os.mkdir(dest_folder + "/" + nr + d)
+				for f in files:
+					if manifest_db is not None and manifest_db.up_to_date(root + "/" + f, dest_folder + "/" + nr + f):
+						stats.count("skipped")
+						continue
+					tasks.append((action, root + "/" + f, dest_folder + "/" + nr + f))
 
+		record = manifest_db.use_hash if manifest_db is not None else None
+		if jobs == 1:
+			init_folder_worker(key, options, record=record)
+			results = itertools.imap(process_folder_file, tasks)
+		else:
+			pool = multiprocessing.Pool(jobs or None, init_folder_worker, (key, options, stats.enabled, record))
+			results = pool.imap_unordered(process_folder_file, tasks, 16)
+
+		failures = []
+		for src, err, file_stats, info in results:
+			stats.merge(file_stats)
+			if err is not None:
+				failures.append((src, err))
+			if manifest_db is not None:
+				manifest_db.record(src, err, *(info or ()))
+		if jobs != 1:
+			pool.close()
+			pool.join()
+		return failures
+
+	"""
+	Encrypt or decrypt (action) all files in a folder like process_folder, in a pipeline of threads (see pipeline.py)
+	for network storage: io_threads files are read and written at the same time, while threads (0 uses all cores)
+	do the xor and LZO work. At most max_buffers chunks are held in memory.
+	"""
+	@staticmethod
+	def pipeline_folder(action, folder, key, dest_folder, threads=1, io_threads=8, options={}, chunk_size=STREAM_CHUNK_SIZE, max_buffers=64, manifest_db=None):
+		if action == "encrypt":
+			steps = (Esafenet.__begin_encrypt,
+				lambda blocks, key: Esafenet.__encrypt_header(blocks[0], blocks[1], key))
+		else:
+			steps = (lambda infh, key: Esafenet.__begin_decrypt(infh, key, chunk_size, **options), Esafenet.__decrypt_header)
+		return pipeline.process_folder(folder, dest_folder, key, steps, xor_engine.xor_with_key,
+			threads or multiprocessing.cpu_count(), io_threads, chunk_size, max_buffers, manifest_db)
+
+	"""
+	Encrypt or decrypt (action) the files in source to dest, where source is a folder or an existing tar or zip archive,
+	and dest a folder, or a new archive named like one (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tbz2).
+	The files are streamed through the engine one at a time, in a single process, without temporary files.
+	A file that fails before any of it is written is left out and returned in the list of (file, error) tuples,
+	like a file that fails to be written to a folder. A failure while writing to an archive ends the run.
+	"""
+	@staticmethod
+	def process_archive(action, source, key, dest, options={}):
+		files = archive.archive_files(source) if archive.is_archive(source) else archive.folder_files(source)
+		writer = archive.ArchiveWriter(dest) if archive.archive_mode(dest) else archive.FolderWriter(dest)
+		failures = []
+		try:
+			for name, fh, size, mtime in files:
+				stats.count("files")
+				error = None
+				try:
+					chunks = getattr(Esafenet, action + "_chunks")(fh, key, **options)
+					first = next(chunks)
+				except Exception as e:
+					error = e
+				if error is None:
+					#the header block is followed by the rest of the file from byte 512 on, xored
+					output_size = len(first) + max(size - 512, 0)
+					try:
+						writer.add(name, output_size, mtime, itertools.chain([first], chunks))
+						stats.count("write_bytes", output_size)
+					except Exception as e:
+						if not isinstance(writer, archive.FolderWriter):
+							raise
+						error = e
+				if error is not None:
+					stats.count("failures")
+					if isinstance(error, simplelzo1x.error):
+						stats.count("lzo_errors")
+					failures.append((name, "%s: %s" % (error.__class__.__name__, error)))
+		finally:
+			writer.close()
+		return failures
+
+	"""
+	Open the manifest at path for resumable, incremental runs of encrypt_folder or decrypt_folder (action) with key,
+	a key or a KeyRing. With use_hash, files are hashed, so files that were only touched are skipped as well.
+	"""
+	@staticmethod
+	def open_manifest(path, action, key, use_hash=False):
+		keys = [k for name, k in key.keys] if isinstance(key, KeyRing) else [key]
+		return manifest.Manifest(path, action, [manifest.key_id(k) for k in keys], use_hash)
+
+
+	"""
+	Scan all files below a folder for E-Safenet headers, reading only their first 512 bytes.
+	The results are stored in a SQLite index, unchanged files are skipped on later scans.
+	Returns (number of files, number of (re)scanned files, number of encrypted files).
+	"""
+	@staticmethod
+	def scan_folder(folder, index_path, jobs=16):
+		return scanner.scan_folder(folder, index_path, jobs)
 
 	"""
 	Perform a known-plaintext attack. Obtain a key given an encrypted file and its plaintext counterpart.
 	The file should be at least 1.5 KB for this to work (1536 bytes)
 	Returns the found key
+
+	Bytes 512-1536 of the plaintext are used (the first 512 bytes are compressed, so unusable).
+	Since the key repeats every key_len bytes, at the right alignment c[i] ^ c[i+key_len] equals p[i] ^ p[i+key_len]
+	for the ciphertext c and plaintext p, independent of the key. The alignment is therefore found with a single
+	substring search in the xor of the ciphertext with itself, shifted by key_len.
 	"""
 	@staticmethod
 	def find_key(crypted_text, plain_text, key_len=512):
-		if len(plain_text) < 512:
+		if len(plain_text) < 1536:
 			raise EsafenetException("This plaintext attack requires at least 1536 bytes (1.5 KB) of data to work")
-		
-		text = plain_text[512:1024] #uses this part of the text for plaintext finding. (The first 512 bytes will be compressed, so unusable)
-		compare = plain_text[1024:1536] #todo: better comparison (min 512 bytes)
-		start = 0
-
-		while(start < len(crypted_text)):
-			j = 0
-			plain = ""
-			key = []
-			for i in range(start, len(crypted_text)):
-				if(j < key_len):
-					key.append(ord(text[j]) ^ ord(crypted_text[i]))
-				else:
-					plain = plain + chr((ord(crypted_text[i]) ^ key[j % key_len]))
-				j += 1
-
-			if compare in plain: 
-				key = collections.deque(key)
-				key.rotate(start % key_len) #The key is always returned for offset 0
-				return key
-			else:
-				start += 1
-		return None #if we haven't returned by the end of the file, no key was found
+
+		text = plain_text[512:512+key_len] #the key is derived from this part
+		known = plain_text[512:1536]
+		pattern = xor_engine.xor_strings(known[key_len:], known[:-key_len])
+		#buffers, so a mapped file is not copied
+		shifted = xor_engine.xor_strings(buffer(crypted_text, key_len), buffer(crypted_text, 0, max(len(crypted_text) - key_len, 0)))
+
+		start = shifted.find(pattern)
+		if start < 0:
+			return None #no alignment in the file matches the plaintext, no key was found
+
+		key = [ord(p) ^ ord(c) for p, c in zip(text, crypted_text[start:start+key_len])]
+		key = collections.deque(key)
+		key.rotate(start % key_len) #The key is always returned for offset 0
+		return key
+
+	"""
+	Perform the known-plaintext attack on several (encrypted, plaintext) pairs at once.
+	Returns a list with the found key (or None) for each pair.
+	"""
+	@staticmethod
+	def find_keys(pairs, key_len=512):
+		return [Esafenet.find_key(crypted_text, plain_text, key_len) for crypted_text, plain_text in pairs]
 
 	"""
 	Stores a given key on disk
@@ -189,8 +659,125 @@ class Esafenet:
 		return partial_binary.find_binary_key(text)
 
 	@staticmethod
-	def text_find_key(infolder, language, outfile):
-		partial_c.process_parallel(infolder, language, outfile)
+	def text_find_key(infolder, language, outfile, jobs=None):
+		partial_c.process_parallel(infolder, language, outfile, jobs or None)
+
+	"""
+	Ciphertext-only attack: find the key that decrypts as much of the encrypted texts as possible to printable characters,
+	or to likely plaintext under a scoring model (a built-in model name or a model file, see coa_models.py).
+	"""
+	@staticmethod
+	def coa_find_key(texts, model=None):
+		if model is not None:
+			model = coa_models.get_model(model)
+		return coa.find_key(texts, model=model)
+
+	"""
+	Run attack ('known', 'binary', 'text' or 'coa') on the files at paths that the key state (see key_state.py) has not
+	processed yet (in their current version), and add the evidence to state; the evidence of an earlier version of a
+	file is taken out first. The known-plaintext attack takes the plaintext of each file from plain_paths,
+	the text attack the keywords of language.
+	Returns the number of files that were processed.
+	"""
+	@staticmethod
+	def update_key_state(state, attack, paths, language=None, plain_paths={}, jobs=None):
+		new = state.new_files(attack, paths)
+		if attack == 'text':
+			for path, evidence in partial_c.file_keyword_counts(new, language, jobs).items():
+				state.set_file(attack, path, evidence)
+			return len(new)
+		for path in new:
+			#mapped, the attacks read the file in place
+			text = corpus.map_file(path)
+			if attack == 'coa':
+				evidence = key_state.sparse(coa.column_histogram(text))
+			elif attack == 'binary':
+				evidence = key_state.key_evidence(partial_binary.binary_key_bytes(text))
+			elif attack == 'known':
+				key = Esafenet.find_key(text, corpus.map_file(plain_paths[path]))
+				evidence = key_state.key_evidence(list(key) if key is not None else [])
+			#the evidence of an earlier version of the file is replaced
+			state.set_file(attack, path, evidence)
+		return len(new)
+
+	"""
+	Ciphertext-only attack under the checksum in the header of text: the key with the best score (as with coa_find_key)
+	for which the plaintext bytes 512-1024 of text add up to the checksum.
+	texts are the files that are scored, by default only text itself.
+	Returns (key, score, upper bound on the score), the key is optimal when the score equals the bound.
+	"""
+	@staticmethod
+	def coa_solve_key(text, texts=None, model=None):
+		checksum, cipher = coa_solver.header_constraint(text)
+		if model is not None:
+			model = coa_models.get_model(model)
+		scores = coa.column_scores(coa.corpus_histogram(texts or [text]), model)
+		return coa_solver.solve(scores, cipher, checksum, coa_solver.fixed_key_bytes(text))
+
+"""
+KeyRing: a collection of named keys, from which the right key for each encrypted file is picked.
+
+The compressed first block always ends with the LZO end-of-stream marker (0x11 0x00 0x00), and ends at
+offset 512. Xoring the last 3 bytes of the header block with the marker therefore gives 3 key bytes, at a
+position that only depends on the compressed length in the header. Every key is indexed on these 3 bytes
+for every possible compressed length, so selecting a key is a single dictionary lookup, followed by
+Esafenet.check_key on the (normally single) candidate. The cost does not grow with the number of keys.
+"""
+class KeyRing:
+	LZO_EOF = "\x11\x00\x00"
+
+	def __init__(self):
+		self.keys = []
+		self.index = collections.defaultdict(list)
+
+	def add(self, name, key):
+		key = xor_engine.normalize_key(key)
+		self.keys.append((name, key))
+		fingerprints = "".join(chr(b) for b in key)
+		for compressed_len in range(3, 512 - 28 + 1):
+			self.index[(compressed_len, fingerprints[compressed_len-3:compressed_len])].append(len(self.keys) - 1)
+
+	"""
+	Load a key ring from a folder of pickled keys (named after their files), or from a single pickle file
+	holding a key, a list of keys or a dictionary of named keys.
+	"""
+	@staticmethod
+	def load(path):
+		ring = KeyRing()
+		if os.path.isdir(path):
+			for f in sorted(os.listdir(path)):
+				with open(os.path.join(path, f), "rb") as fh:
+					ring.add(f, cPickle.load(fh))
+			return ring
+
+		with open(path, "rb") as fh:
+			keys = cPickle.load(fh)
+		if isinstance(keys, dict):
+			for name in sorted(keys):
+				ring.add(name, keys[name])
+		elif len(keys) and isinstance(keys[0], (list, tuple, collections.deque)):
+			for i, key in enumerate(keys):
+				ring.add("key%d" % i, key)
+		else:
+			ring.add(os.path.basename(path), keys)
+		return ring
+
+	"""
+	Pick the key for an encrypted file, given (at least) the first 1024 bytes of the file.
+	Returns a (name, key) tuple, or None if no key in the ring matches.
+	"""
+	def select(self, text):
+		if len(text) < 512:
+			return None
+		compressed_len = struct.unpack('<h', text[6:8])[0]
+		fingerprint = xor_engine.xor_strings(text[509:512], KeyRing.LZO_EOF)
+		for i in self.index.get((compressed_len, fingerprint), []):
+			if Esafenet.check_key(text, self.keys[i][1]):
+				return self.keys[i]
+		return None
+
+	def __len__(self):
+		return len(self.keys)
 
 #We even have our own exception!
 class EsafenetException(Exception):
@@ -198,18 +785,53 @@ class EsafenetException(Exception):
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="Esafenet encryption/decryption/key generation")
-	parser.add_argument('a', metavar='action', type=str, help='Action to perform', choices = ['encrypt', 'decrypt', 'encrypt_folder', 'decrypt_folder', 'keygen', 'findkey', 'pattern_decrypt'])
+	parser.add_argument('a', metavar='action', type=str, help='Action to perform', choices = ['encrypt', 'decrypt', 'encrypt_folder', 'decrypt_folder', 'decrypt_in_place', 'scan', 'keygen', 'findkey', 'pattern_decrypt', 'coa', 'solve', 'key_state'])
 	parser.add_argument('--infile', type=argparse.FileType('rb'), help='Input file', required=False)
 	parser.add_argument('--key', type=argparse.FileType('rb'), help='Key file', required=False)
+	parser.add_argument('--keyring', type=str, help='Folder of key files, or a file with several keys, to pick the right key for each file from (decrypt actions)', required=False)
 	parser.add_argument('--outfile', type=argparse.FileType('wb'), help='Output file', required=False, default=sys.stdout)
-	parser.add_argument('--infolder', type=str, help='Input folder', required=False)
-	parser.add_argument('--outfolder', type=str, help='Output folder', required=False)
+	parser.add_argument('--infolder', type=str, help='Input folder, or a tar or zip archive for encrypt_folder and decrypt_folder', required=False)
+	parser.add_argument('--outfolder', type=str, help='Output folder, or a new archive (.zip, .tar, .tar.gz, .tgz, .tar.bz2, .tbz2) for encrypt_folder and decrypt_folder', required=False)
 	parser.add_argument('--comp_file', type=argparse.FileType('rb'), help='Plaintext comparison file used by findkey', required=False)
 	parser.add_argument('--type', metavar='pattern_type', type=str, help='Type for pattern decrypt (binary or text)', choices = ['binary', 'text'], required=False)
 	parser.add_argument('--language', metavar='text_pattern_language', type=str, help='Language for text pattern decrypt (C, PHP or CS)', choices = ['C', 'PHP', 'CS'], required=False)
+	parser.add_argument('--verify', action='store_true', help='Check the key against the header checksum before decrypting a file')
+	parser.add_argument('--rollback', action='store_true', help='Undo interrupted runs of decrypt_in_place instead of resuming them')
+	parser.add_argument('--jobs', type=int, help='Number of worker processes for the folder actions (default 1, 0 uses all cores) and the text pattern_decrypt (default all cores), or I/O threads for scan (default 16)', required=False)
+	parser.add_argument('--io-threads', type=int, help='Pipelined encrypt_folder and decrypt_folder for network storage: read and write this many files at a time in threads, overlapping I/O with the decryption (done in --jobs threads)', required=False)
+	parser.add_argument('--manifest', type=str, help='Manifest database for encrypt_folder and decrypt_folder: files that are up to date in it are skipped, so interrupted runs resume and re-runs only process changed files', required=False)
+	parser.add_argument('--hash', action='store_true', help='Record the SHA-1 hash of every file in the manifest, so files that were only touched are skipped too')
+	parser.add_argument('--index', type=str, help='Index database used by scan', required=False)
+	parser.add_argument('--state', type=str, help='Key state file: findkey, pattern_decrypt and coa only process the files that are new to it, and write the best key given all evidence in it (key_state prints it)', required=False)
+	parser.add_argument('--stats', metavar='STATS_FILE', type=str, nargs='?', const='-', help='Time the stages of the work and count bytes, files and errors; the JSON report is written to STATS_FILE, or printed to stderr', required=False)
+	parser.add_argument('--model', type=str, help='Scoring model for coa and solve: one of %s, or a model file (default: count printable characters)' % coa_models.BUILTIN_MODELS, required=False)
 	
 	args = parser.parse_args()
+	if args.stats != None:
+		stats.enable()
+
+	def load_decryption_key():
+		if args.keyring != None:
+			return KeyRing.load(args.keyring)
+		return cPickle.load(args.key)
+
+	def update_key_state(attack, paths, **options):
+		state = key_state.KeyState.load(args.state)
+		new = Esafenet.update_key_state(state, attack, paths, **options)
+		state.save(args.state)
+		state.close()
+		key, confidence = state.best_key()
+		cPickle.dump(key, args.outfile)
+		if args.outfile.name != '<stdout>':
+			known = [c for b, c in zip(key, confidence) if b is not None]
+			print "Key state: %d new file(s) added to %s, %d key bytes known (mean confidence %.2f), key written to %s" % (new,
+				args.state, len(known), sum(known) / max(len(known), 1), args.outfile.name)
 	
+	def open_manifest(action, key):
+		if args.manifest == None:
+			return None
+		return Esafenet.open_manifest(args.manifest, action, key, args.hash)
+
 	if args.a == 'keygen':
 		if args.outfile == None:
 			parser.print_usage()
@@ -232,13 +854,12 @@ if __name__ == "__main__":
 			parser.print_usage()
 			print "error: keyfile is required for the encrypt action"
 			sys.exit(1)
-		f = Esafenet.encrypt_file(args.infile.read(), cPickle.load(args.key))
-		args.outfile.write(f)
+		written = Esafenet.encrypt_stream(args.infile, args.outfile, cPickle.load(args.key))
 		if args.outfile.name != '<stdout>':
-			print "Encryption: %d bytes written to %s" % (len(f), args.outfile.name)
+			print "Encryption: %d bytes written to %s" % (written, args.outfile.name)
 
 	elif args.a == 'encrypt_folder':
-		if args.infolder == None or not os.path.isdir(args.infolder):
+		if args.infolder == None or not (os.path.isdir(args.infolder) or archive.is_archive(args.infolder)):
 			parser.print_usage()
 			print "error: infolder is required for the encrypt_folder action"
 			sys.exit(1)
@@ -252,9 +873,21 @@ if __name__ == "__main__":
 			parser.print_usage()
 			print "error: keyfile is required for the encrypt_folder action"
 			sys.exit(1)
-		Esafenet.encrypt_folder(args.infolder, cPickle.load(args.key), args.outfolder)
+		key = cPickle.load(args.key)
+		folder_manifest = open_manifest('encrypt', key)
+		try:
+			failures = Esafenet.encrypt_folder(args.infolder, key, args.outfolder, 1 if args.jobs == None else args.jobs, args.io_threads, folder_manifest)
+		finally:
+			if folder_manifest != None:
+				folder_manifest.close()
 
 		print "Folder encryption: all written to %s" % args.outfolder
+		if folder_manifest != None:
+			print "%d file(s) up to date in %s, skipped" % (folder_manifest.skipped, args.manifest)
+		if failures:
+			print "%d file(s) could not be processed:" % len(failures)
+			for name, err in failures:
+				print "  %s: %s" % (name, err)
 		
 	
 	elif args.a == 'decrypt':
@@ -268,18 +901,17 @@ if __name__ == "__main__":
 			print "error: outfile is required for the decrypt action"
 			sys.exit(1)
 		
-		if args.key == None:
+		if args.key == None and args.keyring == None:
 			parser.print_usage()
-			print "error: keyfile is required for the decrypt action"
+			print "error: keyfile or keyring is required for the decrypt action"
 			sys.exit(1)
-		f = Esafenet.decrypt_file(args.infile.read(), cPickle.load(args.key))
-		args.outfile.write(f)
+		written = Esafenet.decrypt_stream(args.infile, args.outfile, load_decryption_key(), verify=args.verify)
 		if args.outfile.name != '<stdout>':
-			print "Decryption: %d bytes written to %s" % (len(f), args.outfile.name)
+			print "Decryption: %d bytes written to %s" % (written, args.outfile.name)
 	
 	
 	elif args.a == 'decrypt_folder':
-		if args.infolder == None or not os.path.isdir(args.infolder):
+		if args.infolder == None or not (os.path.isdir(args.infolder) or archive.is_archive(args.infolder)):
 			parser.print_usage()
 			print "error: infolder is required for the decrypt_folder action"
 			sys.exit(1)
@@ -289,13 +921,69 @@ if __name__ == "__main__":
 			print "error: outfolder is required for the decrypt_folder action"
 			sys.exit(1)
 		
-		if args.key == None:
+		if args.key == None and args.keyring == None:
 			parser.print_usage()
-			print "error: keyfile is required for the decrypt_folder action"
+			print "error: keyfile or keyring is required for the decrypt_folder action"
 			sys.exit(1)
-		Esafenet.decrypt_folder(args.infolder, cPickle.load(args.key), args.outfolder)
+		key = load_decryption_key()
+		folder_manifest = open_manifest('decrypt', key)
+		try:
+			failures = Esafenet.decrypt_folder(args.infolder, key, args.outfolder, 1 if args.jobs == None else args.jobs, args.verify, args.io_threads, folder_manifest)
+		finally:
+			if folder_manifest != None:
+				folder_manifest.close()
 
 		print "Folder decryption: all written to %s" % args.outfolder
+		if folder_manifest != None:
+			print "%d file(s) up to date in %s, skipped" % (folder_manifest.skipped, args.manifest)
+		if failures:
+			print "%d file(s) could not be processed:" % len(failures)
+			for name, err in failures:
+				print "  %s: %s" % (name, err)
+
+	elif args.a == 'decrypt_in_place':
+		if args.infile == None and (args.infolder == None or not os.path.isdir(args.infolder)):
+			parser.print_usage()
+			print "error: infile or infolder is required for the decrypt_in_place action"
+			sys.exit(1)
+
+		if args.key == None and args.keyring == None:
+			parser.print_usage()
+			print "error: keyfile or keyring is required for the decrypt_in_place action"
+			sys.exit(1)
+		key = load_decryption_key()
+
+		if args.infile != None:
+			args.infile.close()
+			if args.rollback:
+				Esafenet.rollback_in_place(args.infile.name, key)
+				print "Rollback: %s restored" % args.infile.name
+			else:
+				size = Esafenet.decrypt_in_place(args.infile.name, key)
+				print "Decryption: %s decrypted in place (%d bytes)" % (args.infile.name, size)
+		else:
+			failures = Esafenet.decrypt_folder_in_place(args.infolder, key, args.rollback)
+			if args.rollback:
+				print "Folder rollback: interrupted decryptions in %s restored" % args.infolder
+			else:
+				print "Folder decryption: %s decrypted in place" % args.infolder
+			if failures:
+				print "%d file(s) could not be processed:" % len(failures)
+				for name, err in failures:
+					print "  %s: %s" % (name, err)
+
+	elif args.a == 'scan':
+		if args.infolder == None or not os.path.isdir(args.infolder):
+			parser.print_usage()
+			print "error: infolder is required for the scan action"
+			sys.exit(1)
+
+		if args.index == None:
+			parser.print_usage()
+			print "error: index is required for the scan action"
+			sys.exit(1)
+		total, scanned, encrypted = Esafenet.scan_folder(args.infolder, args.index, args.jobs or 16)
+		print "Scan: %d files, %d (re)scanned, %d E-Safenet encrypted, index written to %s" % (total, scanned, encrypted, args.index)
 
 	elif args.a == 'findkey':
 
@@ -313,6 +1001,9 @@ if __name__ == "__main__":
 			parser.print_usage()
 			print "error: outfile is required for the decrypt_folder action"
 			sys.exit(1)
+		if args.state != None:
+			update_key_state('known', [args.infile.name], plain_paths={args.infile.name: args.comp_file.name})
+			sys.exit(0)
 		key = Esafenet.find_key(args.infile.read(), args.comp_file.read())
 		
 		cPickle.dump(key, args.outfile)
@@ -334,6 +1025,9 @@ if __name__ == "__main__":
 				parser.print_usage()
 				print "error: infile is required for the pattern_decrypt binary action"
 				sys.exit(1)
+			if args.state != None:
+				update_key_state('binary', [args.infile.name])
+				sys.exit(0)
 			key = Esafenet.binary_find_key(args.infile.read())
 			cPickle.dump(key, args.outfile)
 			if args.outfile.name != '<stdout>':
@@ -352,4 +1046,64 @@ if __name__ == "__main__":
 				parser.print_usage()
 				print "error: language is required for the pattern_decrypt text action"
 				sys.exit(1)
-			key = Esafenet.text_find_key(args.infolder, args.language, args.outfile)
+			if args.state != None:
+				update_key_state('text', partial_c.list_input(args.infolder), language=args.language, jobs=args.jobs or None)
+				sys.exit(0)
+			key = Esafenet.text_find_key(args.infolder, args.language, args.outfile, args.jobs)
+
+	elif args.a == 'coa':
+		if args.infile == None and args.infolder == None:
+			parser.print_usage()
+			print "error: infile or infolder is required for the coa action"
+			sys.exit(1)
+
+		if args.state != None:
+			update_key_state('coa', [args.infile.name] if args.infile != None else coa.read_texts(args.infolder).paths)
+			sys.exit(0)
+		if args.infile != None:
+			texts = [args.infile.read()]
+		else:
+			texts = coa.read_texts(args.infolder)
+		key = Esafenet.coa_find_key(texts, args.model)
+		cPickle.dump(key, args.outfile)
+		if args.outfile.name != '<stdout>':
+			print "Ciphertext-only attack: key written to %s (%d files analyzed)" % (args.outfile.name, len(texts))
+
+	elif args.a == 'solve':
+		if args.infile == None:
+			parser.print_usage()
+			print "error: infile is required for the solve action (its header holds the checksum)"
+			sys.exit(1)
+
+		text = args.infile.read()
+		texts = [text]
+		if args.infolder != None:
+			texts = itertools.chain(texts, coa.read_texts(args.infolder))
+		key, score, bound = Esafenet.coa_solve_key(text, texts, args.model)
+		cPickle.dump(key, args.outfile)
+		if args.outfile.name != '<stdout>':
+			print "Solver: key written to %s (score %d, upper bound %d%s)" % (args.outfile.name, score, bound, ", optimal" if score == bound else "")
+
+	elif args.a == 'key_state':
+		if args.state == None or not os.path.exists(args.state):
+			parser.print_usage()
+			print "error: an existing state file is required for the key_state action"
+			sys.exit(1)
+
+		state = key_state.KeyState.load(args.state)
+		key, confidence = state.best_key()
+		files = state.summary()
+		state.close()
+		cPickle.dump(key, args.outfile)
+		if args.outfile.name != '<stdout>':
+			for attack, files in sorted(files.items()):
+				print "%-8s %d file(s)" % (attack, files)
+			known = [c for b, c in zip(key, confidence) if b is not None]
+			print "Key state: %d key bytes known (mean confidence %.2f), key written to %s" % (len(known),
+				sum(known) / max(len(known), 1), args.outfile.name)
+
+	if args.stats == '-':
+		stats.write_report(sys.stderr)
+	elif args.stats != None:
+		with open(args.stats, "w") as fh:
+			stats.write_report(fh)
@@ -20,16 +20,120 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 from esafenet import Esafenet
+import xor_engine
+import coa
+import bisect
+import collections
+import copy
+import corpus
+import threading
 import wx
+import wx.lib.newevent
 import numpy
 import os
 # begin wxGlade: extracode
 # end wxGlade
 
+#Number of decrypted rows kept by ResultList, a few screens full
+ROW_CACHE_SIZE = 256
+#Printable characters are shown as-is, the others as an empty cell
+PRINTABLE = "".join(chr(c) if 32 <= c <= 126 else "\x00" for c in range(256))
+#Posted by AnalysisWorker: progress of a stage, a better key, and the end of the analysis
+ProgressEvent, EVT_PROGRESS = wx.lib.newevent.NewEvent()
+KeyEvent, EVT_KEY = wx.lib.newevent.NewEvent()
+DoneEvent, EVT_DONE = wx.lib.newevent.NewEvent()
+
+
+"""
+A virtual list of the files of a corpus (see corpus.py) decrypted with a key, 512 bytes per row and a byte per column.
+The rows of a file hold its ciphertext after the header block.
+Rows are only decrypted when they are shown, and the most recently shown rows are cached,
+so the list opens at once and uses the same memory for inputs of any size.
+"""
+class ResultList(wx.ListCtrl):
+    def __init__(self, *args, **kwds):
+        kwds["style"] = kwds.get("style", 0) | wx.LC_VIRTUAL
+        wx.ListCtrl.__init__(self, *args, **kwds)
+        self.texts = corpus.Corpus()
+        self.key = None
+        self.starts = [0]
+        self.rows = collections.OrderedDict()
+        #the body of the last file a row was read from, scrolling mostly stays in the same file
+        self.last = (None, None)
+
+    """
+    Show the files of texts decrypted with key, replacing what is shown.
+    """
+    def show(self, texts, key):
+        self.texts = texts
+        self.key = key
+        self.rows.clear()
+        self.last = (None, None)
+        #the first row of every file
+        self.starts = [0]
+        for size in texts.sizes:
+            self.starts.append(self.starts[-1] + (max(size - 512, 0) + 511) // 512)
+        self.SetItemCount(self.starts[-1])
+        self.Refresh()
+
+    """
+    The decrypted row, with the characters that are not printable replaced by NUL.
+    """
+    def row(self, item):
+        row_txt = self.rows.pop(item, None)
+        if row_txt is None:
+            f = bisect.bisect_right(self.starts, item) - 1
+            if self.last[0] != f:
+                self.last = (f, self.texts.body(f))
+            r = item - self.starts[f]
+            row_txt = xor_engine.xor_with_key(self.last[1][512*r:512*r+512], self.key).translate(PRINTABLE)
+            if len(self.rows) >= ROW_CACHE_SIZE:
+                self.rows.popitem(last=False)
+        self.rows[item] = row_txt
+        return row_txt
+
+    def OnGetItemText(self, item, col):
+        row_txt = self.row(item)
+        if col < len(row_txt) and row_txt[col] != "\x00":
+            return row_txt[col]
+        return "-" if col == 0 else ""
+
+"""
+Runs the ciphertext-only attack on texts (a corpus) in the background (see coa.find_key_steps), and posts its progress to window:
+a ProgressEvent (stage, done, total) after every step, a KeyEvent (key) when the key improved, and a DoneEvent
+(key, cancelled, error) at the end. The key of a cancelled analysis is the best key found so far.
+"""
+class AnalysisWorker(threading.Thread):
+    def __init__(self, window, texts):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.window = window
+        self.texts = texts
+        self.cancelled = threading.Event()
+
+    """
+    Stop the analysis at the next step.
+    """
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        key = None
+        error = None
+        try:
+            for stage, done, total, step_key in coa.find_key_steps(self.texts):
+                if self.cancelled.is_set():
+                    break
+                if step_key is not None:
+                    key = step_key
+                    wx.PostEvent(self.window, KeyEvent(key=key))
+                wx.PostEvent(self.window, ProgressEvent(stage=stage, done=done, total=total))
+        except Exception as e:
+            error = "%s: %s" % (e.__class__.__name__, e)
+        wx.PostEvent(self.window, DoneEvent(key=key, cancelled=self.cancelled.is_set(), error=error))
+
 
 class MainFrame(wx.Frame):
-    text = None
-    texts = []
     def __init__(self, *args, **kwds):
         # begin wxGlade: MainFrame.__init__
         kwds["style"] = wx.DEFAULT_FRAME_STYLE
@@ -46,10 +150,13 @@ class MainFrame(wx.Frame):
         wxglade_tmp_menu.AppendSeparator()
         self.ana = wx.MenuItem(wxglade_tmp_menu, wx.NewId(), "Analyze", "", wx.ITEM_NORMAL)
         wxglade_tmp_menu.AppendItem(self.ana)
+        self.cnc = wx.MenuItem(wxglade_tmp_menu, wx.NewId(), "Cancel analysis", "", wx.ITEM_NORMAL)
+        wxglade_tmp_menu.AppendItem(self.cnc)
         self.frame_2_menubar.Append(wxglade_tmp_menu, "File")
         self.SetMenuBar(self.frame_2_menubar)
         # Menu Bar end
-        self.list_ctrl_1 = wx.ListCtrl(self, -1, style=wx.LC_REPORT | wx.SUNKEN_BORDER)
+        self.frame_2_statusbar = self.CreateStatusBar(1, 0)
+        self.list_ctrl_1 = ResultList(self, -1, style=wx.LC_REPORT | wx.SUNKEN_BORDER)
         for i in range(512):
             self.list_ctrl_1.InsertColumn(i, str(i), width=30)
         self.__set_properties()
@@ -58,12 +165,20 @@ class MainFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, self.of, self.opf)
         self.Bind(wx.EVT_MENU, self.anlz, self.ana)
         self.Bind(wx.EVT_MENU, self.ofi, self.opfi)
+        self.Bind(wx.EVT_MENU, self.cncl, self.cnc)
+        self.Bind(EVT_PROGRESS, self.on_progress)
+        self.Bind(EVT_KEY, self.on_key)
+        self.Bind(EVT_DONE, self.on_done)
+        self.worker = None
+        #the files opened so far
+        self.corpus = corpus.Corpus()
         # end wxGlade
 
     def __set_properties(self):
         # begin wxGlade: MainFrame.__set_properties
         self.SetTitle("E-Safenet decrypt")
         self.list_ctrl_1.SetMinSize((1800, 500))
+        self.cnc.Enable(False)
         # end wxGlade
 
     def __do_layout(self):
@@ -76,21 +191,14 @@ class MainFrame(wx.Frame):
         # end wxGlade
 
     def of(self, event):  # wxGlade: MainFrame.<event_handler>
-        filename = ""  # Use  filename as a flag
+        dirname = ""  # Use  dirname as a flag
         dlg = wx.DirDialog(self, message="Choose a folder")
  
         if dlg.ShowModal() == wx.ID_OK:
             dirname = dlg.GetPath()
         dlg.Destroy()
-        self.texts.append("")
         if dirname:
-           for(root, dirs, files) in os.walk(dirname):
-               for f in files:
-                   with open(root + "/" + f, "rb") as fh:
-                       fi = fh.read()[512:]
-                       l_off = len(fi) % 512
-                       self.texts[0] += fi + "\x00"*(512-l_off)
-                       #self.texts.append(fh.read())
+            self.open_files(corpus.list_files(dirname))
 
     def ofi(self, event):  # wxGlade: MainFrame.<event_handler>
         filename = ""  # Use  filename as a flag
@@ -101,65 +209,60 @@ class MainFrame(wx.Frame):
         dlg.Destroy()
  
         if filename:
-            with open(filename, "rb") as fh:
-                self.texts.append(fh.read())
+            self.open_files([filename])
+
+    """
+    Add the E-Safenet files at paths to the corpus, the files are only read when they are analyzed or shown.
+    """
+    def open_files(self, paths):
+        added = self.corpus.add(paths)
+        skipped = self.corpus.skipped
+        self.frame_2_statusbar.SetStatusText("%d file(s) opened, %d in total (left out so far: %d not E-Safenet, %d too small, %d duplicate, %d unreadable)" % (
+            added, len(self.corpus), skipped['magic'], skipped['small'], skipped['duplicate'], skipped['unreadable']))
+
     def xor_with_key(self, text, key):
-        xored = ""
-        for idx, c in enumerate(text):
-            xored += chr(ord(c) ^ key[idx % len(key)])
-        return xored
+        return xor_engine.xor_with_key(text, key)
 
     def anlz(self, event):  # wxGlade: MainFrame.<event_handler>
-        #maximize plaintext
-        if len(self.texts) > 0:
-            print "Analyzing, this can take a while..."
-            keyval = [None]*512
-            #keyval2 = [None]*512
-            for i in range(512):
-                keyval[i] = [0]*256
-                #keyval2[i] = [0]*8
-
-            for t in range(len(self.texts)):
-               text_ord = [ord(c) for c in self.texts[t]]
-               rows = ((len(self.texts[t])-1) // 512) + 1
-               for i in range(512):
-                   for pos_key in range(256):
-                       for idx in range(i+512, len(self.texts[t]), 512):
-                           o = text_ord[idx] ^ pos_key
-                           if (o >= 32 and o <= 126) or o == 9 or o == 10 or o == 13:
-                               keyval[i][pos_key] += 1
-                               #for q in range(8):
-                                #   bit = pos_key >> q & 1
-                                 #  if bit == 0:
-                                  #     bit = -1
-                                   #keyval2[i][q] += bit
-
-
-            assumed_key = [None]*512
-            assumed_key2 = [None]*512
-            for i in range(512):
-                assumed_key2[i] = [None]*8
-            for i in range(512):
-                assumed_key[i] = keyval[i].index(max(keyval[i]))
-                #for j in range(8):
-                    #assumed_key2[i][j] = keyval2[i][j] > 0
-                
-            print "Analyzing done"
-            print assumed_key
-            #print assumed_key2
-            self.show_dec(assumed_key)
+        #maximize plaintext, in the background: the grid shows the key as it improves
+        if len(self.corpus) > 0 and self.worker is None:
+            print "Analyzing..."
+            #files opened during the analysis are left for the next one
+            self.worker = AnalysisWorker(self, copy.deepcopy(self.corpus))
+            self.ana.Enable(False)
+            self.cnc.Enable(True)
+            self.worker.start()
+
+    def cncl(self, event):  # wxGlade: MainFrame.<event_handler>
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def on_progress(self, event):
+        self.frame_2_statusbar.SetStatusText("Analyzing: %s %d/%d" % (event.stage, event.done, event.total))
+
+    def on_key(self, event):
+        self.show_dec(event.key)
+
+    def on_done(self, event):
+        self.worker = None
+        self.ana.Enable(True)
+        self.cnc.Enable(False)
+        if event.error is not None:
+            status = "Analyzing failed: %s" % event.error
+        elif event.cancelled:
+            status = "Analyzing cancelled" + (", showing the best key so far" if event.key is not None else "")
+        else:
+            status = "Analyzing done"
+        print status
+        self.frame_2_statusbar.SetStatusText(status)
+        if event.key is not None:
+            print event.key
+            self.show_dec(event.key)
 
     def show_dec(self, key):
-        if len(self.texts) > 0:
-            rows = ((len(self.texts[0])-1) // 512) + 1
-            for i in range(rows):
-                row_txt = self.xor_with_key(self.texts[0][512*i:512*i+512],key)
-                self.list_ctrl_1.InsertStringItem(i, "-")
-                for j in range(len(row_txt)):
-                    if ord(row_txt[j]) >= 32 and ord(row_txt[j]) <= 126:
-                        self.list_ctrl_1.SetStringItem(i, j, row_txt[j])
-        
-            
+        if len(self.corpus) > 0:
+            self.list_ctrl_1.show(self.corpus, key)
+
 
 # end of class MainFrame
 class ES_Gui(wx.App):
@@ -0,0 +1,233 @@
+# In-place decryption of E-Safenet files, with a crash-safe journal
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# The encrypted file is memory-mapped and everything after the 512 byte header block is xored
+# in the mapping, after which the header block is replaced by the decompressed first block.
+#
+# Before a file is touched, a journal (<file>.esafenet-journal) is written that holds the original
+# header block and the number of body bytes that have been xored so far. Before each chunk is xored,
+# the CRC32 of each of its 512 byte units is stored in the journal too. Because xoring is its own
+# inverse, an interrupted chunk can always be brought back to a known state: a unit either still
+# matches its stored CRC, or matches it once xored again. With this, an interrupted run can be
+# resumed (decrypt_in_place on the same file) or rolled back to the original encrypted file
+# (rollback_in_place).
+import mmap
+import os
+import struct
+import zlib
+import simplelzo1x #Self-created safenet-specific module, see simplelzo1x folder.
+import xor_engine
+
+JOURNAL_SUFFIX = ".esafenet-journal"
+#Chunks are aligned to this size in the file, it is a multiple of the mmap granularity and the key length
+CHUNK_SIZE = 4 * 1024 * 1024
+UNIT = 512
+MAX_UNITS = CHUNK_SIZE // UNIT
+
+PHASE_BODY = 0
+PHASE_HEADER = 1
+
+#magic, phase, crc slot, key crc, original file size, body bytes xored, in-flight chunk start, in-flight units
+STATE = struct.Struct("<4sBBxxIQQQI")
+MAGIC = "ESJ1"
+
+class InPlaceException(Exception):
+	pass
+
+def journal_name(path):
+	return path + JOURNAL_SUFFIX
+
+def key_crc(key):
+	return zlib.crc32(xor_engine.key_string(key)) & 0xffffffff
+
+def unit_crcs(data):
+	return [zlib.crc32(data[i:i+UNIT]) & 0xffffffff for i in range(0, len(data), UNIT)]
+
+def plain_header(header, key):
+	offset = ord(header[4]) | ord(header[5]) << 8  #offset is stored in these 2 bytes in little-endian order.
+	return simplelzo1x.decompress(xor_engine.xor_with_key(header[offset:512], key))
+
+"""
+The journal of a single file.
+The state record lives at the start of the journal and fits in one sector, so every state change is a single write.
+The CRCs of the in-flight chunk are written to one of two slots, and only become active when the state points to them.
+"""
+class Journal:
+	def __init__(self, fh):
+		self.fh = fh
+
+	@staticmethod
+	def create(path, header, key, size):
+		journal = Journal(open(journal_name(path), "w+b"))
+		journal.fh.write(STATE.pack(MAGIC, PHASE_BODY, 0, key_crc(key), size, 0, 0, 0))
+		journal.fh.write(header)
+		journal.sync()
+		journal.load()
+		return journal
+
+	@staticmethod
+	def open(path, key):
+		journal = Journal(open(journal_name(path), "r+b"))
+		journal.load()
+		if journal.magic != MAGIC:
+			raise InPlaceException("%s is not an in-place decryption journal" % journal_name(path))
+		if journal.key_crc != key_crc(key):
+			raise InPlaceException("%s was written with a different key" % journal_name(path))
+		return journal
+
+	def load(self):
+		self.fh.seek(0)
+		(self.magic, self.phase, self.slot, self.key_crc, self.size, self.done,
+			self.chunk_start, self.units) = STATE.unpack(self.fh.read(STATE.size))
+		self.header = self.fh.read(512)
+		self.fh.seek(self.__slot_offset(self.slot))
+		self.crcs = struct.unpack("<%dI" % self.units, self.fh.read(4 * self.units))
+
+	def sync(self):
+		self.fh.flush()
+		os.fsync(self.fh.fileno())
+
+	def __slot_offset(self, slot):
+		return STATE.size + 512 + slot * 4 * MAX_UNITS
+
+	def __write_state(self):
+		self.fh.seek(0)
+		self.fh.write(STATE.pack(MAGIC, self.phase, self.slot, self.key_crc, self.size, self.done, self.chunk_start, len(self.crcs)))
+		self.sync()
+
+	"""
+	Commit the body bytes done so far, and announce the chunk that is about to be xored.
+	"""
+	def begin_chunk(self, done, chunk_start, crcs):
+		slot = 1 - self.slot
+		self.fh.seek(self.__slot_offset(slot))
+		self.fh.write(struct.pack("<%dI" % len(crcs), *crcs))
+		self.sync()
+		self.slot, self.done, self.chunk_start, self.crcs = slot, done, chunk_start, crcs
+		self.__write_state()
+
+	def set_state(self, phase, done):
+		self.phase, self.done, self.chunk_start, self.crcs = phase, done, 0, ()
+		self.__write_state()
+
+	def close(self):
+		self.fh.close()
+
+	def remove(self):
+		name = self.fh.name
+		self.fh.close()
+		os.remove(name)
+
+"""
+Bring the chunk that was being xored when the run was interrupted back to the state it had before.
+"""
+def resolve_chunk(m, journal, key):
+	for i, crc in enumerate(journal.crcs):
+		pos = journal.chunk_start + i * UNIT
+		data = m[pos:pos+UNIT]
+		if zlib.crc32(data) & 0xffffffff == crc:
+			continue
+		xored = xor_engine.xor_with_key(data, key, pos - 512)
+		if zlib.crc32(xored) & 0xffffffff != crc:
+			raise InPlaceException("Unit at offset %d is neither encrypted nor decrypted (torn write)" % pos)
+		m[pos:pos+UNIT] = xored
+
+"""
+Xor the body bytes between the journal's done marker and target, journaling each chunk.
+Works in both directions: forward to decrypt, backward (target < done) to roll back.
+"""
+def xor_body(m, journal, key, target):
+	while journal.done != target:
+		pos = 512 + journal.done
+		if target > journal.done:
+			start, end = pos, min((pos // CHUNK_SIZE + 1) * CHUNK_SIZE, 512 + target)
+			new_done = end - 512
+		else:
+			start, end = max(((pos - 1) // CHUNK_SIZE) * CHUNK_SIZE, 512 + target), pos
+			new_done = start - 512
+		chunk = m[start:end]
+		journal.begin_chunk(journal.done, start, unit_crcs(chunk))
+		m[start:end] = xor_engine.xor_with_key(chunk, key, start - 512)
+		aligned = start - start % mmap.ALLOCATIONGRANULARITY
+		m.flush(aligned, end - aligned)
+		journal.begin_chunk(new_done, 0, [])
+
+def map_file(fh):
+	return mmap.mmap(fh.fileno(), 0)
+
+"""
+Decrypt the file at path in place, resuming an earlier interrupted run if a journal exists.
+Returns the size of the decrypted file.
+"""
+def decrypt_in_place(path, key):
+	with open(path, "r+b") as fh:
+		if os.path.exists(journal_name(path)):
+			journal = Journal.open(path, key)
+		else:
+			#esafenet imports this module, so it is imported here
+			from esafenet import Esafenet
+			head = fh.read(1024)
+			header = head[:512]
+			if len(header) < 512:
+				raise InPlaceException("File is too short (%d bytes) to contain an E-Safenet header" % len(header))
+			size = os.fstat(fh.fileno()).st_size
+			#check the key against the header checksum before touching the file, so a wrong key fails early
+			if not Esafenet.check_key(head, key):
+				raise InPlaceException("Wrong key: the header checksum does not match")
+			if size > 512 and len(plain_header(header, key)) != 512:
+				raise InPlaceException("The first block does not decompress to 512 bytes, wrong key?")
+			journal = Journal.create(path, header, key, size)
+
+		if journal.phase == PHASE_BODY:
+			if journal.size > 512:
+				m = map_file(fh)
+				resolve_chunk(m, journal, key)
+				xor_body(m, journal, key, journal.size - 512)
+				m.close()
+			journal.set_state(PHASE_HEADER, journal.size - 512)
+
+		#rewriting the header block is idempotent, so an interrupted header phase is simply redone
+		plain = plain_header(journal.header, key)
+		fh.seek(0)
+		fh.write(plain)
+		if journal.size == 512:
+			fh.truncate(len(plain))
+		fh.flush()
+		os.fsync(fh.fileno())
+		size = journal.size - 512 + len(plain)
+		journal.remove()
+	return size
+
+"""
+Undo an interrupted in-place decryption of the file at path, restoring the encrypted file.
+"""
+def rollback_in_place(path, key):
+	journal = Journal.open(path, key)
+	with open(path, "r+b") as fh:
+		if journal.phase == PHASE_HEADER:
+			fh.seek(0)
+			fh.write(journal.header)
+			fh.flush()
+			os.fsync(fh.fileno())
+			journal.set_state(PHASE_BODY, journal.done)
+
+		if journal.done or journal.crcs:
+			m = map_file(fh)
+			resolve_chunk(m, journal, key)
+			xor_body(m, journal, key, 0)
+			m.close()
+	journal.remove()
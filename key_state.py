@@ -0,0 +1,231 @@
+# Persistent key recovery state for E-Safenet keys
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# The evidence of every attack is kept as a 512x256 array of counts per key byte candidate, together with
+# the files it was gathered from. Attacks only have to process the files that are new (or changed) since
+# the last run, and add their counts. For the ciphertext-only attack the column histograms of the files are
+# kept instead, as the scores are a linear function of them.
+#
+# The evidence each file added is kept with it, as a sparse count array. When a file changed, the evidence of its old
+# version is subtracted before the new version is added, so a file always counts once.
+#
+# The state file only holds the counts, so loading and saving it does not depend on the number of files. The files
+# and their evidence are kept in a SQLite database next to it (the state path + FILES_SUFFIX), which is read a row
+# at a time for the files an attack is given. Both carry a generation number, which a save increases, so a state
+# file and a database that do not belong together (an interrupted save) are refused.
+#
+# The best key is found by giving every attack a vote per column: the share of its counts for each candidate,
+# weighted by how reliable the attack is. The confidence of a key byte is the share of the weighted votes
+# that the best candidate got.
+import cPickle
+import os
+import sqlite3
+import coa
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+KEY_LEN = 512
+VERSION = 3
+FILES_SUFFIX = ".files"
+SCHEMA = """CREATE TABLE IF NOT EXISTS files (
+	attack TEXT,
+	path TEXT,
+	size INTEGER,
+	mtime REAL,
+	flat BLOB,
+	n BLOB,
+	PRIMARY KEY (attack, path)
+)"""
+ATTACKS = ['known', 'binary', 'text', 'coa']
+#How much the vote of each attack counts when the evidence of several attacks is combined
+WEIGHTS = {'known': 100, 'binary': 10, 'text': 5, 'coa': 1}
+
+class KeyStateException(Exception):
+	pass
+
+"""
+Identifies the version of a file: a file is processed again when its size or modification time changes.
+"""
+def file_id(path):
+	st = os.stat(path)
+	return (st.st_size, st.st_mtime)
+
+"""
+The non-zero cells of a 512x256 count array, as (flat indices, counts), to store the evidence of a file.
+"""
+def sparse(counts):
+	counts = numpy.asarray(counts, dtype=numpy.int64)
+	flat = numpy.flatnonzero(counts)
+	return flat.astype(numpy.int32), counts.flat[flat]
+
+"""
+The evidence of a (partial) key found by an attack, None meaning unknown: a count of weight for every known key byte.
+"""
+def key_evidence(key, weight=1):
+	flat = [i * 256 + b for i, b in enumerate(key[:KEY_LEN]) if b is not None]
+	return numpy.array(flat, dtype=numpy.int32), numpy.array([weight] * len(flat), dtype=numpy.int64)
+
+class KeyState:
+	"""
+	An empty state, with its files in the SQLite database at files_path (by default in memory).
+	"""
+	def __init__(self, files_path=":memory:"):
+		if numpy is None:
+			raise KeyStateException("The key state needs numpy")
+		self.counts = dict((attack, numpy.zeros((KEY_LEN, 256), dtype=numpy.int64)) for attack in ATTACKS)
+		self.generation = 0
+		self.files_path = files_path
+		self.db = sqlite3.connect(files_path)
+		self.db.execute(SCHEMA)
+		self.db.execute("CREATE TABLE IF NOT EXISTS meta (generation INTEGER)")
+
+	"""
+	Load the state from path, or start a new one if the file does not exist.
+	"""
+	@staticmethod
+	def load(path):
+		state = KeyState(path + FILES_SUFFIX)
+		if not os.path.exists(path):
+			#the files of an earlier state that was removed do not count
+			state.db.execute("DELETE FROM files")
+			state.db.execute("DELETE FROM meta")
+			return state
+		with open(path, "rb") as fh:
+			data = cPickle.load(fh)
+		if not isinstance(data, dict) or data.get('version') not in (1, 2, VERSION):
+			raise KeyStateException("%s is not a key state file" % path)
+		for attack in ATTACKS:
+			state.counts[attack] += data['counts'][attack]
+		if data['version'] < VERSION:
+			#versions 1 and 2 kept the files in the state file, they move to the database with the next save
+			state.db.execute("DELETE FROM files")
+			for attack in ATTACKS:
+				for p, entry in data['files'][attack].items():
+					#version 1 did not keep the evidence per file, it cannot be taken out when such a file changes
+					fid, evidence = (entry, None) if data['version'] == 1 else entry
+					state.insert_file(attack, p, fid, evidence)
+			return state
+		state.generation = data['generation']
+		row = state.db.execute("SELECT generation FROM meta").fetchone()
+		if row is None or row[0] != state.generation:
+			raise KeyStateException("%s does not belong to %s (interrupted save?), remove both to start over" % (path + FILES_SUFFIX, path))
+		return state
+
+	"""
+	Write the state to path, and commit the files to the database next to it. The new state file is written first and
+	renamed over the old one after the commit, so an interrupted save is detected by the generation numbers.
+	A state that was not loaded from path has its files copied to the database of path.
+	"""
+	def save(self, path):
+		if self.files_path != path + FILES_SUFFIX:
+			db = sqlite3.connect(path + FILES_SUFFIX)
+			db.execute(SCHEMA)
+			db.execute("CREATE TABLE IF NOT EXISTS meta (generation INTEGER)")
+			db.execute("DELETE FROM files")
+			db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", self.db.execute("SELECT * FROM files"))
+			self.db.close()
+			self.db = db
+			self.files_path = path + FILES_SUFFIX
+		self.generation += 1
+		tmp = path + ".tmp"
+		with open(tmp, "wb") as fh:
+			cPickle.dump({'version': VERSION, 'generation': self.generation, 'counts': self.counts}, fh, cPickle.HIGHEST_PROTOCOL)
+		self.db.execute("DELETE FROM meta")
+		self.db.execute("INSERT INTO meta VALUES (?)", (self.generation,))
+		self.db.commit()
+		os.rename(tmp, path)
+
+	def close(self):
+		self.db.close()
+
+	"""
+	The paths that attack did not process yet in their current version.
+	"""
+	def new_files(self, attack, paths):
+		new = []
+		for path in paths:
+			row = self.db.execute("SELECT size, mtime FROM files WHERE attack = ? AND path = ?", (attack, path)).fetchone()
+			if row is None or tuple(row) != file_id(path):
+				new.append(path)
+		return new
+
+	"""
+	Record the evidence (see sparse and key_evidence) attack found in the current version of the file at path,
+	replacing the evidence of the version it processed before.
+	"""
+	def set_file(self, attack, path, evidence):
+		self.remove_file(attack, path)
+		flat, n = evidence
+		self.counts[attack].flat[flat] += n
+		self.insert_file(attack, path, file_id(path), evidence)
+
+	def insert_file(self, attack, path, fid, evidence):
+		flat, n = evidence if evidence is not None else (None, None)
+		self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", (attack, path, fid[0], fid[1],
+			None if flat is None else buffer(numpy.asarray(flat, dtype=numpy.int32).tostring()),
+			None if n is None else buffer(numpy.asarray(n, dtype=numpy.int64).tostring())))
+
+	"""
+	Take the evidence of the file at path out of the state.
+	"""
+	def remove_file(self, attack, path):
+		row = self.db.execute("SELECT flat, n FROM files WHERE attack = ? AND path = ?", (attack, path)).fetchone()
+		if row is None:
+			return
+		if row[0] is not None:
+			flat = numpy.frombuffer(row[0], dtype=numpy.int32)
+			n = numpy.frombuffer(row[1], dtype=numpy.int64)
+			self.counts[attack].flat[flat] -= n
+		self.db.execute("DELETE FROM files WHERE attack = ? AND path = ?", (attack, path))
+
+	"""
+	The votes of attack: the share of every candidate in its evidence, per column, and which columns it has evidence for.
+	"""
+	def votes(self, attack):
+		counts = self.counts[attack]
+		if attack == 'coa':
+			#the histogram is turned into scores, every best scoring key byte gets a vote
+			scores = coa.column_scores(counts)
+			counts = (scores == scores.max(1)[:, None]) & (counts.sum(1) > 0)[:, None]
+		totals = counts.sum(1)
+		return counts / numpy.maximum(totals, 1).astype(numpy.float64)[:, None], totals > 0
+
+	"""
+	The best key given all evidence, with None for unknown bytes, and the confidence (0 to 1) of every key byte.
+	"""
+	def best_key(self):
+		combined = numpy.zeros((KEY_LEN, 256))
+		weights = numpy.zeros(KEY_LEN)
+		for attack in ATTACKS:
+			shares, known = self.votes(attack)
+			combined += WEIGHTS[attack] * shares
+			weights += WEIGHTS[attack] * known
+		best = numpy.argmax(combined, 1)
+		confidence = combined[numpy.arange(KEY_LEN), best] / numpy.maximum(weights, 1)
+		key = [int(b) if w > 0 else None for b, w in zip(best, weights)]
+		return key, [float(c) for c in confidence]
+
+	"""
+	Number of processed files per attack.
+	"""
+	def summary(self):
+		files = dict((attack, 0) for attack in ATTACKS)
+		files.update(self.db.execute("SELECT attack, COUNT(*) FROM files GROUP BY attack"))
+		return files
@@ -0,0 +1,155 @@
+# Manifest of processed files for resumable and incremental E-Safenet folder runs
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Every file that encrypt_folder or decrypt_folder processes is recorded in a SQLite manifest, with the size,
+# modification time and (optionally) SHA-1 hash of the source file, the id of the key it was processed with,
+# the outcome and the size of the output. A later run skips the files that are up to date:
+#   - the source file did not change: same size and modification time, or, with hashing, the same contents,
+#   - it was processed successfully with a key that is still in use,
+#   - the output file is still there, with the recorded size.
+# Interrupted runs resume where they stopped, as every finished file is in the manifest. Files that failed are retried.
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import xor_engine
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS files (
+	path TEXT,
+	action TEXT,
+	size INTEGER,
+	mtime REAL,
+	hash TEXT,
+	key_id TEXT,
+	outcome TEXT,
+	output_size INTEGER,
+	PRIMARY KEY (path, action)
+)"""
+OK = "ok"
+#Seconds between commits of the manifest: a crash loses at most this much of the record (the files are processed again)
+COMMIT_INTERVAL = 1.0
+HASH_BLOCK = 1 << 20
+
+"""
+A short id of a key, for the manifest.
+"""
+def key_id(key):
+	return hashlib.sha1(xor_engine.key_string(key)).hexdigest()[:16]
+
+"""
+A file-like object that hashes everything read from fh.
+"""
+class HashingReader:
+	def __init__(self, fh):
+		self.fh = fh
+		self.hash = hashlib.sha1()
+
+	def read(self, size=-1):
+		data = self.fh.read(size)
+		self.hash.update(data)
+		return data
+
+	def hexdigest(self):
+		return self.hash.hexdigest()
+
+def file_hash(path):
+	h = hashlib.sha1()
+	with open(path, "rb") as fh:
+		for block in iter(lambda: fh.read(HASH_BLOCK), ""):
+			h.update(block)
+	return h.hexdigest()
+
+class Manifest:
+	"""
+	Open (or create) the manifest at path for action ("encrypt" or "decrypt").
+	key_ids are the ids of the keys of this run, files processed with another key are processed again.
+	With use_hash, the source files are hashed, so files that were only touched are not processed again.
+	The manifest can be used from several threads.
+	"""
+	def __init__(self, path, action, key_ids, use_hash=False):
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute(SCHEMA)
+		self.action = action
+		self.key_ids = set(key_ids)
+		self.use_hash = use_hash
+		self.lock = threading.Lock()
+		self.last_commit = time.time()
+		#the source file stats taken by up_to_date, recorded with the outcome
+		self.sources = {}
+		self.skipped = 0
+
+	"""
+	Whether src was processed to dst before, and neither changed since. Files that are not up to date are stat'ed here,
+	so their record describes the file as it was before processing it.
+	"""
+	def up_to_date(self, src, dst):
+		try:
+			st = os.stat(src)
+		except OSError:
+			return False #processing it will report the error
+		with self.lock:
+			if self.db is None:
+				return False
+			row = self.db.execute("SELECT size, mtime, hash, key_id, outcome, output_size FROM files WHERE path = ? AND action = ?",
+				(src, self.action)).fetchone()
+		self.sources[src] = (st.st_size, st.st_mtime)
+		if row is None:
+			return False
+		size, mtime, digest, used_key, outcome, output_size = row
+		if outcome != OK or used_key not in self.key_ids:
+			return False
+		try:
+			if os.path.getsize(dst) != output_size:
+				return False
+		except OSError:
+			return False
+		if (size, mtime) != (st.st_size, st.st_mtime):
+			if not self.use_hash or digest is None or size != st.st_size or file_hash(src) != digest:
+				return False
+			#only touched: keep the file, and the new modification time
+			with self.lock:
+				self.db.execute("UPDATE files SET mtime = ? WHERE path = ? AND action = ?", (st.st_mtime, src, self.action))
+				self.commit()
+		del self.sources[src]
+		self.skipped += 1
+		return True
+
+	"""
+	Record the outcome of processing src: error is None on success. key is the key that was used (for a key ring,
+	the key picked for the file), digest the hash of the source file if it was computed while processing it.
+	"""
+	def record(self, src, error, key=None, digest=None, output_size=None):
+		size, mtime = self.sources.pop(src, (None, None))
+		used_key = key_id(key) if key is not None else None
+		with self.lock:
+			if self.db is None:
+				return #closed by an interrupted run, the file is processed again next time
+			self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+				(src, self.action, size, mtime, digest, used_key, OK if error is None else error, output_size))
+			if time.time() - self.last_commit > COMMIT_INTERVAL:
+				self.commit()
+
+	def commit(self):
+		self.db.commit()
+		self.last_commit = time.time()
+
+	def close(self):
+		with self.lock:
+			self.commit()
+			self.db.close()
+			self.db = None
@@ -17,43 +17,174 @@
 
 import itertools
 from os.path import commonprefix
+import stats
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+#Repeated runs must be longer than this to be used for the key
+MIN_RUN = 16
 
 # Recipe for pairwise iteration
 def pairwise(iterable):
     a, b = itertools.tee(iterable)
     next(b, None)
     return itertools.izip(a, b)
-	
-def find_binary_key(text):
-	r = text[512:]
 
+"""
+Filter the common prefix lengths of neighbouring sorted suffixes down to the ones that can be maximal:
+a prefix shorter than one of its neighbours is a prefix of that neighbour's run, and of a run of equal
+neighbours (which are all the same string) only the first is needed.
+Returns the indices of the kept pairs.
+"""
+def local_maxima(lengths):
+	kept = []
+	for i, l in enumerate(lengths):
+		if l > MIN_RUN and (i == 0 or l > lengths[i-1]) and (i == len(lengths) - 1 or l >= lengths[i+1]):
+			kept.append(i)
+	return kept
+
+"""
+Find the runs of ciphertext that repeat at the same offset in different 512 byte chunks.
+Returns a list of (offset, run) tuples. Runs that are part of a longer run found at a lower offset are left out.
+
+For every offset the suffixes of the chunks are put in sorted order, neighbours in that order have the
+longest common prefixes. The order at offset o follows from the byte at o and the order at o+1, so all
+512 orders are built from right to left with one (numpy) sort each, like a suffix array. The common
+prefix of two neighbours at o is 1 + the range minimum of the common prefixes at o+1 between them.
+"""
+def repeated_runs(r):
+	if numpy is None:
+		return repeated_runs_sorted(r)
+
+	m = (len(r) + 511) // 512
+	if m < 2:
+		return []
+	padded = numpy.empty(m * 512, dtype=numpy.int16)
+	padded.fill(-1) #past the end of the (shorter) last chunk
+	padded[:len(r)] = numpy.frombuffer(r, dtype=numpy.uint8)
+	chunks = padded.reshape(m, 512)
+
+	#state for the (empty) suffixes at offset 512
+	rank = numpy.zeros(m, dtype=numpy.int64)
+	pos = numpy.arange(m)
+	lcp = numpy.zeros(m, dtype=numpy.int32)
+	runs = []
+	for offset in range(511, -1, -1):
+		col = chunks[:, offset]
+		order = numpy.lexsort((rank, col))
+		k1 = col[order]
+		k2 = rank[order]
+
+		same = (k1[1:] == k1[:-1]) & (k1[1:] >= 0)
+		pa = pos[order[:-1]]
+		pb = pos[order[1:]]
+		new_lcp = numpy.zeros(m, dtype=numpy.int32)
+		new_lcp[1:] = numpy.where(same, 1 + range_min(lcp, numpy.minimum(pa, pb) + 1, numpy.maximum(pa, pb)), 0)
+
+		rank = numpy.empty(m, dtype=numpy.int64)
+		rank[order] = numpy.concatenate(([0], numpy.cumsum((k1[1:] != k1[:-1]) | (k2[1:] != k2[:-1]))))
+		pos = numpy.empty(m, dtype=numpy.int64)
+		pos[order] = numpy.arange(m)
+		lcp = new_lcp
+
+		lengths = lcp[1:]
+		if lengths.max() > MIN_RUN:
+			kept = local_maxima_numpy(lengths)
+			if offset > 0:
+				#runs that also match one byte to the left are part of a run found at offset-1
+				prev = chunks[:, offset-1]
+				kept = kept[prev[order[kept]] != prev[order[kept+1]]]
+			for i in kept:
+				start = order[i] * 512 + offset
+				runs.append((offset, r[start:start+lengths[i]]))
+	return runs
+
+def local_maxima_numpy(lengths):
+	left = numpy.concatenate(([-1], lengths[:-1]))
+	right = numpy.concatenate((lengths[1:], [-1]))
+	return numpy.nonzero((lengths > MIN_RUN) & (lengths > left) & (lengths >= right))[0]
+
+"""
+Minimum of values[lo[i]..hi[i]] (inclusive) for every i, with a sparse table.
+"""
+def range_min(values, lo, hi):
+	table = [values]
+	span = 1
+	while span * 2 <= len(values):
+		prev = table[-1]
+		table.append(numpy.minimum(prev[:-span], prev[span:]))
+		span *= 2
+	result = numpy.empty(len(lo), dtype=values.dtype)
+	level = numpy.floor(numpy.log2(hi - lo + 1)).astype(numpy.int64)
+	for k in numpy.unique(level):
+		sel = level == k
+		l = lo[sel]
+		h = hi[sel]
+		result[sel] = numpy.minimum(table[k][l], table[k][h - (1 << k) + 1])
+	return result
+
+"""
+Same as repeated_runs, sorting the chunk suffixes for every offset. Used when numpy is not available.
+"""
+def repeated_runs_sorted(r):
 	chunks = [r[x:x+512] for x in range(0,len(r),512)]
+	runs = []
+	for offset in range(512):
+		order = sorted(range(len(chunks)), key=lambda c: chunks[c][offset:])
+		pairs = list(pairwise(order))
+		lengths = [len(commonprefix([chunks[a][offset:], chunks[b][offset:]])) for a, b in pairs]
+		for i in local_maxima(lengths):
+			a, b = pairs[i]
+			if offset == 0 or chunks[a][offset-1] != chunks[b][offset-1]:
+				runs.append((offset, chunks[a][offset:offset+lengths[i]]))
+	return runs
+
+"""
+Keep only the runs that are not part of a longer run, each at the lowest offset it was found at.
+Runs are checked longest first against an index of the 17 byte substrings of the runs kept so far.
+"""
+def maximal_runs(runs):
+	first = {}
+	for offset, run in runs:
+		if run not in first or offset < first[run]:
+			first[run] = offset
+
+	kept = []
+	index = {}
+	for run in sorted(first, key=len, reverse=True):
+		k = MIN_RUN + 1
+		if any(run in kept[i][1] for i in index.get(run[:k], ())):
+			continue
+		kept.append((first[run], run))
+		for j in range(len(run) - k + 1):
+			index.setdefault(run[j:j+k], set()).add(len(kept) - 1)
+	return kept
+
+"""
+Probable-plaintext attack on binary files. Binary files contain long runs of zero bytes, which show
+the key as-is in the ciphertext. Such runs repeat at the same offset in several 512 byte chunks.
+Returns the key as a list of 512 byte values, with None for the bytes that were not found.
+"""
+def binary_key_bytes(text):
+	#a buffer on the text after the header block, so a mapped file is not copied
+	r = buffer(text, 512)
+
 	store = [None]*512
 	for i in range(512):
 		store[i] = {}
+	with stats.stage("repeated_runs"):
+		runs = repeated_runs(r)
+	with stats.stage("maximal_runs"):
+		runs = maximal_runs(runs)
+	stats.count("repeated_runs_bytes", len(r))
+	stats.count("maximal_runs", len(runs))
+	for offset, run in runs:
+		store[offset][run] = 1
 
-	for offset in range(512):
-		ochunks = [x[offset:] for x in chunks]
-		ochunks.sort()
-
-		for s1, s2 in pairwise(ochunks):
-			pfx = commonprefix([s1,s2])
-			if len(pfx)>16:
-				skip = False
-				for ofs in store:
-					for stored in ofs.keys():
-						if pfx in stored:
-							skip = True
-							break
-
-				if not skip:			
-					store[offset][pfx] = store[offset].get(pfx, 0) + 1
-					for ofs in range(len(store)):
-						for stored in store[ofs].keys():
-							if len(stored) < len(pfx) and stored in pfx:
-								del(store[ofs][stored])
-
-	key = ['\0']*512
+	key = [None]*512
 	i = 0
 
 	order = [None]*512
@@ -67,7 +198,12 @@ def find_binary_key(text):
 	for o in order:
 		if o != None:
 			for k, offset in o:
-				key[offset:offset+len(k)] = k
+				key[offset:offset+len(k)] = [ord(l) for l in k]
 
-	arr = [ord(l) for l in key]
-	return arr
+	return key
+
+"""
+Same as binary_key_bytes, with 0 for the bytes that were not found.
+"""
+def find_binary_key(text):
+	return [0 if b is None else b for b in binary_key_bytes(text)]
@@ -20,6 +20,13 @@ from collections import defaultdict
 import os
 import re
 from multiprocessing import Pool
+import corpus
+import stats
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 keyword_lists = {}
 keyword_lists['C'] = [
@@ -74,7 +81,12 @@ keyword_lists['CS'] = [
 "private "
 ]
 
-open_files = []
+#The files read by read_input, memory-mapped when they are used (see corpus.py)
+open_files = corpus.Corpus()
+#Files are split over the workers of process_parallel in shards of about this many bytes
+SHARD_SIZE = 4 * 1024 * 1024
+#column index (see column_index) of each file in open_files
+open_indexes = []
 
 def gen():
 	for k in keywords:
@@ -92,12 +104,139 @@ def is_allowed_string(s):
 	return True
 
 def read_input(dir):
-	for root, dirs, files in os.walk(dir):
-		for f in files:
-			l = open(root + "/" + f).read()
-			open_files.append(l)
+	open_files.add(corpus.list_files(dir))
+	if numpy is not None:
+		corpus_indexes()
+
+if numpy is not None:
+	#ALLOWED[b] tells whether byte b is an allowed plaintext character
+	ALLOWED = numpy.zeros(256, dtype=bool)
+	ALLOWED[32:127] = True
+	ALLOWED[[9, 10, 13]] = True
+	#BAD_BYTES[v] holds the ciphertext bytes that do not decrypt to an allowed character with key byte v
+	BAD_BYTES = [numpy.nonzero(~ALLOWED[numpy.arange(256) ^ v])[0] for v in range(256)]
+
+"""
+Precompute, for one file, which key bytes decrypt each key column (0-511) to allowed characters only.
+Row t of column c is the ciphertext byte at 512 + 512*t + c. For every column c and key byte v, the index
+holds how many rows before the end of the column the first row is that does not decrypt to an allowed
+character (0 if there is none), counting from row 0 and from row 1. With this, verifying a key fragment
+against all rows of its columns is a lookup per byte instead of a loop over the whole file.
+Returns (rows per column, slack from row 0, slack from row 1), or None if the file has no data after 512 bytes.
+"""
+def column_index(text):
+	body = numpy.frombuffer(text, dtype=numpy.uint8)[512:]
+	n = len(body)
+	if n == 0:
+		return None
+	rows = (n + 511) // 512
+	rows_per_col = numpy.empty(512, dtype=numpy.int64)
+	rows_per_col.fill(rows)
+	if n % 512:
+		rows_per_col[n % 512:] -= 1
+
+	first_bad = [first_bad_rows(body[512 * start:], rows_per_col - start) + start for start in (0, 1)]
+	return (rows_per_col,) + tuple(numpy.clip(rows_per_col[:, None] - fb, 0, 255).astype(numpy.uint8) for fb in first_bad)
+
+"""
+For every column and key byte, the first row that does not decrypt to an allowed character (rows_per_col if none).
+Row t of column c is data[512*t + c]. Large files are processed block_rows rows at a time, so only the
+(512, 256) result grows with the file, not the memory used.
+"""
+def first_bad_rows(data, rows_per_col, block_rows=2048):
+	rows = (len(data) + 511) // 512
+	result = numpy.empty((512, 256), dtype=numpy.int64)
+	result[:] = numpy.maximum(rows_per_col, 0)[:, None]
+	if rows <= 0:
+		return result
+
+	if rows < 128:
+		#small files: try all 256 key bytes on all cells at once
+		cells = numpy.zeros(rows * 512, dtype=numpy.uint8)
+		cells[:len(data)] = data
+		cells = cells.reshape(rows, 512)
+		valid = numpy.arange(rows)[:, None] < rows_per_col[None, :]
+		for v in range(256):
+			bad = ~ALLOWED[cells ^ v] & valid
+			has_bad = bad.any(0)
+			result[has_bad, v] = bad.argmax(0)[has_bad]
+		return result
+
+	#large files: first row of every byte value in every column, then the earliest bad byte for every key byte
+	first_row = numpy.empty(512 * 256, dtype=numpy.int64)
+	first_row.fill(rows)
+	#column * 256 for every cell of a block
+	cols = numpy.tile(numpy.arange(512, dtype=numpy.int32) * 256, block_rows)
+	for row in range(0, rows, block_rows):
+		block = data[row * 512:(row + block_rows) * 512]
+		values, first = numpy.unique(cols[:len(block)] + block, return_index=True)
+		#earlier blocks hold the earlier rows
+		first_row[values] = numpy.minimum(first_row[values], row + first // 512)
+	first_row = first_row.reshape(512, 256)
+	for v in range(256):
+		result[:, v] = numpy.minimum(result[:, v], first_row[:, BAD_BYTES[v]].min(1))
+	return result
+
+def corpus_indexes():
+	while len(open_indexes) < len(open_files):
+		open_indexes.append(column_index(open_files[len(open_indexes)]))
+	return open_indexes
+
+"""
+Find all positions in text where the key fragment derived from keyword decrypts the same offset in every
+512 byte chunk to allowed characters (like offset_key), and add the key bytes of the matches to counts.
+Only the positions from first up to last are tried, so a large file can be split over several workers.
+Returns the number of matches; unlike offset_key, the matches are not printed one by one.
+"""
+def match_keyword(text, index, keyword, counts, first=512, last=None, block=1 << 18):
+	L = len(keyword)
+	if index is None or len(text) - L <= 512:
+		return 0
+	rows_per_col, slack0, slack1 = index
+	data = numpy.frombuffer(text, dtype=numpy.uint8)
+	kw = numpy.frombuffer(keyword, dtype=numpy.uint8)
+	j = numpy.arange(L)
+	end = len(text) - L if last is None else min(last, len(text) - L)
+	matches = 0
+	for first in range(first, end, block):
+		starts = numpy.arange(first, min(first + block, end))
+		offsets = starts % 512
+		#number of chunks checked by offset_key for each start
+		checked = (len(text) - L - offsets - 512 + 511) // 512
+		#one keyword byte at a time, only for the starts that matched the bytes before it
+		for i in range(L):
+			key = data[starts + i] ^ kw[i]
+			pos = offsets + i
+			col = pos % 512
+			row0 = pos // 512
+			slack = numpy.where(row0 == 0, slack0[col, key], slack1[col, key])
+			ok = slack <= rows_per_col[col] - row0 - checked
+			starts, offsets, checked = starts[ok], offsets[ok], checked[ok]
+		keys = data[starts[:, None] + j] ^ kw
+		matches += len(starts)
+		numpy.add.at(counts, ((offsets[:, None] + j) % 512, keys), 1)
+	return matches
+
+def counts_to_key(counts):
+	safenet_key = defaultdict(defaultdict)
+	for i in range(512):
+		safenet_key[i] = defaultdict(int)
+	for i, v in zip(*numpy.nonzero(counts)):
+		safenet_key[i][v] = int(counts[i, v])
+	return safenet_key
 
 def xor_one_keyword(keyword):
+	if numpy is None:
+		return xor_one_keyword_slow(keyword)
+	counts = numpy.zeros((512, 256), dtype=numpy.int64)
+	for text, index in zip(open_files, corpus_indexes()):
+		match_keyword(text, index, keyword, counts)
+	return counts_to_key(counts)
+
+"""
+Same as xor_one_keyword, checking every position against every chunk. Used when numpy is not available.
+"""
+def xor_one_keyword_slow(keyword):
 	#create dictionary for this keyword
 	safenet_key = defaultdict(defaultdict)
 	for i in range(512):
@@ -175,23 +314,146 @@ def process():
 	print format_key()
 	compare_keys()
 
-def process_parallel(infolder, language, outfile):
-	read_input(infolder)
-	keywords = keyword_lists[language]
+"""
+List the E-Safenet files below dir that have data after the 512 byte header block, without duplicates (see corpus.py).
+"""
+def list_input(dir):
+	return corpus.Corpus(corpus.list_files(dir)).paths
+
+def index_file(path):
+	text = corpus.map_file(path)
+	index = column_index(text)
+	text.close()
+	return index
+
+"""
+Split the corpus into shards of about SHARD_SIZE bytes: small files are grouped together, large files are
+split into ranges of start positions. The column index of a large file is computed once, up front.
+Each shard is a list of (path, first, last, index) tuples, index None meaning it is computed by the worker.
+"""
+def make_shards(paths, pool):
+	shards = []
+	batch = []
+	size = 0
+	large = []
+	for path in paths:
+		n = os.path.getsize(path)
+		if n > SHARD_SIZE:
+			large.append((path, n))
+			continue
+		batch.append((path, 512, None, None))
+		size += n
+		if size >= SHARD_SIZE:
+			shards.append(batch)
+			batch = []
+			size = 0
+	if batch:
+		shards.append(batch)
+
+	indexes = pool.map(index_file, [path for path, n in large])
+	for (path, n), index in zip(large, indexes):
+		for first in range(512, n, SHARD_SIZE):
+			shards.append([(path, first, first + SHARD_SIZE, index)])
+	return shards
 
-	final_safenet_key = defaultdict(defaultdict)
-	for o in range(512):
-		final_safenet_key[o] = defaultdict(int)
-	p = Pool(4)
-
-	for kw in keywords:
-		res_key = p.apply_async(xor_one_keyword, (kw,))
-		res_key = res_key.get()
-		for k, v in res_key.items():
-			for k2, v2 in v.items():
-				final_safenet_key[k][k2] += v2
+def init_shard_worker(keywords):
+	global shard_keywords
+	shard_keywords = keywords
+
+"""
+Match all keywords in one shard. The files are memory-mapped, so all workers share the page cache
+instead of holding their own copy of the corpus.
+Returns a list of (path, flat indices, counts): the non-zero key byte counts of every file (or range of a file)
+of the shard, as a sparse 512x256 array.
+"""
+def match_shard(shard):
+	results = []
+	for path, first, last, index in shard:
+		counts = numpy.zeros((512, 256), dtype=numpy.int64)
+		text = corpus.map_file(path)
+		if index is None:
+			index = column_index(text)
+		matches = 0
+		for keyword in shard_keywords:
+			matches += match_keyword(text, index, keyword, counts, first, last)
+		text.close()
+		print "Matches found: %d in %s%s" % (matches, path, " (from %d)" % first if first > 512 else "")
+		flat = numpy.flatnonzero(counts)
+		results.append((path, flat, counts.flat[flat]))
+	return results
+
+"""
+Match the keywords of the given language in the files at paths on jobs worker processes, yielding the results of
+every shard (see match_shard).
+"""
+def match_files(paths, language, jobs=None):
+	if not paths:
+		return
+	p = Pool(jobs, init_shard_worker, (keyword_lists[language],))
+	with stats.stage("index"):
+		shards = make_shards(paths, p)
+	with stats.stage("match"):
+		for results in p.imap_unordered(match_shard, shards):
+			yield results
 	p.close()
 	p.join()
+	stats.count("text_files", len(paths))
+	if stats.enabled:
+		#stat'ing every file again is only worth it for the report
+		stats.count("match_bytes", sum(os.path.getsize(path) for path in paths))
+
+"""
+Match the keywords of the given language in the files at paths, on jobs worker processes.
+Returns a 512x256 array with the number of matches of every key byte at every offset.
+"""
+def keyword_counts(paths, language, jobs=None):
+	counts = numpy.zeros((512, 256), dtype=numpy.int64)
+	for results in match_files(paths, language, jobs):
+		for path, flat, n in results:
+			counts.flat[flat] += n
+	return counts
+
+"""
+Like keyword_counts, per file: returns {path: (flat indices, counts)}, the non-zero counts of each file.
+"""
+def file_keyword_counts(paths, language, jobs=None):
+	parts = defaultdict(list)
+	for results in match_files(paths, language, jobs):
+		for path, flat, n in results:
+			parts[path].append((flat, n))
+	counts = {}
+	for path in paths:
+		#the ranges of a large file are matched separately
+		flat = numpy.concatenate([f for f, n in parts[path]] or [numpy.zeros(0, dtype=numpy.int64)])
+		n = numpy.concatenate([n for f, n in parts[path]] or [numpy.zeros(0, dtype=numpy.int64)])
+		flat, inverse = numpy.unique(flat, return_inverse=True)
+		counts[path] = (flat.astype(numpy.int32), numpy.bincount(inverse, n, len(flat)).astype(numpy.int64))
+	return counts
+
+"""
+Probable-plaintext attack on a folder of source code files, with the keywords of the given language.
+The corpus is split into shards over all files (and ranges of large files), which are matched against all
+keywords on jobs worker processes (all cores by default). The key is pickled to outfile.
+"""
+def process_parallel(infolder, language, outfile, jobs=None):
+	keywords = keyword_lists[language]
+	if numpy is not None:
+		with stats.stage("walk"):
+			paths = list_input(infolder)
+		final_safenet_key = counts_to_key(keyword_counts(paths, language, jobs))
+	else:
+		#the workers use the corpus they inherit from this process
+		read_input(infolder)
+		p = Pool(jobs, init_shard_worker, (keywords,))
+		final_safenet_key = defaultdict(defaultdict)
+		for o in range(512):
+			final_safenet_key[o] = defaultdict(int)
+		for res_key in p.imap_unordered(xor_one_keyword, keywords):
+			for k, v in res_key.items():
+				for k2, v2 in v.items():
+					final_safenet_key[k][k2] += v2
+		p.close()
+		p.join()
 	print final_safenet_key.items()
 	k= format_key(final_safenet_key)
 	pickle.dump(k, outfile)
@@ -0,0 +1,232 @@
+# Pipelined folder encryption/decryption for E-Safenet, overlapping I/O with the xor and LZO work
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# The work is split over four stages, connected by bounded queues:
+#   walk (1 thread):      lists the files and creates the destination folders
+#   read (io threads):    reads each file in chunks, and the header block first
+#   transform (threads):  decompresses/compresses the header block, xors the chunks
+#   write (io threads):   writes the chunks of each file in order
+# Several files are read and written at the same time, so the latency of network storage is hidden,
+# while the xor (numpy) and LZO (simplelzo1x) work releases the interpreter lock and runs in parallel.
+#
+# Every chunk holds one of max_buffers buffers from the moment it is read until it is written, and the queues
+# cannot hold more chunks than there are buffers, so the memory used is bounded by max_buffers * chunk_size. The oldest unwritten chunk of a file always holds
+# a buffer, so the pipeline cannot deadlock on them.
+import os
+import Queue
+import threading
+import simplelzo1x
+import stats
+from manifest import HashingReader
+
+#Passed through a queue to stop the threads of the next stage
+STOP = None
+
+"""
+A file going through the pipeline.
+Chunk 0 is the header block, which is transformed by the header function of the action.
+"""
+class Job:
+	def __init__(self, src, dst):
+		self.src = src
+		self.dst = dst
+		self.key = None
+		self.error = None
+		self.lzo_error = False
+		self.total = None	#number of chunks, known when the file has been read completely
+		self.next = 0	#next chunk to write
+		self.written = 0
+		self.digest = None
+		self.pending = {}
+		self.out = None
+		self.lock = threading.Lock()
+
+	def fail(self, e):
+		if self.error is None:
+			self.error = "%s: %s" % (e.__class__.__name__, e)
+			self.lzo_error = isinstance(e, simplelzo1x.error)
+
+"""
+Wait for threads to finish. A join with a timeout, as a plain join cannot be interrupted with Ctrl-C.
+"""
+def join(threads):
+	for thread in threads:
+		while thread.is_alive():
+			thread.join(0.5)
+
+"""
+Run action over all files below folder, writing to dest_folder.
+steps is an (begin, header) pair of functions for the action:
+  begin(infh, key) reads the start of a file and returns (key of the file, header item, first body chunk),
+  header(item, key) returns the output for the header block.
+Body chunks are transformed with xor(chunk, key, position).
+With a manifest (see manifest.py), files that are up to date in it are skipped, and the outcome of the others is recorded.
+Returns a list of (file, error) tuples for the files that could not be processed.
+"""
+def process_folder(folder, dest_folder, key, steps, xor, threads=4, io_threads=8, chunk_size=1 << 20, max_buffers=64, manifest_db=None):
+	begin, header = steps
+	paths = Queue.Queue(1024)
+	chunks = Queue.Queue()
+	out = Queue.Queue()
+	buffers = threading.Semaphore(max_buffers)
+	failures = []
+	failures_lock = threading.Lock()
+	walk_errors = []
+
+	def finish(job):
+		try:
+			if job.out is not None:
+				job.out.close()
+		except Exception as e:
+			job.fail(e)
+		stats.count("files")
+		if job.error is not None:
+			if os.path.exists(job.dst):
+				os.remove(job.dst) #do not leave partial output behind
+			stats.count("failures")
+			if job.lzo_error:
+				stats.count("lzo_errors")
+			with failures_lock:
+				failures.append((job.src, job.error))
+		if manifest_db is not None:
+			manifest_db.record(job.src, job.error, job.key, job.digest, job.written)
+
+	def walk():
+		try:
+			for root, dirs, files in os.walk(folder):
+				nr = root.replace(folder, "")
+				if nr:
+					nr += "/"
+				for d in dirs:
+					if not os.path.isdir(dest_folder + "/" + nr + d):
+						os.mkdir(dest_folder + "/" + nr + d)
+				for f in files:
+					if manifest_db is not None and manifest_db.up_to_date(root + "/" + f, dest_folder + "/" + nr + f):
+						stats.count("skipped")
+						continue
+					paths.put(Job(root + "/" + f, dest_folder + "/" + nr + f))
+		except Exception as e:
+			walk_errors.append(e)
+		finally:
+			for i in range(io_threads):
+				paths.put(STOP)
+
+	def read():
+		while True:
+			job = paths.get()
+			if job is STOP:
+				break
+			seq = 0
+			#the header block is small, it is held in the buffer of the first chunk
+			buffers.acquire()
+			held = True
+			try:
+				with open(job.src, "rb") as fl:
+					fh = HashingReader(fl) if manifest_db is not None and manifest_db.use_hash else fl
+					job.key, item, chunk = begin(fh, key)
+					job.out = open(job.dst, "wb")
+					chunks.put((job, 0, item, None))
+					seq = 1
+					pos = 0
+					while chunk:
+						chunks.put((job, seq, chunk, pos))
+						held = False
+						seq += 1
+						pos += len(chunk)
+						stats.count("read_bytes", len(chunk))
+						buffers.acquire()
+						held = True
+						with stats.stage("read"):
+							chunk = fh.read(chunk_size)
+					if fh is not fl:
+						job.digest = fh.hexdigest()
+			except Exception as e:
+				job.fail(e)
+			if held:
+				buffers.release()
+			with job.lock:
+				job.total = seq
+				done = job.next == job.total
+			if done:
+				finish(job)
+
+	def transform():
+		while True:
+			item = chunks.get()
+			if item is STOP:
+				break
+			job, seq, data, pos = item
+			try:
+				if job.error is not None:
+					data = None
+				elif seq == 0:
+					data = header(data, job.key)
+				else:
+					with stats.stage("xor"):
+						data = xor(data, job.key, pos)
+					stats.count("xor_bytes", len(data))
+			except Exception as e:
+				job.fail(e)
+				data = None
+			out.put((job, seq, data))
+
+	def write():
+		while True:
+			item = out.get()
+			if item is STOP:
+				break
+			job, seq, data = item
+			with job.lock:
+				job.pending[seq] = data
+				while job.next in job.pending:
+					data = job.pending.pop(job.next)
+					if job.error is None:
+						try:
+							with stats.stage("write"):
+								job.out.write(data)
+							stats.count("write_bytes", len(data))
+							job.written += len(data)
+						except Exception as e:
+							job.fail(e)
+					if job.next > 0:
+						buffers.release()
+					job.next += 1
+				done = job.next == job.total
+			if done:
+				finish(job)
+
+	if not os.path.isdir(dest_folder):
+		os.mkdir(dest_folder)
+	readers = [threading.Thread(target=read) for i in range(io_threads)]
+	transformers = [threading.Thread(target=transform) for i in range(threads)]
+	writers = [threading.Thread(target=write) for i in range(io_threads)]
+	walker = threading.Thread(target=walk)
+	for thread in [walker] + readers + transformers + writers:
+		thread.daemon = True
+		thread.start()
+
+	#the threads of a stage are stopped once all threads of the stage before it are done
+	join([walker] + readers)
+	for i in range(threads):
+		chunks.put(STOP)
+	join(transformers)
+	for i in range(io_threads):
+		out.put(STOP)
+	join(writers)
+	if walk_errors:
+		raise walk_errors[0]
+	return failures
@@ -0,0 +1,137 @@
+# E-Safenet header scanner and triage index
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Only the first 512 bytes of each file are read. The results are kept in a SQLite index,
+# files whose size and modification time did not change since the last scan are skipped.
+import os
+import sqlite3
+import struct
+from multiprocessing.pool import ThreadPool
+
+#magic, padding_end, compressed_len, checksum, "E-SafeNet", 3 zero bytes, "LOCK"
+HEADER = struct.Struct("<4shhI9s3s4s")
+MAGIC = "b\x14#e"
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS files (
+	path TEXT PRIMARY KEY,
+	size INTEGER,
+	mtime REAL,
+	encrypted INTEGER,
+	padding_end INTEGER,
+	compressed_len INTEGER,
+	checksum INTEGER,
+	esafenet_magic INTEGER,
+	lock_magic INTEGER,
+	error TEXT
+)"""
+
+"""
+Parse and validate the E-Safenet header in the first 512 bytes of a file.
+Returns a dictionary with the header fields, 'encrypted' tells whether the header is valid,
+'error' holds the reason if it is not.
+"""
+def parse_header(block):
+	info = {'encrypted': False, 'padding_end': None, 'compressed_len': None, 'checksum': None,
+		'esafenet_magic': False, 'lock_magic': False, 'error': None}
+	if len(block) < 512:
+		info['error'] = "file too short"
+		return info
+	magic, padding_end, compressed_len, checksum, esafenet, zeros, lock = HEADER.unpack_from(block)
+	info.update(padding_end=padding_end, compressed_len=compressed_len,
+		checksum=checksum & 0xffffff, #3 bytes checksum, the 1 in the last byte is static
+		esafenet_magic=(esafenet == "E-SafeNet"), lock_magic=(lock == "LOCK"))
+
+	if magic != MAGIC:
+		info['error'] = "bad magic"
+	elif not info['esafenet_magic'] or not info['lock_magic']:
+		info['error'] = "missing E-SafeNet/LOCK marker"
+	elif padding_end < HEADER.size or padding_end + compressed_len != 512:
+		info['error'] = "inconsistent lengths"
+	elif checksum >> 24 != 1:
+		info['error'] = "bad checksum marker"
+	else:
+		info['encrypted'] = True
+	return info
+
+def open_index(index_path):
+	db = sqlite3.connect(index_path)
+	db.execute(SCHEMA)
+	return db
+
+"""
+Stat and (if changed since the last scan) parse a single file.
+Returns None for unchanged files.
+"""
+def scan_file(task):
+	path, known = task
+	try:
+		st = os.stat(path)
+		if known is not None and known == (st.st_size, st.st_mtime):
+			return None
+		with open(path, "rb") as fh:
+			info = parse_header(fh.read(512))
+	except (IOError, OSError) as e:
+		st = None
+		info = parse_header("")
+		info['error'] = str(e)
+	info['path'] = path
+	info['size'] = st.st_size if st else None
+	info['mtime'] = st.st_mtime if st else None
+	return info
+
+"""
+Scan all files below folder and update the index at index_path, using jobs I/O threads.
+Returns (number of files, number of (re)scanned files, number of encrypted files).
+"""
+def scan_folder(folder, index_path, jobs=16):
+	db = open_index(index_path)
+	prefix = folder.rstrip("/") + "/"
+	known = {}
+	for path, size, mtime in db.execute("SELECT path, size, mtime FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)):
+		known[path] = (size, mtime)
+
+	tasks = []
+	for root, dirs, files in os.walk(folder):
+		for f in files:
+			path = os.path.join(root, f)
+			tasks.append((path, known.pop(path, None)))
+
+	pool = ThreadPool(jobs)
+	rows = []
+	for info in pool.imap_unordered(scan_file, tasks, 64):
+		if info is not None:
+			rows.append((info['path'], info['size'], info['mtime'], info['encrypted'], info['padding_end'],
+				info['compressed_len'], info['checksum'], info['esafenet_magic'], info['lock_magic'], info['error']))
+	pool.close()
+	pool.join()
+
+	with db:
+		db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+		#files that are gone since the last scan
+		db.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+	encrypted = db.execute("SELECT COUNT(*) FROM files WHERE encrypted AND substr(path, 1, ?) = ?", (len(prefix), prefix)).fetchone()[0]
+	db.close()
+	return (len(tasks), len(rows), encrypted)
+
+"""
+Returns the paths of the indexed files with a valid E-Safenet header.
+"""
+def encrypted_files(index_path):
+	db = open_index(index_path)
+	paths = [row[0] for row in db.execute("SELECT path FROM files WHERE encrypted ORDER BY path")]
+	db.close()
+	return paths
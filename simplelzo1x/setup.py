@@ -10,6 +10,6 @@ module1 = Extension('simplelzo1x',
                     library_dirs = ['liblzo/'+str(8 * struct.calcsize("P"))+'bit'])
 
 setup (name = 'simplelzo1x',
-       version = '1.1',
+       version = '1.3',
        description = '(De)compress with the LZO1X_1 algorithm used in E-Safenet',
        ext_modules = [module1])
@@ -26,9 +26,12 @@
  */
 
 
-#define MODULE_VERSION  "1.1"
+#define MODULE_VERSION  "1.3"
 
 #include <Python.h>
+#include <structmember.h>
+#include <pythread.h>
+#include <string.h>
 #include "lzo/lzo1x.h"
 
 #if !defined(LZO_VERSION) || (LZO_VERSION != 0x1000)
@@ -41,7 +44,262 @@
 static PyObject *LzoError;
 
 static char compress__doc[] = "compress(str): Compresses a string with E-Safenet's lzo1x.\n";
-static char decompress__doc[] = "decompress(str): Decompress a string with E-Safenet's lzo1x\n";
+static char decompress__doc[] = "decompress(str): Decompress a string with E-Safenet's lzo1x.\n"
+"Raises simplelzo1x.error if the data is corrupt (eg. decrypted with a wrong key).\n";
+static char decrypt__doc[] = "decrypt(data, key): Decrypt an E-Safenet file with the key (a string), in one call:\n"
+"the header block is xored and decompressed, and the rest of the file is xored.\n"
+"data can be any buffer (str, bytearray, mmap, ...). Raises simplelzo1x.error if the header block is corrupt\n"
+"(eg. decrypted with a wrong key), and ValueError if data is shorter than the 512 byte header block.\n";
+static char decrypt_batch__doc[] = "decrypt_batch(list, key): decrypt() every buffer of the list with the key, releasing the GIL once.\n"
+"Returns a list with the decrypted file, or the exception instance for the files that failed.\n";
+static char compressor__doc[] = "Compressor(): holds the LZO work memory, for compressing or encrypting many files. The work memory is cleared\n"
+"for every compression, so the output only depends on the data.\n"
+"A compressor can be shared between threads, but its calls are serialized: use one per thread for parallel work.\n";
+static char compressor_compress__doc[] = "compress(str): like simplelzo1x.compress.\n";
+static char compressor_encrypt__doc[] = "encrypt(data, key): Encrypt a file with the key (a string), in one call: the E-Safenet header\n"
+"is built, the first 512 bytes are compressed and xored, and the rest of the file is xored.\n";
+static char compressor_encrypt_batch__doc[] = "encrypt_batch(list, key): encrypt() every buffer of the list with the key, releasing the GIL once.\n"
+"Returns a list with the encrypted file, or the exception instance for the files that failed.\n";
+
+#define BLOCK_LEN 512
+#define HEADER_LEN 28
+/* worst case expansion of incompressible data for lzo1x */
+#define COMPRESS_BOUND(n) ((n) + (n) / 16 + 64 + 3)
+
+/* xor n bytes of in with the key, starting at key[offset], into out (which may be in) */
+static void
+xor_key(const unsigned char *in, unsigned char *out, size_t n,
+        const unsigned char *key, size_t key_len, size_t offset)
+{
+    size_t i = 0, j = offset % key_len, m, x;
+    unsigned PY_LONG_LONG a, b;
+
+    while (i < n)
+    {
+        m = key_len - j;
+        if (m > n - i)
+            m = n - i;
+        /* a word at a time, memcpy keeps the loads unaligned-safe */
+        for (x = 0; x + 8 <= m; x += 8)
+        {
+            memcpy(&a, in + i + x, 8);
+            memcpy(&b, key + j + x, 8);
+            a ^= b;
+            memcpy(out + i + x, &a, 8);
+        }
+        for (; x < m; x++)
+            out[i + x] = in[i + x] ^ key[j + x];
+        i += m;
+        j = 0;
+    }
+}
+
+static void
+put_le16(unsigned char *p, unsigned int v)
+{
+    p[0] = (unsigned char) (v & 0xff);
+    p[1] = (unsigned char) ((v >> 8) & 0xff);
+}
+
+static void
+put_le32(unsigned char *p, unsigned long v)
+{
+    put_le16(p, (unsigned int) (v & 0xffff));
+    put_le16(p + 2, (unsigned int) ((v >> 16) & 0xffff));
+}
+
+/* lzo1x_1_compress with a cleared dictionary: LZO 1.00 does not initialise the work memory, and matches found
+   through stale entries make the output depend on what was compressed before. */
+static int
+compress_block(const lzo_bytep in, lzo_uint in_len, lzo_bytep out, lzo_uintp out_len, lzo_voidp wrkmem)
+{
+    /* lzo1x_1 output depends on the stale dictionary contents: the memset (of the whole dictionary, also for small
+       inputs) is what makes the output byte-identical between calls, compressors and the Python path */
+    memset(wrkmem, 0, LZO1X_MEM_COMPRESS);
+    return lzo1x_1_compress(in, in_len, out, out_len, wrkmem);
+}
+
+/* A file of a fused call: the input buffer, the output string and the outcome */
+typedef struct
+{
+    PyObject *src;
+    Py_buffer in;
+    PyObject *out;
+    size_t out_len;
+    int err;        /* LZO error, or 1 for input that is too short */
+} fused_item;
+
+/* Size of the decrypted file, or -1 if data cannot hold a header block */
+static Py_ssize_t
+decrypted_bound(Py_ssize_t len)
+{
+    return len < BLOCK_LEN ? -1 : len;
+}
+
+/* Decrypt item->in into item->out, without the GIL */
+static void
+decrypt_item(fused_item *item, const unsigned char *key, size_t key_len)
+{
+    const unsigned char *in = (const unsigned char *) item->in.buf;
+    size_t len = (size_t) item->in.len;
+    unsigned char *out = (unsigned char *) PyString_AS_STRING(item->out);
+    unsigned char header[BLOCK_LEN];
+    size_t offset;
+    lzo_uint new_len = BLOCK_LEN;
+
+    /* the compressed block starts at the offset stored in bytes 4-5, little-endian */
+    offset = in[4] | in[5] << 8;
+    if (offset > BLOCK_LEN)
+        offset = BLOCK_LEN;
+    xor_key(in + offset, header, BLOCK_LEN - offset, key, key_len, 0);
+    item->err = lzo1x_decompress_safe(header, BLOCK_LEN - offset, out, &new_len, NULL);
+    if (item->err == LZO_E_INPUT_NOT_CONSUMED)
+        item->err = LZO_E_OK;
+    if (item->err != LZO_E_OK || new_len > BLOCK_LEN)
+    {
+        if (item->err == LZO_E_OK)
+            item->err = LZO_E_ERROR;
+        return;
+    }
+    /* the body follows the plaintext header, at key offset 0 */
+    xor_key(in + BLOCK_LEN, out + new_len, len - BLOCK_LEN, key, key_len, 0);
+    item->out_len = new_len + len - BLOCK_LEN;
+}
+
+/* Encrypt item->in into item->out with the work memory, without the GIL */
+static void
+encrypt_item(fused_item *item, const unsigned char *key, size_t key_len, lzo_voidp wrkmem)
+{
+    const unsigned char *in = (const unsigned char *) item->in.buf;
+    size_t len = (size_t) item->in.len;
+    size_t first = len < BLOCK_LEN ? len : BLOCK_LEN;
+    size_t second = len < 2 * BLOCK_LEN ? len - first : BLOCK_LEN;
+    unsigned char *out = (unsigned char *) PyString_AS_STRING(item->out);
+    unsigned char compressed[COMPRESS_BOUND(BLOCK_LEN)];
+    lzo_uint clen = sizeof(compressed);
+    unsigned long checksum = 0;
+    size_t i, start;
+
+    item->err = compress_block(in, first, compressed, &clen, wrkmem);
+    if (item->err != LZO_E_OK)
+        return;
+    /* 3 bytes act as checksum for the second 512 bytes of the file. The 1 is static. */
+    for (i = 0; i < second; i++)
+        checksum += in[first + i];
+    checksum |= 1UL << 24;
+
+    memcpy(out, "b\x14#e", 4);
+    put_le16(out + 4, (unsigned int) (BLOCK_LEN - clen));
+    put_le16(out + 6, (unsigned int) clen);
+    put_le32(out + 8, checksum);
+    memcpy(out + 12, "E-SafeNet\0\0\0LOCK", 16);
+    /* the compressed block ends at the end of the header block, unless it does not fit */
+    start = clen > BLOCK_LEN - HEADER_LEN ? HEADER_LEN : BLOCK_LEN - clen;
+    memset(out + HEADER_LEN, 0, start - HEADER_LEN);
+    xor_key(compressed, out + start, clen, key, key_len, 0);
+    if (len > BLOCK_LEN)
+        xor_key(in + BLOCK_LEN, out + start + clen, len - BLOCK_LEN, key, key_len, 0);
+    item->out_len = start + clen + (len > BLOCK_LEN ? len - BLOCK_LEN : 0);
+}
+
+/* Size of the encrypted file at most */
+static Py_ssize_t
+encrypted_bound(Py_ssize_t len)
+{
+    return HEADER_LEN + COMPRESS_BOUND(BLOCK_LEN) + (len > BLOCK_LEN ? len - BLOCK_LEN : 0);
+}
+
+/* Get the buffer of obj and allocate the output string, with the GIL */
+static int
+prepare_item(fused_item *item, PyObject *obj, Py_ssize_t (*bound)(Py_ssize_t))
+{
+    Py_ssize_t out_len;
+
+    item->src = NULL;
+    item->out = NULL;
+    item->out_len = 0;
+    item->err = LZO_E_OK;
+    if (PyObject_GetBuffer(obj, &item->in, PyBUF_SIMPLE) < 0)
+    {
+        /* str and old-style buffers (mmap in Python 2) */
+        const void *p;
+        Py_ssize_t n;
+        PyErr_Clear();
+        if (PyObject_AsReadBuffer(obj, &p, &n) < 0)
+            return -1;
+        if (PyBuffer_FillInfo(&item->in, NULL, (void *) p, n, 1, PyBUF_SIMPLE) < 0)
+            return -1;
+    }
+    /* the buffer has to outlive the call, also when the caller drops it while the GIL is released */
+    Py_INCREF(obj);
+    item->src = obj;
+    out_len = bound(item->in.len);
+    if (out_len < 0)
+    {
+        item->err = 1;
+        return 0;
+    }
+    item->out = PyString_FromStringAndSize(NULL, out_len);
+    if (item->out == NULL)
+    {
+        PyBuffer_Release(&item->in);
+        Py_CLEAR(item->src);
+        return -1;
+    }
+    return 0;
+}
+
+/* Release the input buffer of an item, and return its result: the output string, or a new exception */
+static PyObject *
+finish_item(fused_item *item, const char *action, int raise)
+{
+    PyObject *type, *exc;
+
+    PyBuffer_Release(&item->in);
+    Py_CLEAR(item->src);
+    if (item->err == LZO_E_OK)
+    {
+        if (_PyString_Resize(&item->out, item->out_len) < 0)
+            return NULL;
+        return item->out;
+    }
+    Py_XDECREF(item->out);
+    item->out = NULL;
+    if (item->err == 1)
+    {
+        type = PyExc_ValueError;
+        exc = PyObject_CallFunction(type, "s", "Data is too short to contain an E-Safenet header");
+    }
+    else
+    {
+        type = LzoError;
+        exc = PyObject_CallFunction(type, "N", PyString_FromFormat("Error %i while %s data", item->err, action));
+    }
+    if (exc == NULL || !raise)
+        return exc;
+    PyErr_SetObject(type, exc);
+    Py_DECREF(exc);
+    return NULL;
+}
+
+/* Get the key string argument */
+static int
+get_key(PyObject *obj, const unsigned char **key, Py_ssize_t *key_len)
+{
+    if (!PyString_Check(obj))
+    {
+        PyErr_SetString(PyExc_TypeError, "key must be a string");
+        return -1;
+    }
+    *key = (const unsigned char *) PyString_AS_STRING(obj);
+    *key_len = PyString_GET_SIZE(obj);
+    if (*key_len == 0)
+    {
+        PyErr_SetString(PyExc_ValueError, "key must not be empty");
+        return -1;
+    }
+    return 0;
+}
 
 static PyObject *
 compress(PyObject *dummy, PyObject *args)
@@ -63,7 +321,7 @@ compress(PyObject *dummy, PyObject *args)
     if (len < 0)
         return NULL;
     in_len = len;
-    out_len = in_len + in_len / 64 + 16 + 3;
+    out_len = in_len + in_len / 16 + 64 + 3; //worst case expansion of incompressible data for lzo1x
 
     /* alloc buffers */
     result_str = PyString_FromStringAndSize(NULL, out_len);
@@ -83,7 +341,9 @@ compress(PyObject *dummy, PyObject *args)
     new_len = out_len;
 
     out[0] = 0xf0;
-    err = lzo1x_1_compress(in, in_len, out/*-+5*/, &new_len, wrkmem);
+    Py_BEGIN_ALLOW_THREADS
+    err = compress_block(in, in_len, out/*-+5*/, &new_len, wrkmem);
+    Py_END_ALLOW_THREADS
 
     PyMem_Free(wrkmem);
     if (err != LZO_E_OK || new_len > out_len)
@@ -126,29 +386,283 @@ decompress(PyObject *self, PyObject *args)
     out_len = 512;//always 512 bytes in our application
 
     out_string = PyString_FromStringAndSize(NULL, out_len);
+    if (out_string == NULL)
+        return PyErr_NoMemory();
 
-    //decompress
+    //decompress, with overrun checks: corrupt input must not crash the interpreter
     out = (lzo_bytep) PyString_AsString(out_string);
     new_len = out_len;
 
-    err = lzo1x_decompress(in, in_len, out, &new_len, NULL);
+    Py_BEGIN_ALLOW_THREADS
+    err = lzo1x_decompress_safe(in, in_len, out, &new_len, NULL);
+    Py_END_ALLOW_THREADS
+
+    //trailing bytes after the end-of-stream marker are harmless
+    if ((err != LZO_E_OK && err != LZO_E_INPUT_NOT_CONSUMED) || new_len > out_len)
+    {
+        Py_DECREF(out_string);
+        PyErr_Format(LzoError, "Error %i while decompressing data", err);
+        return NULL;
+    }
 
     if (new_len != out_len)
         _PyString_Resize(&out_string, new_len);
     return out_string;
 }
 
+/* Process prepared items without the GIL: decrypt, or encrypt with the work memory (serialized by lock) */
+static void
+run_items(fused_item *items, Py_ssize_t n, const unsigned char *key, Py_ssize_t key_len,
+          lzo_voidp wrkmem, PyThread_type_lock lock)
+{
+    Py_ssize_t i;
+
+    Py_BEGIN_ALLOW_THREADS
+    if (wrkmem != NULL)
+        PyThread_acquire_lock(lock, 1);
+    for (i = 0; i < n; i++)
+    {
+        if (items[i].err != LZO_E_OK)
+            continue;
+        if (wrkmem != NULL)
+            encrypt_item(&items[i], key, (size_t) key_len, wrkmem);
+        else
+            decrypt_item(&items[i], key, (size_t) key_len);
+    }
+    if (wrkmem != NULL)
+        PyThread_release_lock(lock);
+    Py_END_ALLOW_THREADS
+}
+
+/* A fused call on a single buffer, raising the error of the file */
+static PyObject *
+fused(PyObject *args, lzo_voidp wrkmem, PyThread_type_lock lock)
+{
+    PyObject *data, *key_obj;
+    const unsigned char *key;
+    Py_ssize_t key_len;
+    fused_item item;
+
+    if (!PyArg_ParseTuple(args, wrkmem != NULL ? "OO:encrypt" : "OO:decrypt", &data, &key_obj))
+        return NULL;
+    if (get_key(key_obj, &key, &key_len) < 0)
+        return NULL;
+    if (prepare_item(&item, data, wrkmem != NULL ? encrypted_bound : decrypted_bound) < 0)
+        return NULL;
+    run_items(&item, 1, key, key_len, wrkmem, lock);
+    return finish_item(&item, wrkmem != NULL ? "compressing" : "decompressing", 1);
+}
+
+/* A fused call on a list of buffers, returning a list of results */
+static PyObject *
+fused_batch(PyObject *args, lzo_voidp wrkmem, PyThread_type_lock lock)
+{
+    PyObject *list, *key_obj, *seq, *result = NULL;
+    const unsigned char *key;
+    Py_ssize_t key_len, n, i, prepared = 0;
+    fused_item *items;
+
+    if (!PyArg_ParseTuple(args, wrkmem != NULL ? "OO:encrypt_batch" : "OO:decrypt_batch", &list, &key_obj))
+        return NULL;
+    if (get_key(key_obj, &key, &key_len) < 0)
+        return NULL;
+    seq = PySequence_Fast(list, "expected a list of buffers");
+    if (seq == NULL)
+        return NULL;
+    n = PySequence_Fast_GET_SIZE(seq);
+    items = PyMem_New(fused_item, n > 0 ? n : 1);
+    if (items == NULL)
+    {
+        Py_DECREF(seq);
+        return PyErr_NoMemory();
+    }
+    for (; prepared < n; prepared++)
+        if (prepare_item(&items[prepared], PySequence_Fast_GET_ITEM(seq, prepared),
+                         wrkmem != NULL ? encrypted_bound : decrypted_bound) < 0)
+            goto done;
+    run_items(items, n, key, key_len, wrkmem, lock);
+    result = PyList_New(n);
+
+done:
+    for (i = 0; i < prepared; i++)
+    {
+        PyObject *v = finish_item(&items[i], wrkmem != NULL ? "compressing" : "decompressing", 0);
+        if (result == NULL || v == NULL)
+        {
+            Py_XDECREF(v);
+            Py_CLEAR(result);
+            continue;
+        }
+        PyList_SET_ITEM(result, i, v);
+    }
+    PyMem_Free(items);
+    Py_DECREF(seq);
+    return result;
+}
+
+static PyObject *
+decrypt(PyObject *dummy, PyObject *args)
+{
+    UNUSED(dummy);
+    return fused(args, NULL, NULL);
+}
+
+static PyObject *
+decrypt_batch(PyObject *dummy, PyObject *args)
+{
+    UNUSED(dummy);
+    return fused_batch(args, NULL, NULL);
+}
+
+/* Compressor: LZO work memory (cleared for every compression) and the lock serializing its use */
+typedef struct
+{
+    PyObject_HEAD
+    lzo_voidp wrkmem;
+    PyThread_type_lock lock;
+} Compressor;
+
+static PyObject *
+Compressor_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    Compressor *self;
+
+    if (!_PyArg_NoKeywords("Compressor()", kwds) || !PyArg_ParseTuple(args, ":Compressor"))
+        return NULL;
+    self = (Compressor *) type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
+    self->wrkmem = (lzo_voidp) PyMem_Malloc(LZO1X_MEM_COMPRESS * 2);
+    self->lock = PyThread_allocate_lock();
+    if (self->wrkmem == NULL || self->lock == NULL)
+    {
+        Py_DECREF(self);
+        return PyErr_NoMemory();
+    }
+    return (PyObject *) self;
+}
+
+static void
+Compressor_dealloc(Compressor *self)
+{
+    if (self->wrkmem != NULL)
+        PyMem_Free(self->wrkmem);
+    if (self->lock != NULL)
+        PyThread_free_lock(self->lock);
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+static PyObject *
+Compressor_compress(Compressor *self, PyObject *args)
+{
+    PyObject *result_str;
+    const lzo_bytep in;
+    lzo_uint out_len;
+    lzo_uint new_len;
+    int len;
+    int err;
+
+    if (!PyArg_ParseTuple(args, "s#", &in, &len))
+        return NULL;
+    out_len = COMPRESS_BOUND((lzo_uint) len);
+    result_str = PyString_FromStringAndSize(NULL, out_len);
+    if (result_str == NULL)
+        return PyErr_NoMemory();
+    new_len = out_len;
+
+    Py_BEGIN_ALLOW_THREADS
+    PyThread_acquire_lock(self->lock, 1);
+    err = compress_block(in, len, (lzo_bytep) PyString_AS_STRING(result_str), &new_len, self->wrkmem);
+    PyThread_release_lock(self->lock);
+    Py_END_ALLOW_THREADS
+
+    if (err != LZO_E_OK || new_len > out_len)
+    {
+        Py_DECREF(result_str);
+        PyErr_Format(LzoError, "Error %i while compressing data", err);
+        return NULL;
+    }
+    if (new_len != out_len)
+        _PyString_Resize(&result_str, new_len);
+    return result_str;
+}
+
+static PyObject *
+Compressor_encrypt(Compressor *self, PyObject *args)
+{
+    return fused(args, self->wrkmem, self->lock);
+}
+
+static PyObject *
+Compressor_encrypt_batch(Compressor *self, PyObject *args)
+{
+    return fused_batch(args, self->wrkmem, self->lock);
+}
+
+static PyMethodDef Compressor_methods[] =
+{
+    {"compress", (PyCFunction)Compressor_compress, METH_VARARGS, compressor_compress__doc},
+    {"encrypt", (PyCFunction)Compressor_encrypt, METH_VARARGS, compressor_encrypt__doc},
+    {"encrypt_batch", (PyCFunction)Compressor_encrypt_batch, METH_VARARGS, compressor_encrypt_batch__doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject CompressorType =
+{
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "simplelzo1x.Compressor",           /* tp_name */
+    sizeof(Compressor),                 /* tp_basicsize */
+    0,                                  /* tp_itemsize */
+    (destructor)Compressor_dealloc,     /* tp_dealloc */
+    0,                                  /* tp_print */
+    0,                                  /* tp_getattr */
+    0,                                  /* tp_setattr */
+    0,                                  /* tp_compare */
+    0,                                  /* tp_repr */
+    0,                                  /* tp_as_number */
+    0,                                  /* tp_as_sequence */
+    0,                                  /* tp_as_mapping */
+    0,                                  /* tp_hash */
+    0,                                  /* tp_call */
+    0,                                  /* tp_str */
+    0,                                  /* tp_getattro */
+    0,                                  /* tp_setattro */
+    0,                                  /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                 /* tp_flags */
+    compressor__doc,                    /* tp_doc */
+    0,                                  /* tp_traverse */
+    0,                                  /* tp_clear */
+    0,                                  /* tp_richcompare */
+    0,                                  /* tp_weaklistoffset */
+    0,                                  /* tp_iter */
+    0,                                  /* tp_iternext */
+    Compressor_methods,                 /* tp_methods */
+    0,                                  /* tp_members */
+    0,                                  /* tp_getset */
+    0,                                  /* tp_base */
+    0,                                  /* tp_dict */
+    0,                                  /* tp_descr_get */
+    0,                                  /* tp_descr_set */
+    0,                                  /* tp_dictoffset */
+    0,                                  /* tp_init */
+    0,                                  /* tp_alloc */
+    Compressor_new,                     /* tp_new */
+};
+
 static PyMethodDef methods[] =
 {
     {"compress", (PyCFunction)compress, METH_VARARGS, compress__doc},
     {"decompress", (PyCFunction)decompress, METH_VARARGS, decompress__doc},
+    {"decrypt", (PyCFunction)decrypt, METH_VARARGS, decrypt__doc},
+    {"decrypt_batch", (PyCFunction)decrypt_batch, METH_VARARGS, decrypt_batch__doc},
     {NULL, NULL, 0, NULL}
 };
 
 
 static /* const */ char module_doc[]=
 "This module can compress/decompress a string with the lzo1x algorithm of LZO 1.00 used in E-Safenet.\n"
-"usage: decompress(string) / compress(string)"
+"usage: decompress(string) / compress(string)\n"
+"It can also decrypt/encrypt whole E-Safenet files in one call: decrypt(data, key) / Compressor().encrypt(data, key)"
 ;
 
 
@@ -161,6 +675,8 @@ void initsimplelzo1x(void)
 
     if (lzo_init() != LZO_E_OK)
         return;
+    if (PyType_Ready(&CompressorType) < 0)
+        return;
 
     m = Py_InitModule4("simplelzo1x", methods, module_doc,
                        NULL, PYTHON_API_VERSION);
@@ -168,6 +684,8 @@ void initsimplelzo1x(void)
 
     LzoError = PyErr_NewException("lzo.error", NULL, NULL);
     PyDict_SetItemString(d, "error", LzoError);
+    Py_INCREF(&CompressorType);
+    PyModule_AddObject(m, "Compressor", (PyObject *) &CompressorType);
 
     v = PyString_FromString("Jan Laan <jan@noveria.nl>");
     PyDict_SetItemString(d, "__author__", v);
@@ -0,0 +1,142 @@
+# Timing and throughput instrumentation for the E-Safenet tools
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Stages are timed with
+#   with stats.stage("lzo_decompress"):
+#       ...
+# and events are counted with stats.count("files"). Both do nothing unless stats.enable() was called,
+# so the instrumentation can stay in place: a disabled stage costs one function call and a no-op with block.
+#
+# Hooks (see add_hook) are called with (kind, name, value) for every finished stage ("stage", name, seconds)
+# and every count ("count", name, n), in the process where they happen. Worker processes of the folder actions
+# send their totals to the parent process per file, where they are merged without calling the hooks.
+import json
+import threading
+import time
+
+enabled = False
+#stage name: [seconds, calls]
+timers = {}
+#counter name: value
+counters = {}
+hooks = []
+#stages and counts may happen in several threads at once (see pipeline.py)
+lock = threading.Lock()
+
+class NullStage:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+NULL_STAGE = NullStage()
+
+class Stage:
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		elapsed = time.time() - self.start
+		with lock:
+			timer = timers.setdefault(self.name, [0.0, 0])
+			timer[0] += elapsed
+			timer[1] += 1
+		for hook in hooks:
+			hook("stage", self.name, elapsed)
+		return False
+
+def enable():
+	global enabled
+	enabled = True
+
+def disable():
+	global enabled
+	enabled = False
+
+def reset():
+	timers.clear()
+	counters.clear()
+
+"""
+Time a stage of the work, for use in a with statement.
+"""
+def stage(name):
+	if not enabled:
+		return NULL_STAGE
+	return Stage(name)
+
+def count(name, n=1):
+	if not enabled:
+		return
+	with lock:
+		counters[name] = counters.get(name, 0) + n
+	for hook in hooks:
+		hook("count", name, n)
+
+"""
+Register fn to be called with (kind, name, value) for every stage and count.
+"""
+def add_hook(fn):
+	hooks.append(fn)
+
+def remove_hook(fn):
+	hooks.remove(fn)
+
+"""
+Return the totals collected so far and start again from zero, or None when disabled.
+"""
+def take():
+	if not enabled:
+		return None
+	snapshot = (dict((name, list(timer)) for name, timer in timers.items()), dict(counters))
+	reset()
+	return snapshot
+
+"""
+Add totals returned by take() (in another process) to the totals of this process.
+"""
+def merge(snapshot):
+	if snapshot is None:
+		return
+	stage_totals, counter_totals = snapshot
+	for name, (seconds, calls) in stage_totals.items():
+		timer = timers.setdefault(name, [0.0, 0])
+		timer[0] += seconds
+		timer[1] += calls
+	for name, n in counter_totals.items():
+		counters[name] = counters.get(name, 0) + n
+
+"""
+The totals as a dictionary: seconds and calls per stage, and the counters.
+Stages that have a counter "<stage>_bytes" also get their throughput in MB/s.
+"""
+def report():
+	stages = {}
+	for name, (seconds, calls) in timers.items():
+		stages[name] = {'seconds': round(seconds, 6), 'calls': calls}
+		if name + "_bytes" in counters and seconds > 0:
+			stages[name]['mb_per_s'] = round(counters[name + "_bytes"] / seconds / (1 << 20), 3)
+	return {'stages': stages, 'counters': dict(counters)}
+
+def write_report(fh):
+	json.dump(report(), fh, indent=1, sort_keys=True)
+	fh.write("\n")
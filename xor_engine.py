@@ -0,0 +1,113 @@
+# Bulk XOR engine for E-Safenet keys
+# Copyright (C) 2014  Jan Laan, Cedric Van Bockhaven
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file LICENSE. if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import binascii
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+KEY_LEN = 512
+
+"""
+Replace unknown (None) key bytes by 0, so partially recovered keys can be used as-is.
+"""
+def normalize_key(key):
+	return [0 if b is None else b for b in key]
+
+"""
+Return the key as a byte string, rotated so that it starts at the given offset.
+"""
+def key_string(key, offset=0):
+	k = "".join(chr(b) for b in normalize_key(key))
+	offset %= len(k)
+	return k[offset:] + k[:offset]
+
+"""
+Xor a whole buffer with the key at once, instead of byte by byte.
+offset is the position of text[0] in the keystream, so consecutive chunks of a
+file can be xored separately.
+Uses numpy when it is available, and falls back to a big integer xor otherwise.
+"""
+def xor_with_key(text, key, offset=0):
+	n = len(text)
+	if n == 0:
+		return ""
+	if numpy is not None:
+		k = numpy.array(normalize_key(key), dtype=numpy.uint8)
+		k = numpy.roll(k, -(offset % len(k)))
+		data = numpy.frombuffer(text, dtype=numpy.uint8)
+		return (data ^ numpy.resize(k, n)).tostring()
+
+	k = key_string(key, offset)
+	return xor_strings(text, (k * (n // len(k) + 1))[:n])
+
+"""
+Xor two byte strings of equal length.
+"""
+def xor_strings(a, b):
+	n = len(a)
+	if n == 0:
+		return ""
+	if numpy is not None:
+		return (numpy.frombuffer(a, dtype=numpy.uint8) ^ numpy.frombuffer(b, dtype=numpy.uint8)).tostring()
+	x = int(binascii.hexlify(a), 16) ^ int(binascii.hexlify(b), 16)
+	return binascii.unhexlify("%0*x" % (2 * n, x))
+
+"""
+The bytes of a bytes-like object (str, bytearray, buffer, mmap, memoryview or numpy array) as a string.
+"""
+def as_string(data):
+	if isinstance(data, memoryview):
+		return data.tobytes()
+	if isinstance(data, (bytearray, buffer)):
+		return str(data)
+	if numpy is not None and isinstance(data, numpy.ndarray):
+		return data.tostring()
+	return data[:]
+
+"""
+A numpy uint8 array sharing the memory of a bytes-like object, which is writable if the object is.
+"""
+def byte_array(data):
+	if isinstance(data, memoryview):
+		data = numpy.asarray(data)
+	if isinstance(data, numpy.ndarray):
+		return data.view(numpy.uint8).reshape(-1)
+	return numpy.frombuffer(data, dtype=numpy.uint8)
+
+"""
+Xor length bytes of src, from src_start on, with the key into the writable buffer dst at dst_start (the rest of src by default).
+offset is the position of src[src_start] in the keystream, like in xor_with_key.
+With numpy, the bytes are xored straight from src into dst a key length at a time, without copying src or repeating the key.
+"""
+def xor_into(src, dst, key, offset=0, src_start=0, dst_start=0, length=None):
+	if length is None:
+		length = len(src) - src_start
+	if length <= 0:
+		return
+	if len(dst) < dst_start + length:
+		raise ValueError("Output buffer too small: %d bytes needed" % (dst_start + length))
+	if numpy is None:
+		dst[dst_start:dst_start + length] = xor_with_key(as_string(src[src_start:src_start + length]), key, offset)
+		return
+	k = numpy.roll(numpy.array(normalize_key(key), dtype=numpy.uint8), -(offset % len(key)))
+	a = byte_array(src)[src_start:src_start + length]
+	out = byte_array(dst)[dst_start:dst_start + length]
+	whole = length - length % len(k)
+	numpy.bitwise_xor(a[:whole].reshape(-1, len(k)), k, out[:whole].reshape(-1, len(k)))
+	numpy.bitwise_xor(a[whole:], k[:length - whole], out[whole:])